@@ -0,0 +1,409 @@
+"""Throughput benchmarks of the data and model hot paths. Everything runs offline on CPU with
+synthetic Croatian card transactions and a tiny randomly initialized transformer.
+
+Examples:
+    python -m benchmarks.run_benchmarks --output bench.json
+    python -m benchmarks.run_benchmarks --baseline bench.json --tolerance 0.2
+"""
+import sys
+import json
+import time
+import asyncio
+import argparse
+import tempfile
+import platform
+from datetime import datetime
+import numpy as np
+import pandas as pd
+import torch
+from datasets import Dataset
+from finmetrika_ml.utils import apply_functions, get_python_version, get_package_version
+from finmetrika_ml.data import data_cleaning
+from finmetrika_ml.data.data_cleaning import cleaning_pipelines, cleaning_steps, CleaningEngine, CachedCleaner
+from finmetrika_ml.data.data_cleaning_columnar import clean_column
+from finmetrika_ml.data.data_features import create_datetime_features
+from finmetrika_ml.data.data_processing import (count_tokens, TRXDataset, TRXTensorDataset,
+                                                LengthBucketSampler, DynamicPaddingCollator, CausalLMDataset,
+                                                RegressionDataset1D)
+from finmetrika_ml.data.data_token_cache import TokenizationCache
+from finmetrika_ml.model.evaluation import fwd_pass
+from finmetrika_ml.model.inference import UniqueInference
+from finmetrika_ml.model.training import TrainNN
+from finmetrika_ml.model.serving import MicroBatchScorer
+from benchmarks.synthetic import generate_transactions, build_tokenizer, build_tiny_model, build_tiny_causal_lm
+
+
+
+# name: function(ctx) running the benchmark once and returning the number of processed items
+benchmarks = {}
+
+
+def benchmark(name:str):
+    def register(func):
+        benchmarks[name] = func
+        return func
+    return register
+
+
+
+class Context:
+    """Data shared by the benchmarks, built once."""
+    def __init__(self, n_rows:int, seed:int=42) -> None:
+        self.df = generate_transactions(n_rows, seed=seed)
+        self.texts = self.df['text'].tolist()
+        self.tokenizer = build_tokenizer(self.texts)
+        self.encodings = self.tokenizer(self.texts, padding='max_length', max_length=32, truncation=True)
+        self.labels = pd.factorize(self.df['label'])[0]
+        self.dataset = Dataset.from_dict({"text": self.texts,
+                                          "input_ids": self.encodings['input_ids'],
+                                          "attention_mask": self.encodings['attention_mask'],
+                                          "label": self.labels})
+        self.model = build_tiny_model(len(self.tokenizer), num_labels=int(self.labels.max()) + 1)
+
+
+
+def _register_cleaning_functions():
+    for name in list(cleaning_steps) + ['remove_repeated_words']:
+        func = getattr(data_cleaning, name)
+
+        def run(ctx, func=func):
+            for text in ctx.texts:
+                func(text)
+            return len(ctx.texts)
+
+        benchmark(f'data_cleaning.{name}')(run)
+
+_register_cleaning_functions()
+
+
+
+@benchmark('apply_functions.default_chain')
+def _apply_functions_chain(ctx):
+    functions = [getattr(data_cleaning, f) for f in cleaning_pipelines['default']]
+    for text in ctx.texts:
+        apply_functions(functions, text)
+    return len(ctx.texts)
+
+
+@benchmark('apply_functions.minimal_chain')
+def _apply_functions_minimal_chain(ctx):
+    functions = [getattr(data_cleaning, f) for f in cleaning_pipelines['minimal']]
+    for text in ctx.texts:
+        apply_functions(functions, text)
+    return len(ctx.texts)
+
+
+@benchmark('CleaningEngine.default_chain')
+def _cleaning_engine(ctx):
+    engine = CleaningEngine(cleaning_pipelines['default'])
+    for text in ctx.texts:
+        engine(text)
+    return len(ctx.texts)
+
+
+@benchmark('clean_column.default_chain')
+def _clean_column(ctx):
+    clean_column(cleaning_pipelines['default'], ctx.df['text'])
+    return len(ctx.texts)
+
+
+@benchmark('CachedCleaner.default_chain')
+def _cached_cleaner(ctx):
+    CachedCleaner(cleaning_pipelines['default'])(ctx.df['text'])
+    return len(ctx.texts)
+
+
+@benchmark('create_datetime_features')
+def _create_datetime_features(ctx):
+    create_datetime_features(ctx.df[['TRX_DATE']].copy(), 'TRX_DATE')
+    return len(ctx.df)
+
+
+@benchmark('count_tokens')
+def _count_tokens(ctx):
+    df = pd.DataFrame({"input_ids": ctx.encodings['input_ids'],
+                       "attention_mask": ctx.encodings['attention_mask']})
+    count_tokens(df)
+    return len(df)
+
+
+@benchmark('count_tokens.dataset')
+def _count_tokens_dataset(ctx):
+    count_tokens(ctx.dataset)
+    return len(ctx.dataset)
+
+
+@benchmark('tokenizer')
+def _tokenizer(ctx):
+    ctx.tokenizer(ctx.texts, truncation=True, max_length=32)
+    return len(ctx.texts)
+
+
+@benchmark('TokenizationCache.cold')
+def _tokenization_cache_cold(ctx):
+    with tempfile.TemporaryDirectory() as cache_dir:
+        TokenizationCache(cache_dir, ctx.tokenizer, truncation=True, max_length=32).tokenize(ctx.texts)
+    return len(ctx.texts)
+
+
+@benchmark('TokenizationCache.warm')
+def _tokenization_cache_warm(ctx):
+    # The cache is filled once, the runs then read the tokens from disk
+    if not hasattr(ctx, 'token_cache_dir'):
+        ctx.token_cache_dir = tempfile.mkdtemp()
+        TokenizationCache(ctx.token_cache_dir, ctx.tokenizer, truncation=True, max_length=32).tokenize(ctx.texts)
+    TokenizationCache(ctx.token_cache_dir, ctx.tokenizer, truncation=True, max_length=32).tokenize(ctx.texts)
+    return len(ctx.texts)
+
+
+@benchmark('TRXDataset.__getitem__')
+def _trx_dataset_getitem(ctx):
+    dataset = TRXDataset(ctx.dataset, device='cpu')
+    n = min(len(dataset), 2_000)
+    for i in range(n):
+        dataset[i]
+    return n
+
+
+@benchmark('TRXTensorDataset.__getitem__')
+def _trx_tensor_dataset_getitem(ctx):
+    dataset = TRXTensorDataset(ctx.dataset)
+    for i in range(len(dataset)):
+        dataset[i]
+    return len(dataset)
+
+
+@benchmark('TRXTensorDataset.get_batch')
+def _trx_tensor_dataset_get_batch(ctx, batch_size:int=64):
+    dataset = TRXTensorDataset(ctx.dataset)
+    for start in range(0, len(dataset), batch_size):
+        dataset.get_batch(list(range(start, min(start + batch_size, len(dataset)))))
+    return len(dataset)
+
+
+@benchmark('fwd_pass.cpu')
+def _fwd_pass(ctx, batch_size:int=64):
+    n = min(len(ctx.texts), 2_048)
+    input_ids = torch.tensor(ctx.encodings['input_ids'][:n])
+    attention_mask = torch.tensor(ctx.encodings['attention_mask'][:n])
+    for start in range(0, n, batch_size):
+        batch = {"input_ids": input_ids[start:start+batch_size],
+                 "attention_mask": attention_mask[start:start+batch_size]}
+        fwd_pass(batch, ctx.model, 'cpu', ctx.tokenizer)
+    return n
+
+
+
+@benchmark('fwd_pass.cpu_dynamic_padding')
+def _fwd_pass_dynamic_padding(ctx, batch_size:int=64):
+    dataset = TRXTensorDataset(ctx.dataset.select(range(min(len(ctx.dataset), 2_048))))
+    sampler = LengthBucketSampler(count_tokens(ctx.dataset.select(range(len(dataset)))), batch_size)
+    collator = DynamicPaddingCollator(ctx.tokenizer.pad_token_id)
+    for indices in sampler:
+        fwd_pass(collator(dataset.get_batch(indices)), ctx.model, 'cpu', ctx.tokenizer)
+    return len(dataset)
+
+
+@benchmark('UniqueInference.default_chain')
+def _unique_inference(ctx, batch_size:int=64):
+    UniqueInference(ctx.model, ctx.tokenizer, cleaner=cleaning_pipelines['default'],
+                    max_length=32, batch_size=batch_size)(ctx.df['text'])
+    return len(ctx.texts)
+
+
+
+@benchmark('RegressionDataset1D.DataLoader')
+def _regression_dataloader(ctx, batch_size:int=4_096):
+    dataset = RegressionDataset1D(ctx.df['TRX_AMOUNT'].to_numpy(), ctx.labels)
+    sampler = torch.utils.data.BatchSampler(torch.utils.data.RandomSampler(dataset), batch_size, drop_last=False)
+    loader = torch.utils.data.DataLoader(dataset, sampler=sampler, batch_size=None,
+                                         collate_fn=RegressionDataset1D.collate)
+    for _ in loader:
+        pass
+    return len(dataset)
+
+
+@benchmark('RegressionDataset1D.iter_batches')
+def _regression_iter_batches(ctx, batch_size:int=4_096):
+    dataset = RegressionDataset1D(ctx.df['TRX_AMOUNT'].to_numpy(), ctx.labels)
+    for _ in dataset.iter_batches(batch_size, shuffle=True):
+        pass
+    return len(dataset)
+
+
+@benchmark('fwd_pass.per_request')
+def _fwd_pass_per_request(ctx):
+    n = min(len(ctx.texts), 256)
+    for text in ctx.texts[:n]:
+        fwd_pass(ctx.tokenizer([text], truncation=True, max_length=32, return_tensors='pt'),
+                 ctx.model, 'cpu', ctx.tokenizer)
+    return n
+
+
+@benchmark('MicroBatchScorer.concurrent_requests')
+def _micro_batch_scorer(ctx):
+    n = min(len(ctx.texts), 2_048)
+
+    async def run():
+        async with MicroBatchScorer(ctx.model, ctx.tokenizer, max_batch_size=64, max_wait_ms=5,
+                                    max_length=32) as scorer:
+            await asyncio.gather(*[scorer.score(text) for text in ctx.texts[:n]])
+
+    asyncio.run(run())
+    return n
+
+
+def _causal_lm_steps(ctx, dataset:CausalLMDataset, batch_size:int) -> int:
+    """Training steps of a tiny causal LM over the dataset, returns the number of real tokens."""
+    if not hasattr(ctx, 'causal_lm'):
+        ctx.causal_lm = build_tiny_causal_lm(len(ctx.tokenizer))
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size)
+    for batch in loader:
+        batch.pop('document_ids', None)
+        ctx.causal_lm(**batch).loss.backward()
+    return dataset.n_tokens
+
+
+@benchmark('CausalLMDataset.unpacked_tokens')
+def _causal_lm_unpacked(ctx, batch_size:int=32):
+    encodings = ctx.tokenizer(ctx.texts[:512], padding='max_length', max_length=32,
+                              truncation=True, return_tensors='pt')
+    return _causal_lm_steps(ctx, CausalLMDataset(encodings, 'cpu'), batch_size)
+
+
+@benchmark('CausalLMDataset.packed_tokens')
+def _causal_lm_packed(ctx, batch_size:int=8):
+    encodings = ctx.tokenizer(ctx.texts[:512], padding='max_length', max_length=32,
+                              truncation=True, return_tensors='pt')
+    dataset = CausalLMDataset(encodings, 'cpu', packed=True, block_size=128,
+                              sep_token_id=ctx.tokenizer.sep_token_id)
+    return _causal_lm_steps(ctx, dataset, batch_size)
+
+
+
+def _train_epoch(ctx, autocast_dtype:torch.dtype=None, batch_size:int=32) -> int:
+    n = min(len(ctx.dataset), 1_024)
+    dataset = TRXTensorDataset(ctx.dataset.select(range(n)))
+    sampler = LengthBucketSampler(count_tokens(ctx.dataset.select(range(n))), batch_size, shuffle=True)
+    loader = torch.utils.data.DataLoader(dataset, sampler=sampler, batch_size=None,
+                                         collate_fn=DynamicPaddingCollator(ctx.tokenizer.pad_token_id))
+    model = build_tiny_model(len(ctx.tokenizer), num_labels=int(ctx.labels.max()) + 1)
+    TrainNN(model, loader, torch.nn.CrossEntropyLoss(), torch.optim.AdamW(model.parameters(), lr=1e-4),
+            num_epochs=1, device='cpu', autocast_dtype=autocast_dtype, verbose=False).train()
+    return n
+
+
+@benchmark('TrainNN.fp32')
+def _train_nn_fp32(ctx):
+    return _train_epoch(ctx)
+
+
+@benchmark('TrainNN.bf16')
+def _train_nn_bf16(ctx):
+    return _train_epoch(ctx, torch.bfloat16)
+
+
+
+def run_benchmarks(n_rows:int=20_000,
+                   repeat:int=3,
+                   name_filter:str=None,
+                   verbose:bool=True) -> dict:
+    """Run the benchmarks and measure the throughput. The best of 'repeat' runs is kept.
+
+    Args:
+        n_rows (int, optional): Number of synthetic transactions. Defaults to 20_000.
+        repeat (int, optional): Number of runs of each benchmark. Defaults to 3.
+        name_filter (str, optional): Only run benchmarks containing this string. Defaults to None.
+        verbose (bool, optional): Print the results. Defaults to True.
+
+    Returns:
+        dict: Run information under "meta" and items/s of each benchmark under "results".
+    """
+    torch.set_num_threads(1)
+    ctx = Context(n_rows)
+
+    results = {}
+    for name, func in benchmarks.items():
+        if name_filter and name_filter not in name:
+            continue
+        times = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            n_items = func(ctx)
+            times.append(time.perf_counter() - start)
+        results[name] = {"items": n_items,
+                         "seconds": min(times),
+                         "items_per_sec": n_items / min(times)}
+        if verbose:
+            print(f'{name:<45} {results[name]["items_per_sec"]:>14,.0f} items/s')
+
+    meta = {"date": datetime.now().strftime("%Y-%m-%d %H:%M:%S"),
+            "rows": n_rows,
+            "repeat": repeat,
+            "python": get_python_version(),
+            "torch": get_package_version("torch"),
+            "pandas": get_package_version("pandas"),
+            "platform": f'{platform.system()} {platform.machine()}'}
+
+    return {"meta": meta, "results": results}
+
+
+
+def compare_results(results:dict,
+                    baseline:dict,
+                    tolerance:float=0.2,
+                    verbose:bool=True) -> list:
+    """Compare the throughput against a baseline run.
+
+    Args:
+        results (dict): Output of run_benchmarks().
+        baseline (dict): Output of an earlier run_benchmarks().
+        tolerance (float, optional): Allowed relative slow down. Defaults to 0.2.
+        verbose (bool, optional): Print the comparison. Defaults to True.
+
+    Returns:
+        list: Names of the benchmarks slower than the baseline by more than the tolerance.
+    """
+    regressions = []
+    for name, res in results["results"].items():
+        if name not in baseline["results"]:
+            continue
+        ratio = res["items_per_sec"] / baseline["results"][name]["items_per_sec"]
+        if ratio < 1 - tolerance:
+            regressions.append(name)
+        if verbose:
+            flag = 'REGRESSION' if name in regressions else ''
+            print(f'{name:<45} {ratio:>8.2f}x {flag}')
+
+    return regressions
+
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark the data and model hot paths.")
+    parser.add_argument("--rows", type=int, default=20_000, help="Number of synthetic transactions.")
+    parser.add_argument("--repeat", type=int, default=3, help="Number of runs of each benchmark.")
+    parser.add_argument("--filter", default=None, help="Only run benchmarks containing this string.")
+    parser.add_argument("--output", default=None, help="Save the results to this json file.")
+    parser.add_argument("--baseline", default=None, help="Compare against the results in this json file.")
+    parser.add_argument("--tolerance", type=float, default=0.2, help="Allowed relative slow down.")
+    args = parser.parse_args()
+
+    results = run_benchmarks(args.rows, args.repeat, args.filter)
+
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(results, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        print('\nThroughput relative to the baseline:')
+        regressions = compare_results(results, baseline, args.tolerance)
+        if regressions:
+            sys.exit(f'{len(regressions)} benchmark(s) slower than the baseline: {regressions}')
+
+
+
+if __name__ == "__main__":
+    main()
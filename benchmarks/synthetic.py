@@ -0,0 +1,139 @@
+import numpy as np
+import pandas as pd
+import torch
+from tokenizers import Tokenizer
+from tokenizers.models import WordLevel
+from tokenizers.pre_tokenizers import Whitespace
+from transformers import PreTrainedTokenizerFast, BertConfig, BertForSequenceClassification, GPT2Config, GPT2LMHeadModel
+
+
+
+# Merchants and their categories (labels) as they appear on Croatian card statements
+merchants = {
+    "KONZUM P-{branch} {city}"           : "groceries",
+    "PLODINE {city}"                     : "groceries",
+    "LIDL HRVATSKA D.O.O. {city}"        : "groceries",
+    "SPAR HRVATSKA d.o.o. {city}"        : "groceries",
+    "TISAK TN{branch} {city}"            : "kiosk",
+    "INA BS {city}"                      : "fuel",
+    "PETROL d.d. {city}"                 : "fuel",
+    "HEP ELEKTRA DOO"                    : "utilities",
+    "HT HRVATSKI TELEKOM d.d."           : "utilities",
+    "BOLT.EU/O/2401 TALLINN"             : "transport",
+    "WWW.AMAZON.DE*AB12C"                : "online",
+    "PAYPAL *NETFLIX.COM"                : "online",
+    "ATM A{atm} PBZ {city}"              : "cash",
+    "Prijenos sa HR{iban} {name}"        : "transfer",
+    "PBZT DM-DROGERIE MARKT {city}"      : "drugstore",
+    "MULLER TRGOVINA ZAGREB d.o.o. {city}": "drugstore",
+}
+
+cities = ["ZAGREB", "SPLIT", "RIJEKA", "OSIJEK", "ZADAR", "PULA", "VARAŽDIN", "ŠIBENIK", "ČAKOVEC"]
+names = ["IVAN HORVAT", "ANA KOVAČEVIĆ", "MARKO BABIĆ", "PETRA MARIĆ", "LUKA JURIĆ"]
+
+
+
+def generate_transactions(n_rows:int,
+                          n_branches:int=200,
+                          seed:int=42) -> pd.DataFrame:
+    """Generate synthetic Croatian card transactions. Like the real data, the texts are very
+    repetitive: a limited number of merchants, branches and cities, with a masked card number
+    added to a part of the transactions.
+
+    Args:
+        n_rows (int): Number of transactions.
+        n_branches (int, optional): Number of distinct store branches. Defaults to 200.
+        seed (int, optional): Random seed. Defaults to 42.
+
+    Returns:
+        pd.DataFrame: Columns 'text', 'label', 'TRX_AMOUNT' and 'TRX_DATE'.
+    """
+    rng = np.random.default_rng(seed)
+    templates = list(merchants)
+    # Some merchants are much more frequent than the others
+    weights = rng.dirichlet(np.ones(len(templates)) * 0.7)
+    branches = rng.integers(0, 9999, n_branches)
+
+    idx = rng.choice(len(templates), size=n_rows, p=weights)
+    texts = []
+    for i in idx:
+        text = templates[i].format(branch=f'{rng.choice(branches):04d}',
+                                   city=rng.choice(cities),
+                                   atm=rng.integers(1_000_000, 9_999_999),
+                                   iban=rng.integers(10**9, 10**10),
+                                   name=rng.choice(names))
+        if rng.random() < 0.3:
+            text = f'{text} {rng.integers(400000, 559999)}XXXXXX{rng.integers(1000, 9999)}'
+        texts.append(text)
+
+    start = np.datetime64('2023-01-01T00:00')
+    minutes = rng.integers(0, 2 * 365 * 24 * 60, n_rows).astype('timedelta64[m]')
+
+    return pd.DataFrame({"text": texts,
+                         "label": [merchants[templates[i]] for i in idx],
+                         "TRX_AMOUNT": np.round(rng.lognormal(3, 1.5, n_rows), 2),
+                         "TRX_DATE": pd.to_datetime(start + minutes)})
+
+
+
+def build_tokenizer(texts:list) -> PreTrainedTokenizerFast:
+    """Build a word level tokenizer on the texts, without downloading anything.
+
+    Args:
+        texts (list): Texts to build the vocabulary from.
+    """
+    special_tokens = ["[PAD]", "[UNK]", "[CLS]", "[SEP]"]
+    words = sorted({w for t in texts for w, _ in Whitespace().pre_tokenize_str(t)})
+    vocab = {w: i for i, w in enumerate(special_tokens + words)}
+
+    tokenizer = Tokenizer(WordLevel(vocab, unk_token="[UNK]"))
+    tokenizer.pre_tokenizer = Whitespace()
+
+    return PreTrainedTokenizerFast(tokenizer_object=tokenizer,
+                                   pad_token="[PAD]", unk_token="[UNK]",
+                                   cls_token="[CLS]", sep_token="[SEP]",
+                                   model_input_names=["input_ids", "attention_mask"])
+
+
+
+def build_tiny_model(vocab_size:int,
+                     num_labels:int,
+                     seed:int=42) -> BertForSequenceClassification:
+    """Randomly initialized tiny BERT classifier for CPU benchmarks.
+
+    Args:
+        vocab_size (int): Size of the tokenizer vocabulary.
+        num_labels (int): Number of classes.
+        seed (int, optional): Random seed. Defaults to 42.
+    """
+    torch.manual_seed(seed)
+    config = BertConfig(vocab_size=vocab_size,
+                        hidden_size=64,
+                        num_hidden_layers=2,
+                        num_attention_heads=2,
+                        intermediate_size=128,
+                        max_position_embeddings=128,
+                        num_labels=num_labels)
+
+    return BertForSequenceClassification(config).eval()
+
+
+
+def build_tiny_causal_lm(vocab_size:int,
+                         seed:int=42) -> GPT2LMHeadModel:
+    """Randomly initialized tiny GPT-2 for CPU benchmarks of causal language modelling.
+
+    Args:
+        vocab_size (int): Size of the tokenizer vocabulary.
+        seed (int, optional): Random seed. Defaults to 42.
+    """
+    torch.manual_seed(seed)
+    config = GPT2Config(vocab_size=vocab_size,
+                        n_embd=64,
+                        n_layer=2,
+                        n_head=2,
+                        n_positions=256,
+                        bos_token_id=None,
+                        eos_token_id=None)
+
+    return GPT2LMHeadModel(config)
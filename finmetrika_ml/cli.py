@@ -32,6 +32,31 @@ def main():
     create_notebook_from_template(template_path, output_path)
 
 
+def clean_file_main(argv:list=None):
+    parser = argparse.ArgumentParser(description="Clean the text column of a CSV or Parquet file and write it to Parquet.")
+    parser.add_argument("input", help="Path to the input .csv or .parquet file.")
+    parser.add_argument("output", help="Path where the cleaned .parquet file will be saved.")
+    parser.add_argument("--text-column", default="text", help="Name of the column containing the text.")
+    parser.add_argument("--output-column", default=None, help="Name of the cleaned text column. Replaces the text column by default.")
+    parser.add_argument("--pipeline", default="default", 
+                        help="Name of the cleaning pipeline, of a data cleaning function or a comma separated list of data cleaning functions.")
+    parser.add_argument("--batch-size", type=int, default=100_000, help="Number of rows per batch.")
+    parser.add_argument("--cache-size", type=int, default=100_000, help="Number of cleaned texts kept across batches.")
+    args = parser.parse_args(argv)
+
+    # Import here to keep the notebook command light
+    from finmetrika_ml.data.data_cleaning_stream import clean_file
+
+    pipeline = args.pipeline.split(",") if "," in args.pipeline else args.pipeline
+    clean_file(Path(args.input).resolve(), 
+               Path(args.output).resolve(),
+               text_column=args.text_column,
+               pipeline=pipeline,
+               output_column=args.output_column,
+               batch_size=args.batch_size,
+               cache_size=args.cache_size)
+
+
 
 if __name__ == "__main__":
     main()
@@ -1,7 +1,16 @@
 import re
+from collections import OrderedDict
+from functools import partial
 import pandas as pd
 import numpy as np
 
+try:  # Python >= 3.11
+    from re import _parser as sre_parse
+    from re import _constants as sre_constants
+except ImportError:
+    import sre_parse
+    import sre_constants
+
 
 
 # Define credit card pattern: 462765XXXXXX1234
@@ -92,8 +101,8 @@ def remove_repeated_words(text:str):
 
 
 
-def remove_abrv_chr(text:str
-                    #, abrv_patterns:list=None
+def remove_abrv_chr(text:str, 
+                    abrv_patterns:list=None
                     ):
     """Remove abbreviations from text. To add any other ones to the list specify the 'abrv_patterns' argument.
 
@@ -103,11 +112,11 @@ def remove_abrv_chr(text:str
     """
     
     # Define initial abbreviations to remove and make a copy
-    patterns_list = patterns_dict["abbreviations"]#[:]
+    patterns_list = patterns_dict["abbreviations"][:]
     
     # Add extra specified by the user
-    # if abrv_patterns is not None:
-    #     patterns_list.extend(abrv_patterns)
+    if abrv_patterns is not None:
+        patterns_list.extend(abrv_patterns)
 
     modified_text = text
     for p in patterns_list:
@@ -215,3 +224,537 @@ def remove_punctuation(text:str) -> str:
     
     return modified_text
 
+
+
+# Named cleaning pipelines, i.e. data cleaning functions in the order to apply them
+cleaning_pipelines = {
+    "default" : ["remove_ccard", "remove_iban", "remove_atm_no", "remove_branch_info", "remove_cro_abrv",
+                 "remove_abrv_chr", "remove_non_ascii_chr", "remove_punctuation", "remove_repeated_words"],
+    "minimal" : ["remove_ccard", "remove_non_ascii_chr", "remove_punctuation"],
+}
+
+
+# Regex based cleaning functions described by their patterns_dict key, the replacement
+# string and whether the function strips the result.
+cleaning_steps = {
+    "remove_ccard"         : ("credit_card_no", "", True),
+    "remove_abrv_chr"      : ("abbreviations", "", True),
+    "remove_non_ascii_chr" : ("non_ascii_chr", "", False),
+    "remove_cro_abrv"      : ("cro_abrv", "", False),
+    "remove_branch_info"   : ("branch-no", "", False),
+    "remove_atm_no"        : ("atm_no", r"\1", False),
+    "remove_iban"          : ("iban", "", False),
+    "remove_punctuation"   : ("punctuation", "", False),
+}
+
+
+
+def _as_list(patterns) -> list:
+    """Return the patterns_dict entry as a list of patterns."""
+    return list(patterns) if isinstance(patterns, (list, tuple)) else [patterns]
+
+
+
+def _literal_runs(tokens) -> list:
+    """Collect the runs of literal characters every match of the parsed pattern must contain."""
+    runs, current = [], []
+    for op, av in tokens:
+        if op is sre_constants.LITERAL:
+            current.append(chr(av))
+            continue
+        runs.append(''.join(current))
+        current = []
+        if op is sre_constants.SUBPATTERN and not av[1] & re.IGNORECASE:
+            runs.extend(_literal_runs(av[-1]))
+        elif op in (sre_constants.MAX_REPEAT, sre_constants.MIN_REPEAT) and av[0] >= 1:
+            runs.extend(_literal_runs(av[2]))
+    runs.append(''.join(current))
+    return runs
+
+
+
+def _parse_plain(pattern:str):
+    """Parse the pattern, None if it is invalid or sets inline flags (e.g. '(?i)'), which the
+    literal fast paths do not support."""
+    try:
+        parsed = sre_parse.parse(pattern)
+    except re.error:
+        return None
+    if parsed.state.flags & ~re.UNICODE:
+        return None
+    return parsed
+
+
+
+def required_literal(pattern:str) -> str:
+    """Find the longest literal substring that every match of the pattern contains. If
+    the literal is not in the text the pattern cannot match, so the (costly) regex scan
+    can be replaced by a substring check.
+
+    Args:
+        pattern (str): Regex pattern.
+
+    Returns:
+        str: Required literal or an empty string if there is none.
+    """
+    parsed = _parse_plain(pattern)
+    if parsed is None:
+        return ''
+    
+    return max(_literal_runs(parsed), key=len)
+
+
+
+def _single_char_pattern(pattern:str) -> bool:
+    """Check whether the pattern always matches exactly one character, e.g. '\\.' or '[^ -~]'."""
+    parsed = _parse_plain(pattern)
+    return (parsed is not None and len(parsed) == 1 and 
+            parsed[0][0] in (sre_constants.LITERAL, sre_constants.NOT_LITERAL, sre_constants.IN))
+
+
+
+def _sub_op(pattern:str, repl:str):
+    """Compile a single substitution guarded by its required literal."""
+    regex = re.compile(pattern)
+    literal = required_literal(pattern)
+    if literal:
+        return lambda text: regex.sub(repl, text) if literal in text else text
+    return lambda text: regex.sub(repl, text)
+
+
+
+def _delete_chars_op(patterns:list):
+    """Fuse consecutive single character deletions into one pass. Deleting one set of
+    characters after another is the same as deleting their union at once.
+    """
+    literals = [sre_parse.parse(p)[0] for p in patterns]
+    if all(op is sre_constants.LITERAL for op, _ in literals):
+        table = str.maketrans('', '', ''.join(chr(av) for _, av in literals))
+        return lambda text: text.translate(table)
+    
+    regex = re.compile('|'.join(f'(?:{_scoped_flags(p)})' for p in patterns))
+    return lambda text: regex.sub('', text)
+
+
+
+def _strip_op(text:str) -> str:
+    return text.strip()
+
+
+
+def _scoped_flags(pattern:str) -> str:
+    """Turn the leading global flags of the pattern into a scoped group, e.g. '(?i)doo' gives
+    '(?i:doo)', so that the pattern can be joined with others into one regex."""
+    flags = ''
+    while (m := re.match(r'\(\?([aiLmsux]+)\)', pattern)):
+        flags += m.group(1)
+        pattern = pattern[m.end():]
+    return f'(?{flags}:{pattern})' if flags else pattern
+
+
+
+def _trie_regex(tokens:list) -> str:
+    """Build a regex from a trie of the literal tokens, e.g. ['DOO', 'D.O.O.', 'DD'] gives
+    'D(?:\\.O\\.O\\.|D|OO)'. Matching a position costs the length of the token instead of the 
+    number of tokens, and the greedy optional groups prefer the longest token.
+    """
+    trie = {}
+    for token in tokens:
+        node = trie
+        for ch in token:
+            node = node.setdefault(ch, {})
+        node[''] = {}
+    
+    def build(node:dict) -> str:
+        branches = [re.escape(ch) + build(child) for ch, child in sorted(node.items()) if ch != '']
+        if not branches:
+            return ''
+        body = branches[0] if len(branches) == 1 else '(?:' + '|'.join(branches) + ')'
+        return f'(?:{body})?' if '' in node else body
+    
+    return build(trie)
+
+
+
+def literal_token(pattern:str):
+    """Return the literal string matched by the pattern (e.g. '\\.COM' gives '.COM') or None
+    if the pattern is not a plain literal.
+    """
+    parsed = _parse_plain(pattern)
+    if parsed is None or len(parsed) == 0 or any(op is not sre_constants.LITERAL for op, _ in parsed):
+        return None
+    return ''.join(chr(av) for _, av in parsed)
+
+
+
+class MultiLiteralMatcher:
+    """Find many literal tokens (e.g. 'D.O.O.', '.COM', 'WWW' or hundreds of merchant specific
+    tokens) in a single scan of the text. The tokens are compiled into one trie shaped regex, so
+    the cost of the scan grows with the token length and not with the number of tokens.
+    
+    Matches are leftmost-longest and non-overlapping: the scan goes from left to right, at every
+    position the longest matching token wins and the scan continues after it. Non-literal
+    patterns (e.g. 'TN\\d+') are tried at a position only if no token matches there, in the 
+    order given. Note that this differs from removing the patterns one after another, where the
+    removal of one pattern can create a new match of another.
+
+    Args:
+        tokens (list, optional): Literal strings to match.
+        patterns (list, optional): Regex patterns to match in the same scan.
+    
+    Examples:
+        matcher = MultiLiteralMatcher.from_patterns(patterns_dict["abbreviations"])
+        matcher.add(tokens=["KONZUM", "TISAK"])
+        matcher.sub('', 'KONZUM D.O.O. ZAGREB')
+    """
+    def __init__(self, 
+                 tokens:list=None,
+                 patterns:list=None) -> None:
+        self.tokens = []
+        self.patterns = []
+        self.add(tokens, patterns)
+    
+    
+    @classmethod
+    def from_patterns(cls, patterns:list):
+        """Create the matcher from a list of regex patterns (e.g. patterns_dict["abbreviations"]).
+        Plain literal patterns are matched as tokens, the rest as regex patterns.
+
+        Args:
+            patterns (list): Regex patterns.
+        """
+        tokens = [literal_token(p) for p in patterns]
+        return cls(tokens=[t for t in tokens if t is not None],
+                   patterns=[p for p, t in zip(patterns, tokens) if t is None])
+    
+    
+    def add(self, 
+            tokens:list=None, 
+            patterns:list=None):
+        """Add tokens and patterns and recompile the matcher once.
+
+        Args:
+            tokens (list, optional): Literal strings to match.
+            patterns (list, optional): Regex patterns to match.
+        """
+        self.tokens.extend(t for t in (tokens or []) if t and t not in self.tokens)
+        self.patterns.extend(_scoped_flags(p) for p in (patterns or []))
+        
+        alternatives = ([_trie_regex(self.tokens)] if self.tokens else []) + self.patterns
+        # Never matching pattern for an empty matcher
+        self.regex = re.compile('|'.join(f'(?:{p})' for p in alternatives) or r'(?!)')
+        
+        return self
+    
+    
+    def finditer(self, text:str):
+        """Iterate over all the (non-overlapping) matches in the text."""
+        return self.regex.finditer(text)
+    
+    
+    def findall(self, text:str) -> list:
+        """Return all the matched strings in the text."""
+        return [m.group() for m in self.regex.finditer(text)]
+    
+    
+    def sub(self, repl:str, text:str) -> str:
+        """Replace all the matches in the text with 'repl'."""
+        return self.regex.sub(repl, text)
+    
+    
+    def __len__(self):
+        return len(self.tokens) + len(self.patterns)
+    
+    
+    def __repr__(self):
+        return f'MultiLiteralMatcher(tokens={len(self.tokens)}, patterns={len(self.patterns)})'
+
+
+
+class CleaningEngine:
+    """Compile a chain of data cleaning functions into a single reusable plan. All the
+    patterns are compiled once, consecutive single character deletions are fused into one
+    pass and every other pattern is only scanned for when its required literal (e.g. 'ATM',
+    'P-', 'sa HR') appears in the text. The output is identical to applying the functions
+    one after another with apply_functions().
+    
+    Functions which are not regex based (e.g. remove_repeated_words or any user defined
+    function) are kept in the plan as they are.
+    
+    With 'single_scan' the pattern lists of a function (e.g. the abbreviations) are matched in
+    one scan with a MultiLiteralMatcher instead of one pass per pattern. This scales to long
+    lists of merchant specific tokens, but overlapping matches are resolved leftmost-longest,
+    so the output can differ from the chain for texts where patterns overlap.
+
+    Args:
+        functions (list): Data cleaning functions (or their names) in the order to apply them.
+        extra_patterns (dict, optional): Additional patterns per patterns_dict key, e.g.
+            {"abbreviations": [" OBRT"]}. They are applied after the default ones.
+        single_scan (bool, optional): Match the pattern list of each function in a single scan.
+            Defaults to False.
+    
+    Examples:
+        engine = CleaningEngine([remove_ccard, remove_abrv_chr, remove_punctuation])
+        engine.register_patterns("abbreviations", [" OBRT"])
+        df['text_clean'] = df['text'].map(engine)
+        apply_functions([engine, str.upper], text)
+    """
+    def __init__(self, 
+                 functions:list, 
+                 extra_patterns:dict=None,
+                 single_scan:bool=False) -> None:
+        self.functions = list(functions)
+        self.extra_patterns = {k:list(v) for k,v in (extra_patterns or {}).items()}
+        self.single_scan = single_scan
+        self._compile()
+        
+    
+    def register_patterns(self, 
+                          key:str, 
+                          patterns:list):
+        """Add patterns to the patterns_dict group (e.g. "abbreviations"), applied after 
+        the default ones. The plan is recompiled once here and not on every call.
+
+        Args:
+            key (str): Key in patterns_dict.
+            patterns (list): Patterns to add.
+        """
+        if key not in patterns_dict:
+            raise KeyError(f'No such pattern group: {key}')
+        self.extra_patterns.setdefault(key, []).extend(_as_list(patterns))
+        self._compile()
+        
+        return self
+    
+    
+    def _compile(self):
+        """Translate the functions into a list of operations."""
+        # Each step is ('sub', pattern, repl), ('match', patterns), ('strip',) or ('call', func)
+        steps = []
+        for func in self.functions:
+            name = func if isinstance(func, str) else getattr(func, '__name__', None)
+            if name in cleaning_steps and (isinstance(func, str) or func is globals()[name]):
+                key, repl, strip = cleaning_steps[name]
+                patterns = _as_list(patterns_dict[key]) + self.extra_patterns.get(key, [])
+                if self.single_scan and repl == '' and len(patterns) > 1:
+                    steps.append(('match', patterns))
+                else:
+                    steps.extend(('sub', p, repl) for p in patterns)
+                if strip:
+                    steps.append(('strip',))
+            elif isinstance(func, str):
+                if func not in globals() or not callable(globals()[func]):
+                    raise ValueError(f'Unknown cleaning function: {func}')
+                steps.append(('call', globals()[func]))
+            else:
+                steps.append(('call', func))
+        
+        plan, descr, chars = [], [], []
+        def flush_chars():
+            if chars:
+                plan.append(_delete_chars_op(chars))
+                descr.append(('delete_chars', tuple(chars)))
+                chars.clear()
+        
+        for step in steps:
+            if step[0] == 'sub' and step[2] == '' and _single_char_pattern(step[1]):
+                chars.append(step[1])
+                continue
+            flush_chars()
+            if step[0] == 'sub':
+                plan.append(_sub_op(step[1], step[2]))
+                descr.append(('sub', step[1], step[2], required_literal(step[1])))
+            elif step[0] == 'match':
+                matcher = MultiLiteralMatcher.from_patterns(step[1])
+                plan.append(partial(matcher.sub, ''))
+                descr.append(('match', len(matcher.tokens), len(matcher.patterns)))
+            elif step[0] == 'strip':
+                plan.append(_strip_op)
+                descr.append(('strip',))
+            else:
+                plan.append(step[1])
+                descr.append(('call', getattr(step[1], '__name__', repr(step[1]))))
+        flush_chars()
+        
+        self._plan = plan
+        self.plan = descr
+    
+    
+    def __getstate__(self):
+        # The compiled plan holds closures, pickle the settings and compile it again
+        return {k: v for k, v in self.__dict__.items() if k not in ('_plan', 'plan')}
+    
+    
+    def __setstate__(self, state:dict):
+        self.__dict__.update(state)
+        self._compile()
+    
+    
+    def __call__(self, text:str) -> str:
+        # Missing values (NaN, None) are returned as they are
+        if not isinstance(text, str):
+            return text
+        for op in self._plan:
+            text = op(text)
+        return text
+    
+    
+    def __repr__(self):
+        names = [f if isinstance(f, str) else getattr(f, '__name__', repr(f)) for f in self.functions]
+        return f'CleaningEngine(functions={names}, passes={len(self._plan)})'
+
+
+
+def restore_dtype(cleaned:pd.Series, like:pd.Series) -> pd.Series:
+    """Cast the cleaned text column (object dtype) back to the dtype of the original column. 
+    A categorical column gets the cleaned texts as its categories, casting to the original 
+    categories would turn every changed text into a missing value.
+
+    Args:
+        cleaned (pd.Series): Cleaned text column of object dtype.
+        like (pd.Series): The original text column.
+    """
+    if like.dtype == object:
+        return cleaned
+    if isinstance(like.dtype, pd.CategoricalDtype):
+        return cleaned.astype('category')
+    return cleaned.astype(like.dtype)
+
+
+
+class CachedCleaner:
+    """Clean a text column by cleaning every distinct text only once. The column is factorized,
+    only the unique values are cleaned and the results are scattered back to all the rows.
+    Transaction descriptions are very repetitive (e.g. 'KONZUM P-0980 ZAGREB') so this saves
+    most of the work. With 'max_size' set, the cleaned texts are also kept in a bounded LRU
+    cache which lives across batches, e.g. when cleaning a file in chunks.
+
+    Args:
+        cleaner (callable | list): Function cleaning a single text, or a list of data cleaning
+            functions which is compiled into a CleaningEngine.
+        max_size (int, optional): Maximum number of texts kept in the cache across batches.
+            If None, nothing is kept between the batches. Defaults to None.
+        vectorized (bool, optional): The cleaner takes a whole column of the (missing) unique 
+            texts instead of a single text, e.g. lambda col: clean_column(functions, col). 
+            Defaults to False.
+    
+    Examples:
+        cleaner = CachedCleaner([remove_ccard, remove_abrv_chr, remove_punctuation], max_size=100_000)
+        for chunk in pd.read_csv(path, chunksize=1_000_000):
+            chunk['text_clean'] = cleaner(chunk['text'])
+        cleaner.stats
+    """
+    def __init__(self, 
+                 cleaner, 
+                 max_size:int=None,
+                 vectorized:bool=False) -> None:
+        self.cleaner = CleaningEngine(cleaner) if isinstance(cleaner, (list, tuple)) else cleaner
+        self.max_size = max_size
+        self.vectorized = vectorized
+        self.cache = OrderedDict()
+        self.reset_stats()
+    
+    
+    def reset_stats(self):
+        """Set all the counters to zero."""
+        self.n_rows = 0
+        self.n_unique = 0
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+    
+    
+    @property
+    def stats(self) -> dict:
+        """Cache statistics to size the cache: number of rows and unique texts seen, cache hits, 
+        misses and evictions, the hit rate over unique texts and the current cache size.
+        """
+        return {"rows": self.n_rows,
+                "unique": self.n_unique,
+                "hits": self.hits,
+                "misses": self.misses,
+                "evictions": self.evictions,
+                "hit_rate": self.hits / max(self.hits + self.misses, 1),
+                "dedupe_ratio": self.n_rows / max(self.n_unique, 1),
+                "size": len(self.cache)}
+    
+    
+    def _clean_unique(self, uniques:list) -> list:
+        """Clean the unique texts, looking them up in the cache first."""
+        if not self.max_size:
+            self.misses += len(uniques)
+            return self._run_cleaner(uniques)
+        
+        cleaned, missing = [None] * len(uniques), []
+        for i, text in enumerate(uniques):
+            if text in self.cache:
+                self.cache.move_to_end(text)
+                cleaned[i] = self.cache[text]
+            else:
+                missing.append(i)
+        self.hits += len(uniques) - len(missing)
+        self.misses += len(missing)
+        
+        for i, value in zip(missing, self._run_cleaner([uniques[i] for i in missing])):
+            cleaned[i] = value
+            self.cache[uniques[i]] = value
+        
+        # Evict the least recently used texts
+        while len(self.cache) > self.max_size:
+            self.cache.popitem(last=False)
+            self.evictions += 1
+        
+        return cleaned
+    
+    
+    def _run_cleaner(self, texts:list) -> list:
+        if self.vectorized:
+            return list(self.cleaner(pd.Series(texts, dtype=object)))
+        return [self.cleaner(t) for t in texts]
+    
+    
+    def __call__(self, data:pd.Series) -> pd.Series:
+        """Clean the text column.
+
+        Args:
+            data (pd.Series): Text column, missing values are returned as they are.
+
+        Returns:
+            pd.Series: Cleaned text column with the same index, name and dtype. A categorical
+                column has the cleaned texts as its categories.
+        """
+        if isinstance(data.dtype, pd.CategoricalDtype):
+            return self._clean_categorical(data)
+        
+        codes, uniques = pd.factorize(data, use_na_sentinel=True)
+        uniques = list(np.asarray(uniques, dtype=object))
+        self.n_rows += len(data)
+        self.n_unique += len(uniques)
+        
+        cleaned = np.empty(len(uniques) + 1, dtype=object)
+        cleaned[:-1] = self._clean_unique(uniques)
+        # code -1 (missing value) takes the last element
+        cleaned[-1] = np.nan
+        out = pd.Series(cleaned[codes], index=data.index, name=data.name)
+        
+        return restore_dtype(out, data)
+    
+    
+    def _clean_categorical(self, data:pd.Series) -> pd.Series:
+        """Clean only the categories, the codes are mapped to the cleaned categories (different 
+        categories may be cleaned to the same text).
+        """
+        categories = list(np.asarray(data.cat.categories, dtype=object))
+        self.n_rows += len(data)
+        self.n_unique += len(categories)
+        
+        new_codes, new_categories = pd.factorize(pd.Series(self._clean_unique(categories), dtype=object))
+        # code -1 (missing value) takes the last element
+        codes = np.append(new_codes, -1)[data.cat.codes.to_numpy()]
+        
+        return pd.Series(pd.Categorical.from_codes(codes, categories=new_categories), 
+                         index=data.index, name=data.name)
+    
+    
+    def __repr__(self):
+        return f'CachedCleaner(cleaner={self.cleaner!r}, max_size={self.max_size})'
@@ -0,0 +1,289 @@
+import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
+from finmetrika_ml.data.data_cleaning import patterns_dict, cleaning_steps, _as_list
+
+
+
+# Characters matched by Python's '\s' and removed by str.strip(), written as RE2 class content
+WHITESPACE_RE2 = (r"\t\n\x{0b}\x{0c}\r\x{1c}-\x{1f} \x{85}\x{a0}\x{1680}\x{2000}-\x{200a}"
+                  r"\x{2028}\x{2029}\x{202f}\x{205f}\x{3000}")
+WHITESPACE_CHARS = ("\t\n\x0b\x0c\r\x1c\x1d\x1e\x1f \x85\xa0\u1680\u2000\u2001\u2002\u2003\u2004"
+                    "\u2005\u2006\u2007\u2008\u2009\u200a\u2028\u2029\u202f\u205f\u3000")
+
+
+
+def to_re2(pattern:str) -> str:
+    """Translate a Python regex pattern to the RE2 syntax used by the Arrow string kernels.
+    Python matches Unicode digits and whitespace with '\\d' and '\\s' while RE2 only matches
+    ASCII ones, so both are replaced by explicit Unicode classes.
+
+    Args:
+        pattern (str): Python regex pattern.
+
+    Returns:
+        str: Equivalent RE2 pattern.
+    """
+    out, in_class, i = [], False, 0
+    while i < len(pattern):
+        c = pattern[i]
+        if c == '\\' and i + 1 < len(pattern):
+            nxt = pattern[i+1]
+            if nxt == 'd':
+                out.append(r'\p{Nd}')
+            elif nxt == 's':
+                out.append(WHITESPACE_RE2 if in_class else f'[{WHITESPACE_RE2}]')
+            else:
+                out.append(pattern[i:i+2])
+            i += 2
+            continue
+        if c == '[' and not in_class:
+            in_class = True
+        elif c == ']' and in_class and out[-1] not in ('[', '[^'):
+            in_class = False
+        out.append(c)
+        i += 1
+
+    return ''.join(out)
+
+
+
+def to_arrow(data) -> pa.ChunkedArray:
+    """Convert a pandas Series (object, string[pyarrow] or Arrow dtype) or a pyarrow array
+    to a pyarrow string array. Missing values become nulls.
+
+    Args:
+        data (pd.Series | pa.Array | pa.ChunkedArray): Text column.
+    """
+    if isinstance(data, pd.Series):
+        if isinstance(data.dtype, (pd.StringDtype, pd.ArrowDtype)) and data.dtype.storage == 'pyarrow':
+            data = pa.array(data)
+        else:
+            data = pa.array(data.to_numpy(dtype=object), type=pa.string(), from_pandas=True)
+    if isinstance(data, pa.Array):
+        data = pa.chunked_array([data])
+    if not (pa.types.is_string(data.type) or pa.types.is_large_string(data.type)):
+        data = data.cast(pa.string())
+
+    return data
+
+
+
+def from_arrow(result:pa.ChunkedArray, like):
+    """Convert the result of the Arrow string kernels back to the type of the input column.
+
+    Args:
+        result (pa.ChunkedArray): Cleaned text.
+        like (pd.Series | pa.Array | pa.ChunkedArray): Original input column.
+    """
+    if isinstance(like, pa.ChunkedArray):
+        return result
+    if isinstance(like, pa.Array):
+        return result.combine_chunks()
+    if isinstance(like.dtype, (pd.StringDtype, pd.ArrowDtype)) and like.dtype.storage == 'pyarrow':
+        return pd.Series(pd.array(result, dtype=like.dtype), index=like.index, name=like.name)
+
+    # Keep the original missing value objects (None, NaN) in object columns
+    out = pd.Series(result.to_numpy(zero_copy_only=False), index=like.index, name=like.name, dtype=object)
+    return out.where(like.notna(), like)
+
+
+
+def _strip(arr:pa.ChunkedArray) -> pa.ChunkedArray:
+    return pc.utf8_trim(arr, characters=WHITESPACE_CHARS)
+
+
+
+def _replace(arr:pa.ChunkedArray, patterns:list, repl:str='') -> pa.ChunkedArray:
+    for p in patterns:
+        arr = pc.replace_substring_regex(arr, to_re2(p), repl)
+    return arr
+
+
+
+def _remove_repeated_words(arr:pa.ChunkedArray) -> pa.ChunkedArray:
+    # Split on any whitespace like str.split()
+    arr = pc.replace_substring_regex(_strip(arr), f'[{WHITESPACE_RE2}]+', ' ').combine_chunks()
+    words = pc.split_pattern(arr, ' ')
+    flat = pc.list_flatten(words)
+    parents = pc.list_parent_indices(words).to_numpy()
+
+    # Lowercase in Arrow for ASCII words and with str.lower() for the rest, as the
+    # full Unicode case mapping of Python differs from the Arrow one for some characters
+    lower = pc.utf8_lower(flat).to_numpy(zero_copy_only=False)
+    non_ascii = ~pc.string_is_ascii(flat).to_numpy(zero_copy_only=False)
+    if non_ascii.any():
+        lower[non_ascii] = [w.lower() for w in flat.filter(pa.array(non_ascii)).to_pylist()]
+
+    # Keep the first occurrence of every lowercase word within each row
+    keep = ~pd.DataFrame({'row': parents, 'word': lower}).duplicated().to_numpy()
+    counts = np.bincount(parents[keep], minlength=len(words))
+    offsets = np.concatenate([[0], np.cumsum(counts)]).astype(np.int32)
+    deduped = pa.ListArray.from_arrays(pa.array(offsets), flat.filter(pa.array(keep)),
+                                       mask=pc.is_null(words))
+
+    return pa.chunked_array([pc.binary_join(deduped, pa.scalar(' ', type=flat.type))])
+
+
+
+def _kernel(name:str):
+    """Arrow kernel of the data_cleaning function 'name'."""
+    if name == 'remove_repeated_words':
+        return _remove_repeated_words
+    key, repl, strip = cleaning_steps[name]
+
+    def kernel(arr, extra_patterns:list=None):
+        arr = _replace(arr, _as_list(patterns_dict[key]) + list(extra_patterns or []), repl)
+        return _strip(arr) if strip else arr
+
+    return kernel
+
+
+
+def remove_ccard(data):
+    """Remove the masked credit card number from every row of a text column.
+
+    Args:
+        data (pd.Series | pa.Array | pa.ChunkedArray): Text column.
+
+    Returns:
+        Text column of the same type without the masked credit card.
+    """
+    return from_arrow(_kernel('remove_ccard')(to_arrow(data)), data)
+
+
+
+def remove_repeated_words(data):
+    """Remove all repeated word instances (case-insensitive) from every row of a text column.
+
+    Args:
+        data (pd.Series | pa.Array | pa.ChunkedArray): Text column.
+
+    Returns:
+        Text column of the same type with removed repeated words.
+    """
+    return from_arrow(_remove_repeated_words(to_arrow(data)), data)
+
+
+
+def remove_abrv_chr(data,
+                    abrv_patterns:list=None):
+    """Remove abbreviations from every row of a text column.
+
+    Args:
+        data (pd.Series | pa.Array | pa.ChunkedArray): Text column.
+        abrv_patterns (list): Additional list of abberviations to be removed from text.
+
+    Returns:
+        Text column of the same type with removed abbreviations.
+    """
+    return from_arrow(_kernel('remove_abrv_chr')(to_arrow(data), abrv_patterns), data)
+
+
+
+def remove_non_ascii_chr(data):
+    """Remove non-ASCII characters from every row of a text column.
+
+    Args:
+        data (pd.Series | pa.Array | pa.ChunkedArray): Text column.
+
+    Returns:
+        Text column of the same type with removed non-ASCII characters.
+    """
+    return from_arrow(_kernel('remove_non_ascii_chr')(to_arrow(data)), data)
+
+
+
+def remove_cro_abrv(data):
+    """Remove Croatian specific abbreviations (PBZT, TN1234, ...) from every row of a text column.
+
+    Args:
+        data (pd.Series | pa.Array | pa.ChunkedArray): Text column.
+
+    Returns:
+        Text column of the same type with removed Croatian abbreviations.
+    """
+    return from_arrow(_kernel('remove_cro_abrv')(to_arrow(data)), data)
+
+
+
+def remove_branch_info(data):
+    """Remove branch info number like P-1234 from every row of a text column.
+
+    Args:
+        data (pd.Series | pa.Array | pa.ChunkedArray): Text column.
+
+    Returns:
+        Text column of the same type with removed branch info number.
+    """
+    return from_arrow(_kernel('remove_branch_info')(to_arrow(data)), data)
+
+
+
+def remove_atm_no(data):
+    """Remove ATM numbers from every row of a text column.
+
+    Args:
+        data (pd.Series | pa.Array | pa.ChunkedArray): Text column.
+
+    Returns:
+        Text column of the same type with removed ATM numbers.
+    """
+    return from_arrow(_kernel('remove_atm_no')(to_arrow(data)), data)
+
+
+
+def remove_iban(data):
+    """Remove "sa HR1234..." from every row of a text column.
+
+    Args:
+        data (pd.Series | pa.Array | pa.ChunkedArray): Text column.
+
+    Returns:
+        Text column of the same type with removed IBAN numbers.
+    """
+    return from_arrow(_kernel('remove_iban')(to_arrow(data)), data)
+
+
+
+def remove_punctuation(data):
+    """Remove punctuation from every row of a text column.
+
+    Args:
+        data (pd.Series | pa.Array | pa.ChunkedArray): Text column.
+
+    Returns:
+        Text column of the same type without specified punctuations.
+    """
+    return from_arrow(_kernel('remove_punctuation')(to_arrow(data)), data)
+
+
+
+def clean_column(functions:list, data):
+    """Apply a series of data cleaning functions to a text column. The column is converted to
+    Arrow only once and all the functions run as vectorized Arrow string kernels, which gives
+    the same result as apply_functions(functions, text) on every row.
+
+    Args:
+        functions (list): Data cleaning functions (from data_cleaning or this module) or their names.
+        data (pd.Series | pa.Array | pa.ChunkedArray): Text column.
+
+    Returns:
+        Cleaned text column of the same type as the input.
+
+    Examples:
+        df['text_clean'] = clean_column([remove_ccard, remove_abrv_chr, remove_punctuation], df['text'])
+    """
+    kernels = []
+    for func in functions:
+        name = func if isinstance(func, str) else getattr(func, '__name__', None)
+        if name not in cleaning_steps and name != 'remove_repeated_words':
+            raise ValueError(f'No vectorized version of the function: {name}')
+        kernels.append(_kernel(name))
+
+    arr = to_arrow(data)
+    for kernel in kernels:
+        arr = kernel(arr)
+
+    return from_arrow(arr, data)
@@ -0,0 +1,128 @@
+import os
+import multiprocessing
+from pathlib import Path
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+import pandas as pd
+import numpy as np
+from finmetrika_ml.data.data_cleaning import CachedCleaner, restore_dtype
+
+
+
+# Cleaner of the worker process, built once by _init_worker()
+_worker_cleaner = None
+
+
+def _init_worker(cleaner, cache_size:int):
+    global _worker_cleaner
+    _worker_cleaner = CachedCleaner(cleaner, max_size=cache_size)
+
+
+def _clean_chunk(texts:np.ndarray) -> np.ndarray:
+    return _worker_cleaner(pd.Series(texts, dtype=object)).to_numpy(dtype=object)
+
+
+
+def read_text_chunks(path:Path,
+                     text_column:str,
+                     chunk_size:int=100_000):
+    """Read only the text column of a CSV or Parquet file in chunks of rows.
+
+    Args:
+        path (Path): Location of the .csv or .parquet file.
+        text_column (str): Name of the column containing the text.
+        chunk_size (int, optional): Number of rows per chunk. Defaults to 100_000.
+
+    Yields:
+        pd.Series: Text column of the next chunk of rows.
+    """
+    path = Path(path)
+    if path.suffix == '.parquet':
+        import pyarrow.parquet as pq
+
+        for batch in pq.ParquetFile(path).iter_batches(batch_size=chunk_size, columns=[text_column]):
+            yield batch.column(text_column).to_pandas()
+    elif path.suffix == '.csv':
+        for chunk in pd.read_csv(path, usecols=[text_column], chunksize=chunk_size, dtype={text_column: object}):
+            yield chunk[text_column]
+    else:
+        raise ValueError(f'Unsupported file type: {path.suffix}. Use .csv or .parquet.')
+
+
+
+def _ordered_map(executor, func, chunks, max_in_flight:int):
+    """Like executor.map() but submits at most 'max_in_flight' chunks ahead, so the chunks
+    of a large file are not all read into memory at once. Results are in the input order.
+    """
+    futures = deque()
+    for chunk in chunks:
+        futures.append(executor.submit(func, chunk))
+        if len(futures) >= max_in_flight:
+            yield futures.popleft().result()
+    while futures:
+        yield futures.popleft().result()
+
+
+
+def parallel_clean(data,
+                   cleaner,
+                   text_column:str=None,
+                   n_workers:int=None,
+                   chunk_size:int=100_000,
+                   cache_size:int=100_000,
+                   mp_context:str=None) -> pd.Series:
+    """Clean a text column on multiple cores. The column is split into chunks of rows which are
+    cleaned in a process pool and put back together in the original order, so the output is
+    the same as cleaning the column serially. Only the text values of one chunk are sent to a
+    worker, never the whole frame. Every worker cleans each distinct text once (see CachedCleaner).
+
+    Args:
+        data (pd.Series | pd.DataFrame | Path): Text column, dataframe or .csv/.parquet file.
+        cleaner (callable | list): Function cleaning a single text, a list of data cleaning
+            functions or a CleaningEngine. It must be picklable, i.e. defined at the module level
+            (not a lambda).
+        text_column (str, optional): Text column name for a dataframe or file input.
+        n_workers (int, optional): Number of worker processes. Defaults to the number of CPUs.
+        chunk_size (int, optional): Number of rows per chunk. Defaults to 100_000.
+        cache_size (int, optional): Size of the LRU cache of cleaned texts in each worker. Defaults to 100_000.
+        mp_context (str, optional): Start method of the worker processes ('fork', 'spawn' or
+            'forkserver'). Defaults to None, the platform default ('spawn' on MacOS).
+
+    Returns:
+        pd.Series: Cleaned text column. For a file input the index is the row number.
+
+    Examples:
+        df['text_clean'] = parallel_clean(df, [remove_ccard, remove_abrv_chr, remove_punctuation],
+                                          text_column='text', n_workers=8)
+    """
+    n_workers = n_workers or os.cpu_count()
+
+    if isinstance(data, (str, Path)):
+        if text_column is None:
+            raise ValueError('text_column is required for a file input.')
+        like = None
+        chunks = (c.to_numpy(dtype=object) for c in read_text_chunks(data, text_column, chunk_size))
+    else:
+        if isinstance(data, pd.DataFrame) and text_column not in data.columns:
+            raise ValueError(f'Text column {text_column!r} not found in the dataframe.')
+        like = data[text_column] if isinstance(data, pd.DataFrame) else data
+        # Slices of the text values only
+        chunks = (like.iloc[i:i+chunk_size].to_numpy(dtype=object) for i in range(0, len(like), chunk_size))
+
+    if n_workers == 1:
+        _init_worker(cleaner, cache_size)
+        results = [_clean_chunk(c) for c in chunks]
+    else:
+        context = multiprocessing.get_context(mp_context) if mp_context else None
+        with ProcessPoolExecutor(max_workers=n_workers,
+                                 mp_context=context,
+                                 initializer=_init_worker,
+                                 initargs=(cleaner, cache_size)) as executor:
+            results = list(_ordered_map(executor, _clean_chunk, chunks, max_in_flight=2 * n_workers))
+
+    cleaned = np.concatenate(results) if results else np.empty(0, dtype=object)
+    if like is None:
+        return pd.Series(cleaned, name=text_column)
+
+    out = pd.Series(cleaned, index=like.index, name=like.name)
+    return restore_dtype(out, like)
@@ -0,0 +1,154 @@
+import time
+from pathlib import Path
+import pyarrow as pa
+import pyarrow.csv as pv
+import pyarrow.parquet as pq
+from finmetrika_ml.data.data_cleaning import CachedCleaner, cleaning_pipelines, cleaning_steps
+from finmetrika_ml.data.data_cleaning_columnar import clean_column
+
+
+
+def iter_record_batches(path:Path,
+                        text_column:str,
+                        batch_size:int=100_000):
+    """Read a CSV or Parquet file as a stream of record batches. Only one batch is held in
+    memory at a time.
+
+    Args:
+        path (Path): Location of the .csv or .parquet file.
+        text_column (str): Name of the column containing the text, always read as string.
+        batch_size (int, optional): Number of rows per batch (approximate for CSV files,
+            which are read in blocks of bytes). Defaults to 100_000.
+
+    Yields:
+        pa.RecordBatch: Next batch of rows.
+    """
+    path = Path(path)
+    if path.suffix == '.parquet':
+        yield from pq.ParquetFile(path).iter_batches(batch_size=batch_size)
+    elif path.suffix == '.csv':
+        for batch in _open_csv(path, text_column, batch_size):
+            for start in range(0, batch.num_rows, batch_size):
+                yield batch.slice(start, batch_size)
+    else:
+        raise ValueError(f'Unsupported file type: {path.suffix}. Use .csv or .parquet.')
+
+
+
+def _open_csv(path:Path, text_column:str, batch_size:int=100_000) -> pv.CSVStreamingReader:
+    # Assume ~128 bytes per transaction row to turn rows into a block size
+    return pv.open_csv(path,
+                       read_options=pv.ReadOptions(block_size=max(batch_size * 128, 1 << 20)),
+                       convert_options=pv.ConvertOptions(column_types={text_column: pa.string()},
+                                                         strings_can_be_null=True))
+
+
+
+def read_schema(path:Path, text_column:str) -> pa.Schema:
+    """Schema of the record batches of a CSV or Parquet file, see iter_record_batches().
+
+    Args:
+        path (Path): Location of the .csv or .parquet file.
+        text_column (str): Name of the column containing the text, always read as string.
+    """
+    path = Path(path)
+    if path.suffix == '.parquet':
+        return pq.read_schema(path)
+    elif path.suffix == '.csv':
+        return _open_csv(path, text_column).schema
+    raise ValueError(f'Unsupported file type: {path.suffix}. Use .csv or .parquet.')
+
+
+
+def _set_column(table:pa.Table, name:str, values:pa.Array) -> pa.Table:
+    """Replace the column or append it if the table has no such column."""
+    if name in table.column_names:
+        return table.set_column(table.column_names.index(name), name, values)
+    return table.append_column(name, values)
+
+
+
+def clean_file(input_path:Path,
+               output_path:Path,
+               text_column:str,
+               pipeline='default',
+               output_column:str=None,
+               batch_size:int=100_000,
+               cache_size:int=100_000,
+               verbose:bool=True) -> dict:
+    """Clean the text column of a CSV or Parquet file batch by batch and write the result to
+    a Parquet file incrementally. Peak memory is bounded by the batch size and the cache size,
+    no matter how large the input file is. The unique texts of every batch are cleaned with the
+    vectorized functions and kept in an LRU cache across the batches (see CachedCleaner).
+
+    Args:
+        input_path (Path): Location of the input .csv or .parquet file.
+        output_path (Path): Location of the output .parquet file.
+        text_column (str): Name of the column containing the text.
+        pipeline (str | list, optional): Name of the pipeline in data_cleaning.cleaning_pipelines,
+            name of a single data cleaning function or a list of data cleaning functions (or
+            their names). Defaults to 'default'.
+        output_column (str, optional): Name of the cleaned text column. Defaults to None, which
+            replaces the text column.
+        batch_size (int, optional): Number of rows per batch. Defaults to 100_000.
+        cache_size (int, optional): Number of cleaned texts kept across batches. Defaults to 100_000.
+        verbose (bool, optional): Print the throughput at the end. Defaults to True.
+
+    Returns:
+        dict: Number of rows, run time in seconds, rows per second and cache statistics.
+
+    Examples:
+        clean_file('trx_2024.csv', 'trx_2024_clean.parquet', text_column='text', pipeline='default')
+    """
+    if isinstance(pipeline, str):
+        if pipeline in cleaning_pipelines:
+            pipeline = cleaning_pipelines[pipeline]
+        elif pipeline in cleaning_steps or pipeline == 'remove_repeated_words':
+            # A single data cleaning function
+            pipeline = [pipeline]
+        else:
+            raise ValueError(f'Unknown pipeline or function: {pipeline}. Choose from {list(cleaning_pipelines)} '
+                             f'or the data cleaning functions.')
+
+    functions = list(pipeline)
+    cleaner = CachedCleaner(lambda col: clean_column(functions, col),
+                            max_size=cache_size,
+                            vectorized=True)
+    output_column = output_column or text_column
+
+    start_time = time.perf_counter()
+    n_rows, writer = 0, None
+    try:
+        for batch in iter_record_batches(input_path, text_column, batch_size):
+            # A dictionary encoded column is a categorical column, only its categories are cleaned
+            cleaned = cleaner(batch.column(text_column).to_pandas())
+            table = pa.Table.from_batches([batch])
+            cleaned = pa.array(cleaned.to_numpy(dtype=object), type=pa.string(), from_pandas=True)
+            table = _set_column(table, output_column, cleaned)
+
+            if writer is None:
+                writer = pq.ParquetWriter(output_path, table.schema)
+            writer.write_table(table.cast(writer.schema))
+            n_rows += table.num_rows
+        
+        if writer is None:
+            # Empty input, write a file with the schema and no rows
+            table = _set_column(read_schema(input_path, text_column).empty_table(),
+                                output_column, pa.array([], type=pa.string()))
+            writer = pq.ParquetWriter(output_path, table.schema)
+            writer.write_table(table)
+    finally:
+        if writer is not None:
+            writer.close()
+
+    run_time = time.perf_counter() - start_time
+    stats = {"rows": n_rows,
+             "seconds": run_time,
+             "rows_per_sec": n_rows / run_time if run_time > 0 else float('inf'),
+             "cache": cleaner.stats}
+
+    if verbose:
+        print(f'Cleaned {n_rows:,} rows in {run_time:.1f}s ({stats["rows_per_sec"]:,.0f} rows/s)',
+              f'cache hit rate: {cleaner.stats["hit_rate"]:.1%}')
+
+    return stats
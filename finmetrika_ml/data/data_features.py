@@ -1,4 +1,6 @@
 import re
+import json
+from pathlib import Path
 import pandas as pd
 import numpy as np
 
@@ -9,7 +11,16 @@ patterns_dict = {
     
     # Online shopping
     #TODO Check if there is already
-    "online_purchase" : [r'\.COM', r'\com.']
+    "online_purchase" : [r'\.COM', r'\com.'],
+    
+    # IBAN in 'Prijenos sa HR1234 TEA', only the account 'HR1234' is captured
+    "iban_no"         : r'sa (HR\d+)\s',
+    
+    # ATM id in 'ATM A3122001 ', only the id 'A3122001' is captured
+    "atm_id"          : r'ATM\s([A-Za-z]?\d+)\s',
+    
+    # Branch of the store: P-0980
+    "branch_no"       : r'(P-\d{4})',
     
     #TODO Detect location of the store. Test with LLM to extract address.
     
@@ -20,51 +31,239 @@ patterns_dict = {
 
 
 
+datetime_features = ['DT_DATE_STR', 'DT_MONTH', 'DT_MONTH_TXT', 'DT_YEAR', 'DT_WEEK_DAY', 
+                     'DT_DAY_OF_YEAR', 'DT_WEEK_OF_YEAR']
+
+
+
+def _compact_int(values:pd.Series, dtype:str) -> pd.Series:
+    """Cast to a small integer type, nullable (e.g. 'Int8') if there are missing values."""
+    return values.astype(dtype.capitalize() if values.isna().any() else dtype)
+
+
+
 def create_datetime_features(df:pd.DataFrame,
-                              datetime_column:str):
+                             datetime_column:str,
+                             columns:list=None,
+                             inplace:bool=True):
     """Create features from datetime object. Current supported features are:
-    - month,
-    - year,
-    - week day,
-    - week in a year
+    - date in text (DT_DATE_STR), e.g. 'January 05 2024',
+    - month (DT_MONTH) and month in text (DT_MONTH_TXT),
+    - year (DT_YEAR),
+    - week day (DT_WEEK_DAY), Monday=1, Sunday=7
+    - day of the year (DT_DAY_OF_YEAR),
+    - week in a year (DT_WEEK_OF_YEAR).
+    
+    The features are computed with the vectorized .dt accessors. Text features are categorical
+    (the text is only formatted for each distinct date) and numeric features use the smallest
+    integer type, nullable if the datetime column has missing values.
 
     Args:
         df (pd.DataFrame): Dataframe containing the transaction dates.
         datetime_column (str): Column in the dataframe containing date.
+        columns (list, optional): Features to create. Defaults to None, i.e. all the features.
+        inplace (bool, optional): Add the features to df, without copying it. If False, return 
+            only the features in a new dataframe. Defaults to True.
+    
+    Returns:
+        pd.DataFrame: df with the added features or a dataframe with the features.
     """
+    columns = datetime_features if columns is None else columns
+    unknown = set(columns) - set(datetime_features)
+    if unknown:
+        raise ValueError(f'Unknown datetime features: {sorted(unknown)}. Choose from {datetime_features}.')
+    
+    dt = df[datetime_column].dt
+    out = df if inplace else pd.DataFrame(index=df.index)
     
     # date in format Name of the Month Day Year
-    df['DT_DATE_STR'] = df[datetime_column].apply(lambda x: x.strftime('%B %d %Y'))
+    if 'DT_DATE_STR' in columns:
+        codes, days = pd.factorize(dt.normalize())
+        out['DT_DATE_STR'] = pd.Categorical.from_codes(codes, categories=days.strftime('%B %d %Y'))
     
     # Month of the year >>> 1, 2, ...
-    df['DT_MONTH'] = df[datetime_column].dt.month
-    # df['DT_MONTH'] = df[datetime_column].apply(lambda x: x.strftime('%m')).astype(int)
+    if 'DT_MONTH' in columns or 'DT_MONTH_TXT' in columns:
+        month = dt.month
+    if 'DT_MONTH' in columns:
+        out['DT_MONTH'] = _compact_int(month, 'int8')
     
     # Month of the year in text >>> January, February, etc
-    df['DT_MONTH_TXT'] = df[datetime_column].apply(lambda x: x.strftime('%B'))
+    if 'DT_MONTH_TXT' in columns:
+        month_names = pd.date_range('2000-01-01', periods=12, freq='MS').strftime('%B')
+        codes = month.fillna(0).to_numpy(dtype='int8') - 1
+        out['DT_MONTH_TXT'] = pd.Categorical.from_codes(codes, categories=month_names)
     
-    df['DT_YEAR'] = df[datetime_column].dt.year
-    df['DT_WEEK_DAY'] = df[datetime_column].dt.weekday + 1 # Monday=1, Sunday=7
-    df['DT_DAY_OF_YEAR'] = df[datetime_column].dt.day_of_year
-    df['DT_WEEK_OF_YEAR'] = df[datetime_column].dt.isocalendar().week
+    if 'DT_YEAR' in columns:
+        out['DT_YEAR'] = _compact_int(dt.year, 'int16')
+    if 'DT_WEEK_DAY' in columns:
+        out['DT_WEEK_DAY'] = _compact_int(dt.weekday + 1, 'int8') # Monday=1, Sunday=7
+    if 'DT_DAY_OF_YEAR' in columns:
+        out['DT_DAY_OF_YEAR'] = _compact_int(dt.day_of_year, 'int16')
+    if 'DT_WEEK_OF_YEAR' in columns:
+        out['DT_WEEK_OF_YEAR'] = _compact_int(dt.isocalendar().week, 'int8')
     
-    return df
+    return out
+
+
+
+class AmountBinner:
+    """Bin transaction amounts with edges learned on the training data. The edges are either 
+    quantiles of the training data (n_bins bins with about the same number of transactions) 
+    or custom ones. New data is binned with a vectorized np.searchsorted and returned as
+    categorical with the smallest integer codes. Bins include the left edge, i.e. [low, high).
+    
+    The quantiles are exact ('inverted CDF' method) and computed from the counts of the 
+    distinct amounts, so the training data can be fitted one chunk at a time with partial_fit.
+    Fitted edges can be saved and loaded so scoring jobs don't need the training data.
+
+    Args:
+        n_bins (int, optional): Number of quantile bins. Defaults to 4.
+        edges (list, optional): Custom bin edges, e.g. [0, 50, 500, 1000, float('inf')]. Amounts
+            outside of the edges are missing. If given, nothing is learned and fitting raises a
+            RuntimeError (also for a binner loaded from a file). Defaults to None.
+        labels (list, optional): Names of the bins. Defaults to None, i.e. the intervals.
+        decimals (int, optional): Round the amounts before counting them. Defaults to 2.
+    
+    Examples:
+        binner = AmountBinner(n_bins=10)
+        for chunk in pd.read_csv(path_train, chunksize=1_000_000):
+            binner.partial_fit(chunk['TRX_AMOUNT'])
+        binner.save('amount_bins.json')
+        df['TRX_AMOUNT_BIN'] = AmountBinner.load('amount_bins.json').transform(df['TRX_AMOUNT'])
+    """
+    def __init__(self,
+                 n_bins:int=4,
+                 edges:list=None,
+                 labels:list=None,
+                 decimals:int=2) -> None:
+        self.n_bins = n_bins
+        self.edges = None if edges is None else [float(e) for e in edges]
+        self.labels = labels
+        self.decimals = decimals
+        self.counts = None
+        self._fixed_edges = self.edges is not None
+        if self.edges is not None and labels is not None and len(labels) != len(self.edges) - 1:
+            raise ValueError(f'Expected {len(self.edges) - 1} labels, got {len(labels)}.')
+        
+    
+    def partial_fit(self, amounts):
+        """Count the distinct amounts of a chunk of the training data and update the edges.
+
+        Args:
+            amounts (pd.Series | np.ndarray): Transaction amounts.
+        """
+        if self._fixed_edges:
+            raise RuntimeError('AmountBinner has custom edges, there is nothing to fit. '
+                               'Create a new AmountBinner(n_bins=...) to learn the edges.')
+        counts = pd.Series(np.asarray(amounts, dtype=np.float64)).round(self.decimals).value_counts()
+        self.counts = counts if self.counts is None else self.counts.add(counts, fill_value=0)
+        self.edges = self._quantile_edges()
+        
+        return self
+    
+    
+    def fit(self, amounts):
+        """Learn the quantile edges on the training data.
+
+        Args:
+            amounts (pd.Series | np.ndarray): Transaction amounts.
+        """
+        self.counts = None
+        return self.partial_fit(amounts)
+    
+    
+    def _quantile_edges(self) -> list:
+        counts = self.counts.sort_index()
+        cum_counts = np.cumsum(counts.to_numpy())
+        q = np.arange(1, self.n_bins) / self.n_bins * cum_counts[-1]
+        # Smallest amount with at least q of the counts below or at it
+        inner = counts.index.to_numpy()[np.searchsorted(cum_counts, q, side='left')]
+        
+        return [-np.inf] + np.unique(inner).tolist() + [np.inf]
+    
+    
+    @property
+    def categories(self) -> list:
+        if self.labels is not None:
+            return list(self.labels)
+        return [f'[{lo}, {hi})' for lo, hi in zip(self.edges[:-1], self.edges[1:])]
+    
+    
+    def transform(self, amounts) -> pd.Series:
+        """Bin the amounts using the fitted edges.
+
+        Args:
+            amounts (pd.Series | np.ndarray): Transaction amounts.
+
+        Returns:
+            pd.Series: Categorical bins, missing for missing amounts or outside of the edges.
+        """
+        if self.edges is None:
+            raise RuntimeError('AmountBinner is not fitted. Call fit() or set the edges.')
+        if self.labels is not None and len(self.labels) != len(self.edges) - 1:
+            raise ValueError(f'Expected {len(self.edges) - 1} labels, got {len(self.labels)}.')
+        
+        values = np.asarray(amounts, dtype=np.float64)
+        edges = np.asarray(self.edges)
+        codes = np.searchsorted(edges, values, side='right') - 1
+        codes[np.isnan(values) | (values < edges[0]) | (values >= edges[-1])] = -1
+        
+        n_categories = len(edges) - 1
+        code_dtype = np.int8 if n_categories < 128 else np.int16 if n_categories < 32768 else np.int32
+        bins = pd.Categorical.from_codes(codes.astype(code_dtype), categories=self.categories, ordered=True)
+        
+        return pd.Series(bins, 
+                         index=amounts.index if isinstance(amounts, pd.Series) else None,
+                         name=amounts.name if isinstance(amounts, pd.Series) else None)
+    
+    
+    def fit_transform(self, amounts) -> pd.Series:
+        return self.fit(amounts).transform(amounts)
+    
+    
+    def save(self, path:Path):
+        """Save the fitted edges and labels to a json file."""
+        with open(path, 'w') as f:
+            json.dump({"edges": [str(e) if np.isinf(e) else e for e in self.edges],
+                       "labels": self.labels,
+                       "n_bins": self.n_bins,
+                       "decimals": self.decimals}, f, indent=2)
+    
+    
+    @classmethod
+    def load(cls, path:Path):
+        """Load the fitted edges and labels from a json file."""
+        with open(path) as f:
+            params = json.load(f)
+        return cls(**params)
+    
+    
+    def __repr__(self):
+        return f'AmountBinner(n_bins={self.n_bins}, edges={self.edges})'
 
 
 
 def quantize_amount(df:pd.DataFrame,
-                    txt_amount_column:str):
-    """_summary_
+                    txt_amount_column:str,
+                    binner:AmountBinner=None):
+    """Bin the transaction amounts into the column '<txt_amount_column>_BIN'. By default the
+    bins are: low [0, 50), medium [50, 500), high [500, 1000) and luxury [1000, inf).
 
     Args:
         df (pd.DataFrame): Dataframe containing the transaction amounts.
         txt_amount_column (str): Column in the dataframe containing the transaction amounts.
+        binner (AmountBinner, optional): Fitted binner to use instead of the default bins.
+    
+    Returns:
+        pd.DataFrame: df with the added column.
     """
+    if binner is None:
+        binner = AmountBinner(edges=[0, 50, 500, 1000, float('inf')],
+                              labels=['low', 'medium', 'high', 'luxury'])
     
-    df['TRX_AMOUNT_BIN'] = pd.cut(df['TRX_AMOUNT'], 
-                                        bins=[0, 50, 500, 1000, float('inf')],
-                                        labels=['low', 'medium', 'high', 'luxury'],
-                                        right=False)
+    df[f'{txt_amount_column}_BIN'] = binner.transform(df[txt_amount_column])
+    
+    return df
 
 
 
@@ -84,4 +283,66 @@ def extract_ccard(text:str) -> str:
     if match:
         return match.group()
     else:
-        return np.nan
\ No newline at end of file
+        return np.nan
+
+
+
+# All identifiers in one pattern: one named group per entity, tried in this order
+entities_pattern = re.compile(
+    r'(?P<card>' + patterns_dict["credit_card_no"] + ')'
+    r'|(?P<iban>' + patterns_dict["iban_no"] + ')'
+    r'|(?P<atm>' + patterns_dict["atm_id"] + ')'
+    r'|(?P<branch>' + patterns_dict["branch_no"] + ')'
+    )
+
+# Output column name of each entity
+entities_columns = {"card"   : "TRX_CARD_NO",
+                    "iban"   : "TRX_IBAN",
+                    "atm"    : "TRX_ATM_ID",
+                    "branch" : "TRX_BRANCH_NO"}
+
+
+
+def _extract_entities(text:str) -> tuple:
+    """Extract the first identifier of each type and remove all of them in a single scan."""
+    found = {}
+    
+    def replace(match):
+        # The identifier is the first group inside the named group
+        found.setdefault(match.lastgroup, match.group(entities_pattern.groupindex[match.lastgroup] + 1))
+        # Keep 'ATM' in the text, like data_cleaning.remove_atm_no()
+        return ' ATM ' if match.lastgroup == 'atm' else ' '
+    
+    remainder = ' '.join(entities_pattern.sub(replace, text).split())
+    
+    return tuple(found.get(k) for k in entities_columns) + (remainder,)
+
+
+
+def extract_entities(data:pd.Series) -> pd.DataFrame:
+    """Extract the masked credit card number, IBAN, ATM id and the branch number (P-0980) from 
+    the transaction text and remove them, scanning every text once. Each distinct text is
+    processed only once and the results are mapped back to all the rows. If an identifier
+    appears more than once in the text, the first one is returned.
+
+    Args:
+        data (pd.Series): Transaction text column.
+
+    Returns:
+        pd.DataFrame: Dataframe with the same index and string columns TRX_CARD_NO, TRX_IBAN,
+            TRX_ATM_ID, TRX_BRANCH_NO (missing if not found) and TRX_TEXT_REST with the rest of
+            the text (single spaced).
+    
+    Examples:
+        df = df.join(extract_entities(df['text']))
+    """
+    codes, uniques = pd.factorize(data, use_na_sentinel=True)
+    # Last row for the missing values (code -1)
+    rows = [_extract_entities(t) for t in uniques] + [(None,) * (len(entities_columns) + 1)]
+    columns = list(entities_columns.values()) + ['TRX_TEXT_REST']
+    
+    unique_df = pd.DataFrame(rows, columns=columns, dtype='string')
+    out = unique_df.take(codes)
+    out.index = data.index
+    
+    return out
\ No newline at end of file
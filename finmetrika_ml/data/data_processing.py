@@ -1,7 +1,13 @@
+import json
+import warnings
+from pathlib import Path
 import pandas as pd
+import numpy as np
+import pyarrow as pa
+import pyarrow.compute as pc
 import torch
 from finmetrika_ml.utils import *
-from datasets import DatasetDict
+from datasets import Dataset, DatasetDict, ClassLabel
 from transformers import PreTrainedModel, PreTrainedTokenizerBase, AutoModel
 
 
@@ -21,10 +27,8 @@ def get_labels(df:pd.DataFrame,
     # Extract unique labels
     labels = df[col_label].unique().tolist()
     
-    try:
-        assert len(labels) == 1
-    except AssertionError as e:
-        print(f'Assertion error: {e}')
+    if len(labels) < 2:
+        warnings.warn(f'Column {col_label} contains {len(labels)} label(s), at least 2 are needed for classification.')
         
     if verbose:
         print(
@@ -50,29 +54,260 @@ def get_labels_from_dataset(dts:DatasetDict,
 
 
 
-def count_tokens(df:pd.DataFrame, 
+def _smallest_int_dtype(n:int):
+    return np.int8 if n < 128 else np.int16 if n < 32768 else np.int32
+
+
+
+class LabelVocabulary:
+    """Mapping between labels and integer ids (the codes of a categorical), persisted as json 
+    so training and scoring use the same ids. Ids use the smallest integer type. Columns are 
+    encoded in bulk (pandas, NumPy, lists, Arrow and datasets) and decoding is a single 
+    vectorized lookup. The ids are the ids of datasets.ClassLabel(names=vocab.labels), so 
+    len(vocab) equals get_labels_from_dataset() of the encoded dataset.
+
+    Args:
+        labels (list): Labels in the order of their ids.
+    
+    Examples:
+        vocab = LabelVocabulary.from_data(df_train['category'])
+        vocab.save('labels.json')
+        dataset = vocab.encode_dataset(dataset, 'category', 'label')
+        
+        vocab = LabelVocabulary.load('labels.json')
+        df['predicted_category'] = vocab.decode(predicted_ids)
+    """
+    def __init__(self, labels:list) -> None:
+        self.labels = list(labels)
+        if len(set(self.labels)) != len(self.labels):
+            raise ValueError('Labels are not unique.')
+        self.dtype = _smallest_int_dtype(len(self.labels))
+        self._labels_array = np.array(self.labels, dtype=object)
+        self._labels_arrow = pa.array(self.labels)
+        self._index = pd.Index(self.labels)
+    
+    
+    @classmethod
+    def from_data(cls, data, sort:bool=True):
+        """Vocabulary of the distinct (not missing) labels of a column.
+
+        Args:
+            data (pd.Series | np.ndarray | list | pa.Array | pa.ChunkedArray): Labels.
+            sort (bool, optional): Sort the labels, otherwise in the order of appearance. Defaults to True.
+        """
+        if isinstance(data, (pa.Array, pa.ChunkedArray)):
+            labels = pc.unique(data).drop_null().to_pylist()
+        else:
+            labels = pd.Series(data).dropna().unique().tolist()
+        return cls(sorted(labels) if sort else labels)
+    
+    
+    @classmethod
+    def from_dataset(cls, dts:DatasetDict, split:str, label_column_name:str, sort:bool=True):
+        """Vocabulary of a dataset column, the names of a ClassLabel column keep their ids.
+
+        Args:
+            dts (DatasetDict): Dataset with at least one split.
+            split (str): Dataset sample, e.g. 'train'.
+            label_column_name (str): Name of the column where labels are stored in the dts.
+            sort (bool, optional): Sort the labels of other columns. Defaults to True.
+        """
+        feature = dts[split].features[label_column_name]
+        if isinstance(feature, ClassLabel):
+            return cls(feature.names)
+        # The Arrow column of the rows of the split (after select, filter, shuffle, ...)
+        return cls.from_data(dts[split].with_format('arrow')[label_column_name], sort=sort)
+    
+    
+    def __len__(self):
+        return len(self.labels)
+    
+    
+    def encode(self, data, unknown:str='error') -> np.ndarray:
+        """Ids of the labels.
+
+        Args:
+            data (pd.Series | np.ndarray | list | pa.Array | pa.ChunkedArray): Labels.
+            unknown (str, optional): 'error' raises a KeyError for labels (or missing values) 
+                not in the vocabulary, 'ignore' gives them id -1. Defaults to 'error'.
+
+        Returns:
+            np.ndarray: Ids in the smallest integer type.
+        """
+        if isinstance(data, (pa.Array, pa.ChunkedArray)):
+            ids = pc.index_in(data, value_set=self._labels_arrow).fill_null(-1)
+            ids = ids.to_numpy(zero_copy_only=False) if isinstance(ids, pa.Array) else \
+                  np.concatenate([c.to_numpy(zero_copy_only=False) for c in ids.chunks] or [np.zeros(0, np.int32)])
+        else:
+            # Look up the few distinct labels only, then broadcast to the rows
+            codes, uniques = pd.factorize(pd.Series(data), use_na_sentinel=True)
+            ids = np.append(self._index.get_indexer(uniques), -1)[codes]
+        
+        if unknown == 'error' and (ids < 0).any():
+            values = data.to_pylist() if isinstance(data, (pa.Array, pa.ChunkedArray)) else list(data)
+            raise KeyError(f'Labels not in the vocabulary: {sorted({str(values[i]) for i in np.flatnonzero(ids < 0)[:5]})}')
+        return ids.astype(self.dtype, copy=False)
+    
+    
+    def decode(self, ids, categorical:bool=False):
+        """Labels of the ids.
+
+        Args:
+            ids (array-like): Ids, e.g. predicted labels.
+            categorical (bool, optional): Return a pd.Categorical (no copy of the labels per 
+                row) instead of an array of labels, id -1 (unknown, see encode()) is a missing 
+                value. Defaults to False.
+        """
+        ids = ids.cpu().numpy() if isinstance(ids, torch.Tensor) else np.asarray(ids)
+        lowest = -1 if categorical else 0
+        if ids.size and (ids.min() < lowest or ids.max() >= len(self.labels)):
+            raise ValueError(f'Ids must be between {lowest} and {len(self.labels) - 1}, '
+                             f'got {ids.min()} to {ids.max()}.')
+        if categorical:
+            return pd.Categorical.from_codes(ids.astype(self.dtype, copy=False), categories=self.labels)
+        return self._labels_array[ids]
+    
+    
+    def to_class_label(self) -> ClassLabel:
+        """datasets feature with the same ids."""
+        return ClassLabel(names=[str(l) for l in self.labels])
+    
+    
+    def encode_dataset(self, 
+                       dataset:Dataset, 
+                       label_column_name:str, 
+                       output_column_name:str='label') -> Dataset:
+        """Add the ids of the labels to a dataset as a ClassLabel column, encoded in bulk from 
+        the Arrow column.
+
+        Args:
+            dataset (Dataset): Dataset split.
+            label_column_name (str): Name of the column with the labels.
+            output_column_name (str, optional): Name of the column with the ids. Defaults to 'label'.
+        """
+        ids = self.encode(dataset.with_format('arrow')[label_column_name])
+        if output_column_name in dataset.column_names:
+            dataset = dataset.remove_columns(output_column_name)
+        return dataset.add_column(output_column_name, ids.astype(np.int64), feature=self.to_class_label())
+    
+    
+    def save(self, path:Path):
+        """Save the labels to a json file."""
+        with open(path, 'w') as f:
+            json.dump({"labels": self.labels}, f, indent=2, ensure_ascii=False)
+    
+    
+    @classmethod
+    def load(cls, path:Path):
+        """Load the labels from a json file."""
+        with open(path) as f:
+            return cls(**json.load(f))
+    
+    
+    def __repr__(self):
+        return f'LabelVocabulary({len(self)} labels)'
+
+
+
+def _count_tokens_arrow(column, count_ones:bool) -> np.ndarray:
+    """Number of tokens in every row of an Arrow list column: the number of ones of the 
+    attention mask or the length of the input ids.
+    """
+    if not isinstance(column, pa.ChunkedArray):
+        column = pa.chunked_array([column])
+    
+    counts = []
+    for chunk in column.chunks:
+        if count_ones:
+            ones = pc.equal(pc.list_flatten(chunk), 1).to_numpy(zero_copy_only=False)
+            parents = pc.list_parent_indices(chunk).to_numpy()
+            counts.append(np.bincount(parents, weights=ones, minlength=len(chunk)).astype(np.int64))
+        else:
+            counts.append(pc.list_value_length(chunk).fill_null(0).to_numpy().astype(np.int64))
+    
+    return np.concatenate(counts) if counts else np.zeros(0, dtype=np.int64)
+
+
+
+def count_tokens(data, 
                  col_input_ids:str="input_ids", 
                  col_attn_mask:str="attention_mask"):
-    """Counts the number of tokens in each row of a DataFrame where the 
-    attention mask is 1.
+    """Counts the number of tokens in each row where the attention mask is 1, without a loop 
+    over the rows. If there is no attention mask, the length of the input IDs is used.
+    Supported inputs are:
+    - DataFrame with ragged list columns (or pyarrow backed list columns),
+    - Dataset (datasets) with the columns read directly from Arrow, without pandas,
+    - dictionary (e.g. the tokenizer output) of padded 2-D tensors or arrays or ragged lists,
+    - padded 2-D tensor or array of the attention mask.
 
     Args:
-        df (pd.DataFrame): Dataframe containing the token data.
-        col_input_ids (str, optional): Name of the column in df that contains the input IDs. Defaults to "input_ids".
-        col_attn_mask (str, optional): Name of the column in df that contains the attention masks. Defaults to None.
+        data (pd.DataFrame | Dataset | dict | torch.Tensor | np.ndarray): Token data.
+        col_input_ids (str, optional): Name of the column in data that contains the input IDs. Defaults to "input_ids".
+        col_attn_mask (str, optional): Name of the column in data that contains the attention masks. Defaults to "attention_mask".
         
     Returns:
-        pd.Series with the count of tokens for each row.
+        pd.Series with the count of tokens for each row for a DataFrame input, otherwise np.ndarray.
     
     Examples:
         df_train['cnt_tokens'] = count_tokens(df_train)
+        dataset_enc['train'].add_column('cnt_tokens', count_tokens(dataset_enc['train']))
     """
+    if isinstance(data, (torch.Tensor, np.ndarray)):
+        data = {col_attn_mask: data}
+    
+    columns = data.column_names if isinstance(data, Dataset) else data.keys()
+    count_ones = col_attn_mask is not None and col_attn_mask in columns
+    col = col_attn_mask if count_ones else col_input_ids
+    
+    if isinstance(data, Dataset):
+        column = data.with_format('arrow')[col]
+    else:
+        column = data[col]
     
-    def count_tokens(row):
-        paired_tokens = zip(row[col_input_ids], row[col_attn_mask])
-        return sum(1 for _, mask in paired_tokens if mask == 1)
+    # Padded 2-D tensors and arrays
+    if isinstance(column, torch.Tensor):
+        column = column.numpy(force=True)
+    if isinstance(column, np.ndarray) and column.ndim == 2:
+        if count_ones:
+            return (column == 1).sum(axis=1)
+        return np.full(column.shape[0], column.shape[1])
     
-    return df.progress_apply(count_tokens, axis=1)
+    if isinstance(column, pd.Series):
+        values = pa.array(column) if isinstance(column.dtype, pd.ArrowDtype) else pa.array(column.tolist())
+        return pd.Series(_count_tokens_arrow(values, count_ones), index=column.index)
+    if not isinstance(column, (pa.Array, pa.ChunkedArray)):
+        column = pa.array(list(column))
+    
+    return _count_tokens_arrow(column, count_ones)
+
+
+
+def token_length_histogram(n_tokens, 
+                           labels) -> pd.DataFrame:
+    """Count the number of texts of every token length per label, e.g. for the plots of the 
+    token distribution.
+
+    Args:
+        n_tokens (array-like): Number of tokens of each text, e.g. the output of count_tokens().
+        labels (array-like): Label of each text.
+
+    Returns:
+        pd.DataFrame: Number of texts with the number of tokens in the index and labels in the columns.
+    
+    Examples:
+        hist = token_length_histogram(count_tokens(dataset_enc['train']), dataset_enc['train']['label'])
+    """
+    n_tokens = np.asarray(n_tokens, dtype=np.int64)
+    codes, uniques = pd.factorize(np.asarray(labels))
+    # Skip missing labels
+    n_tokens, codes = n_tokens[codes >= 0], codes[codes >= 0]
+    
+    n_lengths = int(n_tokens.max()) + 1 if len(n_tokens) else 1
+    hist = np.bincount(codes * n_lengths + n_tokens, minlength=len(uniques) * n_lengths)
+    
+    return pd.DataFrame(hist.reshape(len(uniques), n_lengths).T, 
+                        index=pd.RangeIndex(n_lengths, name='n_tokens'),
+                        columns=uniques)
 
 
 
@@ -85,6 +320,8 @@ def tokenize(data_sample:DatasetDict,
     """Tokenize text in the column 'text_column_name'. Note that prior to applying the function
     the data_sample needs to be set to the 'torch' format by using data_sample.set_format('torch').
     TODO Update docstring
+    Use padding=False to pad each batch only to its longest sequence with DynamicPaddingCollator.
+    
     Args:
         data_sample (DatasetDict): Dataset including input text.
         tokenizer (PreTrainedTokenizerBase): The tokenizer corresponding to the model, used to identify model input names.
@@ -108,10 +345,37 @@ def tokenize(data_sample:DatasetDict,
     
 
 
+def pool_hidden_states(last_hidden_state:torch.Tensor,
+                       attention_mask:torch.Tensor=None,
+                       pooling:str='cls') -> torch.Tensor:
+    """Pool the hidden states of the tokens into one feature vector per sample.
+
+    Args:
+        last_hidden_state (torch.Tensor): Hidden states of size [batch_size, n_tokens, hidden_dim].
+        attention_mask (torch.Tensor, optional): Attention mask of size [batch_size, n_tokens], 
+            required for pooling='mean'. Defaults to None.
+        pooling (str, optional): 'cls' for the hidden state of the first token, 'mean' for the 
+            mean over the tokens of the attention mask. Defaults to 'cls'.
+
+    Returns:
+        torch.Tensor: Feature vectors of size [batch_size, hidden_dim].
+    """
+    if pooling == 'cls':
+        return last_hidden_state[:, 0]
+    if pooling == 'mean':
+        if attention_mask is None:
+            return last_hidden_state.mean(dim=1)
+        mask = attention_mask.unsqueeze(-1).to(last_hidden_state.dtype)
+        return (last_hidden_state * mask).sum(dim=1) / mask.sum(dim=1).clamp(min=1)
+    raise ValueError(f"Unknown pooling: {pooling}. Use 'cls' or 'mean'.")
+
+
+
 def extract_feature_vector(data_sample:DatasetDict, 
                            model:PreTrainedModel, 
                            tokenizer:PreTrainedTokenizerBase,
-                           device:str):
+                           device:str,
+                           pooling:str='cls'):
     """Extract features from large language models for text classification.
 
     Args:
@@ -119,6 +383,7 @@ def extract_feature_vector(data_sample:DatasetDict,
         model (PreTrainedModel): The model from which to extract the feature vectors. Should be an instance of a class derived from transformers.PreTrainedModel.
         tokenizer (PreTrainedTokenizerBase): The tokenizer corresponding to the model, used to identify model input names.
         device (str): Compute engine to which the inputs should be transfered. Define using check_device().
+        pooling (str, optional): 'cls' or 'mean', see pool_hidden_states(). Defaults to 'cls'.
 
     Returns:
         - dict: A dictionary containing the feature vectors under the key "feature_vector".
@@ -128,7 +393,8 @@ def extract_feature_vector(data_sample:DatasetDict,
     with torch.inference_mode():
         # outputs.last_hidden_state.size() >>> [batch_size, n_tokens, hidden_dim]
         last_hidden_state = model(**inputs).last_hidden_state
-    return {"feature_vector": last_hidden_state[:,0].cpu().numpy()}
+        feature_vector = pool_hidden_states(last_hidden_state, inputs.get('attention_mask'), pooling)
+    return {"feature_vector": feature_vector.cpu().numpy()}
 
 
 
@@ -154,41 +420,536 @@ class TRXDataset(torch.utils.data.Dataset):
         return len(self.dataset_split)
     
 
+def _column_to_tensor(column:pa.ChunkedArray):
+    """Convert an Arrow column to a tensor. Lists of equal length become a 2-D tensor, ragged 
+    lists a tuple of (flat values, offsets). The values are copied once: Arrow (memory mapped) 
+    buffers are read only and writing to a tensor sharing them would change the dataset.
+    """
+    arr = column.chunk(0) if column.num_chunks == 1 else column.combine_chunks()
+    
+    def to_tensor(values:pa.Array) -> torch.Tensor:
+        values = values.to_numpy(zero_copy_only=False)
+        return torch.from_numpy(values if values.flags.writeable else values.copy())
+    
+    if not (pa.types.is_list(arr.type) or pa.types.is_large_list(arr.type) 
+            or pa.types.is_fixed_size_list(arr.type)):
+        return to_tensor(arr)
+    
+    values = to_tensor(pc.list_flatten(arr))
+    lengths = pc.list_value_length(arr).to_numpy(zero_copy_only=False)
+    if len(arr) and (lengths == lengths[0]).all():
+        return values.reshape(len(arr), int(lengths[0]))
+    
+    offsets = torch.from_numpy(np.concatenate([[0], np.cumsum(lengths)]))
+    return values, offsets
+    
+
+
+class TRXTensorDataset(torch.utils.data.Dataset):
+    """Transaction dataset backed by tensors built from the Arrow columns of the (tokenized) 
+    dataset. Unlike TRXDataset, nothing is converted per sample: the columns are converted 
+    once, a sample (or a batch of samples with get_batch) is plain tensor indexing, and the 
+    tensors stay on the CPU so the dataset works with DataLoader(num_workers>0). Move the 
+    batches to the device in the training loop, e.g. with utils.moveTo().
+    
+    The samples and batches are copies, in place changes (e.g. masking for MLM) change neither 
+    the dataset nor the Arrow columns of the dataset split.
+    
+    Padded columns (same number of tokens in every row) are returned as tensors. Ragged 
+    columns (no padding) are returned as a tensor per sample, or a list of tensors for a batch, 
+    to be padded by the collate function.
+    
+    A DataLoader with a batch size fetches the samples one by one. To fetch every batch with a 
+    single indexing, pass a batch sampler as the 'sampler' with batch_size=None: the dataset is 
+    then indexed with the list of indices of the batch.
+
+    Args:
+        dataset_split (Dataset): Tokenized dataset split including "input_ids".
+        columns (list, optional): Columns to keep. Defaults to ['input_ids', 'attention_mask', 'label'].
+    
+    Examples:
+        dataset = TRXTensorDataset(dataset_enc['train'])
+        loader = DataLoader(dataset, batch_size=64, shuffle=True, num_workers=4)
+        # Batched indexing
+        loader = DataLoader(dataset, sampler=BatchSampler(RandomSampler(dataset), 64, drop_last=False),
+                            batch_size=None, num_workers=4, collate_fn=TRXTensorDataset.collate)
+        for batch in loader:
+            batch = moveTo(batch, device)
+    """
+    def __init__(self, 
+                 dataset_split:Dataset,
+                 columns:list=None):
+        columns = columns or ['input_ids', 'attention_mask', 'label']
+        self.columns = [c for c in columns if c in dataset_split.column_names]
+        
+        arrow_split = dataset_split.with_format('arrow')
+        self.tensors = {c: _column_to_tensor(arrow_split[c]) for c in self.columns}
+        self.n_rows = len(dataset_split)
+    
+    
+    @staticmethod
+    def _take(tensor, idx):
+        # Slices and integer indexing return views, clone them
+        if isinstance(tensor, tuple):
+            values, offsets = tensor
+            if isinstance(idx, (int, np.integer)):
+                return values[offsets[idx]:offsets[idx+1]].clone()
+            return [values[offsets[i]:offsets[i+1]].clone() for i in idx]
+        if isinstance(idx, (int, np.integer)):
+            return tensor[idx].clone()
+        return tensor[idx]
+    
+    
+    def __getitem__(self, idx):
+        if not isinstance(idx, (int, np.integer)):
+            return self.get_batch(idx)
+        return {k: self._take(v, idx) for k,v in self.tensors.items()}
+    
+    
+    def get_batch(self, indices:list) -> dict:
+        """Fetch a batch of samples at once, already collated (padded columns are stacked, 
+        ragged columns are lists of tensors).
+        """
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        return {k: self._take(v, indices.tolist() if isinstance(v, tuple) else indices) 
+                for k,v in self.tensors.items()}
+    
+    
+    @staticmethod
+    def collate(batch):
+        """Collate function for the DataLoader: batches from get_batch are already collated, 
+        lists of samples are collated with the default collate function.
+        """
+        if isinstance(batch, dict):
+            return batch
+        return torch.utils.data.default_collate(batch)
+    
+    
+    def __len__(self):
+        return self.n_rows
+    
+
+
+def padding_fraction(n_tokens, 
+                     batches:list) -> float:
+    """Fraction of the padded token slots which are padding, if every batch is padded to its
+    longest sequence.
+
+    Args:
+        n_tokens (array-like): Number of tokens of each sample, e.g. the output of count_tokens().
+        batches (list): Lists of sample indices, e.g. list(LengthBucketSampler(...)).
+    """
+    n_tokens = np.asarray(n_tokens)
+    n_real = sum(int(n_tokens[b].sum()) for b in batches)
+    n_slots = sum(int(n_tokens[b].max()) * len(b) for b in batches if len(b))
+    
+    return 1 - n_real / n_slots if n_slots else 0.0
+
+
+
+class LengthBucketSampler(torch.utils.data.Sampler):
+    """Batch sampler grouping samples of similar token length, so that little padding is 
+    needed when the batches are padded dynamically (see DynamicPaddingCollator). Without 
+    shuffling, the samples are sorted by length (for inference). With shuffling, the samples 
+    are shuffled, split into buckets of 'bucket_size' batches, sorted by length within each 
+    bucket and the batches are shuffled (for training).
+
+    Args:
+        n_tokens (array-like): Number of tokens of each sample, e.g. the output of count_tokens().
+        batch_size (int): Number of samples per batch.
+        shuffle (bool, optional): Shuffle within buckets and shuffle the batches. Defaults to False.
+        bucket_size (int, optional): Number of batches per bucket when shuffling. Defaults to 50.
+        drop_last (bool, optional): Drop the last incomplete batch. Defaults to False.
+        seed (int, optional): Random seed, combined with the epoch set by set_epoch(). Defaults to 42.
+    
+    Examples:
+        sampler = LengthBucketSampler(count_tokens(dataset_enc['train']), batch_size=64, shuffle=True)
+        loader = DataLoader(TRXTensorDataset(dataset_enc['train']), sampler=sampler, batch_size=None,
+                            collate_fn=DynamicPaddingCollator(tokenizer.pad_token_id))
+        sampler.padding_fraction()
+    """
+    def __init__(self, 
+                 n_tokens,
+                 batch_size:int,
+                 shuffle:bool=False,
+                 bucket_size:int=50,
+                 drop_last:bool=False,
+                 seed:int=42):
+        self.n_tokens = np.asarray(n_tokens)
+        self.batch_size = batch_size
+        self.shuffle = shuffle
+        self.bucket_size = bucket_size
+        self.drop_last = drop_last
+        self.seed = seed
+        self.epoch = 0
+    
+    
+    def set_epoch(self, epoch:int):
+        """Set the epoch to get a different shuffle in every epoch."""
+        self.epoch = epoch
+    
+    
+    def batches(self) -> list:
+        """Lists of sample indices of the batches of the current epoch."""
+        if self.shuffle:
+            rng = np.random.default_rng((self.seed, self.epoch))
+            indices = rng.permutation(len(self.n_tokens))
+            bucket = self.batch_size * self.bucket_size
+            indices = np.concatenate(
+                [b[np.argsort(self.n_tokens[b], kind='stable')] 
+                 for b in np.split(indices, range(bucket, len(indices), bucket))]) if len(indices) else indices
+        else:
+            indices = np.argsort(self.n_tokens, kind='stable')
+        
+        batches = [indices[i:i+self.batch_size] for i in range(0, len(indices), self.batch_size)]
+        if self.drop_last and batches and len(batches[-1]) < self.batch_size:
+            batches = batches[:-1]
+        if self.shuffle:
+            batches = [batches[i] for i in rng.permutation(len(batches))]
+        
+        return [b.tolist() for b in batches]
+    
+    
+    def padding_fraction(self) -> float:
+        """Fraction of padding of the batches of the current epoch, see padding_fraction()."""
+        return padding_fraction(self.n_tokens, self.batches())
+    
+    
+    def __iter__(self):
+        return iter(self.batches())
+    
+    
+    def __len__(self):
+        if self.drop_last:
+            return len(self.n_tokens) // self.batch_size
+        return -(-len(self.n_tokens) // self.batch_size)
+
+
+
+class DynamicPaddingCollator:
+    """Pad every batch only to its longest sequence instead of the model maximum. Works with 
+    samples from TRXDataset and TRXTensorDataset (also the batches from get_batch), ragged 
+    (tokenized with padding=False) or already padded (right padding) inputs, which are trimmed.
+    The batches stay on the CPU. The fraction of padding over all the collated batches is 
+    kept in 'padding_fraction'.
+
+    Args:
+        pad_token_id (int, optional): Padding value of the input ids, tokenizer.pad_token_id. Defaults to 0.
+        pad_to_multiple_of (int, optional): Round up the padded length. Defaults to None.
+        token_columns (list, optional): Columns to pad. Defaults to ['input_ids', 'attention_mask', 'token_type_ids'].
+    
+    Examples:
+        collator = DynamicPaddingCollator(tokenizer.pad_token_id)
+        for batch in DataLoader(dataset, sampler=sampler, batch_size=None, collate_fn=collator):
+            fwd_pass(batch, model, device, tokenizer)
+        collator.padding_fraction
+    """
+    def __init__(self, 
+                 pad_token_id:int=0,
+                 pad_to_multiple_of:int=None,
+                 token_columns:list=None):
+        self.pad_token_id = pad_token_id
+        self.pad_to_multiple_of = pad_to_multiple_of
+        self.token_columns = token_columns or ['input_ids', 'attention_mask', 'token_type_ids']
+        self.n_tokens = 0
+        self.n_slots = 0
+    
+    
+    @property
+    def padding_fraction(self) -> float:
+        return 1 - self.n_tokens / self.n_slots if self.n_slots else 0.0
+    
+    
+    def _pad(self, rows, length:int, value:int) -> torch.Tensor:
+        if isinstance(rows, torch.Tensor) and rows.dim() == 2:
+            if rows.shape[1] >= length:
+                return rows[:, :length]
+            rows = list(rows)
+        rows = [torch.as_tensor(r) for r in rows]
+        out = torch.full((len(rows), length), value, dtype=rows[0].dtype)
+        for i, r in enumerate(rows):
+            out[i, :min(len(r), length)] = r[:length]
+        return out
+    
+    
+    def __call__(self, batch):
+        if not isinstance(batch, dict):
+            batch = {k: [sample[k] for sample in batch] for k in batch[0]}
+        
+        # Number of real tokens of each sample (right padding)
+        if 'attention_mask' in batch:
+            mask = batch['attention_mask']
+            lengths = [int(m.sum()) for m in mask] if not isinstance(mask, torch.Tensor) \
+                      else mask.sum(dim=-1).tolist()
+        else:
+            lengths = [len(ids) for ids in batch['input_ids']]
+        
+        length = max(lengths)
+        if self.pad_to_multiple_of:
+            length = -(-length // self.pad_to_multiple_of) * self.pad_to_multiple_of
+        
+        out = {}
+        for k, v in batch.items():
+            if k in self.token_columns:
+                out[k] = self._pad(v, length, self.pad_token_id if k == 'input_ids' else 0)
+            else:
+                out[k] = v if isinstance(v, torch.Tensor) else torch.as_tensor(np.asarray(v))
+        
+        self.n_tokens += sum(lengths)
+        self.n_slots += len(lengths) * length
+        
+        return out
+    
+
+
+def _real_tokens(encodings) -> tuple:
+    """Input ids of the real (not padding) tokens of all the samples concatenated, and the 
+    number of tokens of each sample."""
+    input_ids = encodings['input_ids']
+    attention_mask = encodings.get('attention_mask')
+    if isinstance(input_ids, torch.Tensor) and input_ids.dim() == 2:
+        if attention_mask is None:
+            return input_ids.reshape(-1).numpy(), np.full(len(input_ids), input_ids.shape[1])
+        mask = attention_mask.bool()
+        return input_ids[mask].numpy(), mask.sum(dim=1).numpy()
+    
+    rows = [np.asarray(ids) for ids in input_ids]
+    if attention_mask is not None:
+        rows = [ids[np.asarray(m, dtype=bool)] for ids, m in zip(rows, attention_mask)]
+    lengths = np.array([len(r) for r in rows], dtype=np.int64)
+    return (np.concatenate(rows) if rows else np.zeros(0, np.int64)), lengths
+
+
+
 class CausalLMDataset(torch.utils.data.Dataset):
+    """Dataset for causal language modelling (e.g. domain adaptive pretraining), the labels are 
+    the input ids (the model shifts them) with padding ignored (-100).
+    
+    Transaction descriptions are short, so with packed=True the real tokens of all the samples 
+    are concatenated, with 'sep_token_id' after every sample, and cut into blocks of 
+    'block_size' tokens without any padding. Samples can span two blocks. With 
+    document_attention=True the tokens attend only to the tokens of their own sample: every 
+    block gets a block diagonal causal 'attention_mask' of size [1, block_size, block_size] 
+    (True = attend), 'position_ids' restarting at every sample and the first token of every 
+    sample is not predicted from the previous sample (label -100). Otherwise the blocks get 
+    the usual 'attention_mask' of ones. Every packed block has 'document_ids', the index of 
+    the sample of every token.
     
-    def __init__(self, encodings, device):
+    Args:
+        encodings (dict): Tokenized samples, 'input_ids' and optionally 'attention_mask', e.g. 
+            the output of the tokenizer.
+        device (str): Not used, the samples stay on the CPU. Move the batches in the training loop.
+        packed (bool, optional): Pack the samples into blocks. Defaults to False.
+        block_size (int, optional): Number of tokens per packed block. Defaults to 128.
+        sep_token_id (int, optional): Token added after every packed sample, e.g. 
+            tokenizer.eos_token_id. Defaults to None, nothing is added (samples tokenized with 
+            special tokens are already separated).
+        document_attention (bool, optional): Restrict the attention to each sample. Defaults to False.
+        drop_last (bool, optional): Drop the last incomplete block, otherwise it is padded. 
+            Defaults to False.
+    
+    Examples:
+        encodings = tokenizer(texts, truncation=True, max_length=64)
+        dataset = CausalLMDataset(encodings, device, packed=True, block_size=256, 
+                                  sep_token_id=tokenizer.eos_token_id)
+        dataset.padding_fraction
+    """
+    def __init__(self, 
+                 encodings, 
+                 device,
+                 packed:bool=False,
+                 block_size:int=128,
+                 sep_token_id:int=None,
+                 document_attention:bool=False,
+                 drop_last:bool=False):
         self.encodings = encodings
         self.device = device
+        self.packed = packed
+        self.block_size = block_size
+        self.document_attention = document_attention
+        
+        tokens, lengths = _real_tokens(encodings)
+        self.n_tokens = int(lengths.sum())
+        n_samples = len(encodings['input_ids'])
+        self.n_slots = n_samples * max((len(ids) for ids in encodings['input_ids']), default=0)
+        if not packed:
+            return
+        
+        # Add the separator after every sample
+        doc_lengths = lengths + (sep_token_id is not None)
+        stream = np.empty(int(doc_lengths.sum()), dtype=np.int64)
+        if sep_token_id is not None:
+            is_sep = np.zeros(len(stream), dtype=bool)
+            is_sep[np.cumsum(doc_lengths) - 1] = True
+            stream[is_sep] = sep_token_id
+            stream[~is_sep] = tokens
+        else:
+            stream[:] = tokens
+        doc_ids = np.repeat(np.arange(n_samples), doc_lengths)
+        doc_starts = np.zeros(len(stream), dtype=bool)
+        doc_starts[(np.cumsum(doc_lengths) - doc_lengths)[doc_lengths > 0]] = True
+        
+        n_blocks = len(stream) // block_size if drop_last else -(-len(stream) // block_size)
+        n_pad = n_blocks * block_size - len(stream)
+        valid = np.ones(len(stream), dtype=bool)
+        if n_pad > 0:
+            stream = np.concatenate([stream, np.zeros(n_pad, dtype=np.int64)])
+            doc_ids = np.concatenate([doc_ids, np.full(n_pad, -1)])
+            doc_starts = np.concatenate([doc_starts, np.zeros(n_pad, dtype=bool)])
+            valid = np.concatenate([valid, np.zeros(n_pad, dtype=bool)])
+        
+        size = n_blocks * block_size
+        labels = np.where(valid, stream, -100)
+        if document_attention:
+            labels[doc_starts] = -100
+        
+        self.input_ids = torch.from_numpy(stream[:size].reshape(n_blocks, block_size))
+        self.labels = torch.from_numpy(labels[:size].reshape(n_blocks, block_size))
+        self.document_ids = torch.from_numpy(doc_ids[:size].reshape(n_blocks, block_size))
+        self.valid = torch.from_numpy(valid[:size].reshape(n_blocks, block_size))
+        self.n_slots = size
+        self.n_tokens = int(self.valid.sum())
+        
+    
+    @property
+    def padding_fraction(self) -> float:
+        """Fraction of the token slots which are padding."""
+        return 1 - self.n_tokens / self.n_slots if self.n_slots else 0.0
         
     def __len__(self):
+        if self.packed:
+            return len(self.input_ids)
         return len(self.encodings['input_ids'])
     
+    
+    def _packed_item(self, idx):
+        doc_ids = self.document_ids[idx]
+        item = {"input_ids": self.input_ids[idx],
+                "labels": self.labels[idx],
+                "document_ids": doc_ids}
+        if not self.document_attention:
+            item['attention_mask'] = self.valid[idx].long()
+            return item
+        
+        same_doc = (doc_ids[:, None] == doc_ids[None, :]) & self.valid[idx][:, None]
+        item['attention_mask'] = torch.tril(same_doc).unsqueeze(0)
+        # Position of every token within its sample
+        starts = torch.ones(len(doc_ids), dtype=torch.bool)
+        starts[1:] = doc_ids[1:] != doc_ids[:-1]
+        positions = torch.arange(len(doc_ids))
+        item['position_ids'] = positions - torch.cummax(torch.where(starts, positions, 0), dim=0).values
+        return item
+    
+    
     def __getitem__(self, idx):
+        if self.packed:
+            return self._packed_item(idx)
+        
         item = {
            key : val[idx] for key,val in self.encodings.items()\
                if key in ['input_ids', 'attention_mask', 'label'] 
         }
         
-        # Labels are the same as input_ids for CLM        
+        # Labels are the same as input_ids for CLM, padding is ignored in the loss
         item['labels'] = item['input_ids']
+        if isinstance(item['input_ids'], torch.Tensor) and 'attention_mask' in item:
+            item['labels'] = item['input_ids'].masked_fill(item['attention_mask'] == 0, -100)
         
         return item
            
     
 
+def _as_float32_tensor(values) -> torch.Tensor:
+    """Contiguous float32 tensor with one row per sample, sharing the memory of float32 
+    contiguous NumPy arrays (no copy)."""
+    if isinstance(values, torch.Tensor):
+        values = values.detach().to(torch.float32).contiguous()
+    else:
+        values = torch.from_numpy(np.ascontiguousarray(np.asarray(values), dtype=np.float32))
+    return values.reshape(-1, 1) if values.dim() == 1 else values
+
+
+
 class RegressionDataset1D(torch.utils.data.Dataset):
+    """Regression dataset backed by two contiguous float32 tensors, converted once. NumPy 
+    float32 arrays are shared without a copy. 1-D inputs become one column, 2-D inputs keep 
+    their features. A sample is a pair of views (X[idx], y[idx]), a batch of indices is fetched 
+    with a single indexing (get_batch) and iter_batches() yields slices of the tensors 
+    without any per sample collation.
+    
+    A DataLoader with a batch size fetches the samples one by one. To fetch every batch with a 
+    single indexing, pass a batch sampler as the 'sampler' with batch_size=None.
+
+    Args:
+        X (array-like): Features of size [n] or [n, n_features].
+        y (array-like): Targets of size [n] or [n, n_targets].
     
+    Examples:
+        dataset = RegressionDataset1D(X, y)
+        for X_batch, y_batch in dataset.iter_batches(batch_size=4096, shuffle=True):
+            loss = loss_fn(model(X_batch), y_batch)
+        
+        loader = DataLoader(dataset, sampler=BatchSampler(RandomSampler(dataset), 4096, drop_last=False),
+                            batch_size=None, collate_fn=RegressionDataset1D.collate)
+    """
     def __init__(self, X, y):
-        self.X = X.reshape(-1,1)
-        self.y = y.reshape(-1,1)
+        self.X = _as_float32_tensor(X)
+        self.y = _as_float32_tensor(y)
+        if len(self.X) != len(self.y):
+            raise ValueError(f'X and y have a different number of samples: {len(self.X)} and {len(self.y)}.')
     
     
     def __getitem__(self, idx):
-        return torch.tensor(self.X[idx,:],
-                            dtype=torch.torch.float32),\
-                torch.tensor(self.y[idx,:],
-                             dype=torch.float32)
+        if not isinstance(idx, (int, np.integer)):
+            return self.get_batch(idx)
+        return self.X[idx], self.y[idx]
+    
+    
+    def get_batch(self, indices:list) -> tuple:
+        """Fetch a batch of samples at once, already collated."""
+        indices = torch.as_tensor(indices, dtype=torch.long)
+        return self.X[indices], self.y[indices]
+    
+    
+    @staticmethod
+    def collate(batch):
+        """Collate function for the DataLoader: batches from get_batch are already collated, 
+        lists of samples are collated with the default collate function.
+        """
+        if isinstance(batch, tuple):
+            return batch
+        return torch.utils.data.default_collate(batch)
+    
+    
+    def iter_batches(self, 
+                     batch_size:int, 
+                     shuffle:bool=False,
+                     drop_last:bool=False,
+                     generator:torch.Generator=None):
+        """Iterate over batches without a DataLoader. Without shuffling the batches are slices 
+        (views) of the tensors, with shuffling one gather per batch.
+
+        Args:
+            batch_size (int): Number of samples per batch.
+            shuffle (bool, optional): Shuffle the samples. Defaults to False.
+            drop_last (bool, optional): Drop the last incomplete batch. Defaults to False.
+            generator (torch.Generator, optional): Random generator for shuffling. Defaults to None.
+
+        Yields:
+            tuple: Batch of features and targets.
+        """
+        n = len(self)
+        stop = n - n % batch_size if drop_last else n
+        if not shuffle:
+            for start in range(0, stop, batch_size):
+                yield self.X[start:start+batch_size], self.y[start:start+batch_size]
+            return
+        
+        perm = torch.randperm(n, generator=generator)
+        for start in range(0, stop, batch_size):
+            idx = perm[start:start+batch_size]
+            yield self.X[idx], self.y[idx]
         
     
     def __len__(self):
-        return self.X.shape[0]
\ No newline at end of file
+        return self.X.shape[0]
@@ -0,0 +1,369 @@
+import os
+import json
+import time
+import shutil
+import hashlib
+from pathlib import Path
+from contextlib import contextmanager
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+from transformers import PreTrainedTokenizerBase
+
+try:
+    import fcntl
+except ImportError:  # Windows, the cache directory is not locked
+    fcntl = None
+
+
+
+def text_hashes(texts:list) -> np.ndarray:
+    """64-bit content hash of every text.
+
+    Args:
+        texts (list): Texts to hash.
+    """
+    return np.fromiter((int.from_bytes(hashlib.blake2b(t.encode('utf-8'), digest_size=8).digest(), 'little')
+                        for t in texts), dtype=np.uint64, count=len(texts))
+
+
+
+def tokenizer_fingerprint(tokenizer:PreTrainedTokenizerBase,
+                          **settings) -> str:
+    """Hash of the tokenizer (its full configuration and vocabulary) and the tokenization
+    settings, e.g. max_length and truncation.
+
+    Args:
+        tokenizer (PreTrainedTokenizerBase): The tokenizer.
+        settings: Tokenization settings.
+    """
+    if getattr(tokenizer, 'is_fast', False):
+        # Truncation and padding of the backend change with every call, they are part of the settings
+        identity = json.loads(tokenizer.backend_tokenizer.to_str())
+        identity.pop('truncation', None)
+        identity.pop('padding', None)
+        identity = json.dumps(identity, sort_keys=True)
+    else:
+        # The normalization (do_lower_case, strip_accents, ...) is set by the init arguments,
+        # file locations are left out, the vocabulary itself is hashed
+        init_kwargs = {k: v for k,v in getattr(tokenizer, 'init_kwargs', {}).items()
+                       if not k.endswith('_file') and k != 'name_or_path'}
+        identity = json.dumps([sorted(tokenizer.get_vocab().items()),
+                               json.dumps(init_kwargs, sort_keys=True, default=str)])
+
+    h = hashlib.sha1()
+    for part in [type(tokenizer).__name__, identity,
+                 json.dumps(tokenizer.special_tokens_map, sort_keys=True, default=str),
+                 json.dumps(settings, sort_keys=True, default=str)]:
+        h.update(part.encode('utf-8'))
+
+    return h.hexdigest()[:16]
+
+
+
+def _gather(dst:np.ndarray, dst_starts:np.ndarray, src:np.ndarray, src_starts:np.ndarray, lengths:np.ndarray):
+    """Copy the ragged rows src[src_starts[i]:src_starts[i]+lengths[i]] to dst[dst_starts[i]:...]."""
+    total = int(lengths.sum())
+    if total == 0:
+        return
+    within = np.arange(total) - np.repeat(np.cumsum(lengths) - lengths, lengths)
+    dst[np.repeat(dst_starts, lengths) + within] = src[np.repeat(src_starts, lengths) + within]
+
+
+
+def _file_version(path:Path):
+    """Inode, modification time and size of the file, None if it does not exist. Manifests are
+    replaced on every write, so a new file always has a new version.
+    """
+    try:
+        st = path.stat()
+    except FileNotFoundError:
+        return None
+    return (st.st_ino, st.st_mtime_ns, st.st_size)
+
+
+
+def _write_manifest(path:Path, manifest:dict):
+    """Write the manifest atomically, a crash never leaves a partially written file."""
+    tmp_path = path / 'manifest.json.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(manifest, f, indent=2)
+    os.replace(tmp_path, path / 'manifest.json')
+
+
+
+class TokenizationCache:
+    """Persistent on-disk cache of tokenized texts. The cache is keyed by the tokenizer identity
+    and the tokenization settings, and each text by the hash of its content, so a repeated run
+    loads the tokens from memory-mapped files and only new or changed texts are tokenized.
+
+    Tokens are stored without padding in a ragged format: the input ids of all the texts in one
+    flat array plus the offsets of each text, in append-only segments. Pad the batches with
+    DynamicPaddingCollator. When the cache is larger than 'max_bytes' the least recently used
+    segments (of any tokenizer) are evicted. Caches of different tokenizers and processes can
+    share the directory: the manifests are read from disk and updated under a lock of the
+    cache directory.
+
+    Args:
+        cache_dir (Path): Directory of the cache.
+        tokenizer (PreTrainedTokenizerBase): The tokenizer.
+        truncation (bool, optional): Truncate to max_length. Defaults to False.
+        max_length (int, optional): Maximum number of tokens. Defaults to None.
+        add_special_tokens (bool, optional): Add [CLS], [SEP], ... Defaults to True.
+        max_bytes (int, optional): Size cap of the whole cache directory. Defaults to 2**30 (1 GB).
+
+    Examples:
+        cache = TokenizationCache(dir_cache, tokenizer, truncation=True, max_length=64)
+        tokens = cache.tokenize(dataset['train']['text'])
+        dataset_enc = Dataset(tokens)
+        cache.invalidate()
+    """
+    def __init__(self,
+                 cache_dir:Path,
+                 tokenizer:PreTrainedTokenizerBase,
+                 truncation:bool=False,
+                 max_length:int=None,
+                 add_special_tokens:bool=True,
+                 max_bytes:int=2**30) -> None:
+        self.cache_dir = Path(cache_dir)
+        self.tokenizer = tokenizer
+        self.settings = {"truncation": truncation,
+                         "max_length": max_length,
+                         "add_special_tokens": add_special_tokens}
+        self.max_bytes = max_bytes
+        self.key = tokenizer_fingerprint(tokenizer, **self.settings)
+        self.path = self.cache_dir / self.key
+        self.hits = 0
+        self.misses = 0
+        self._load()
+
+
+    def _load(self):
+        """Read the manifest and memory-map the segments. Segments evicted by another cache
+        sharing the directory are dropped.
+        """
+        manifest_path = self.path / 'manifest.json'
+        if manifest_path.exists():
+            with open(manifest_path) as f:
+                self.manifest = json.load(f)
+            self._manifest_version = _file_version(manifest_path)
+        else:
+            self.manifest = {"settings": self.settings, "segments": []}
+            self._manifest_version = None
+
+        self.segments, segments = [], []
+        for seg in self.manifest["segments"]:
+            try:
+                arrays = {k: np.load(self.path / f'{seg["name"]}_{k}.npy', mmap_mode='r')
+                          for k in ('values', 'offsets', 'hashes')}
+            except FileNotFoundError:
+                continue
+            segments.append(seg)
+            self.segments.append(arrays)
+        self.manifest["segments"] = segments
+        self._build_index()
+
+
+    def _refresh(self):
+        """Reload the manifest if it was changed on disk by another cache."""
+        if _file_version(self.path / 'manifest.json') != self._manifest_version:
+            self._load()
+
+
+    @contextmanager
+    def _locked(self):
+        """Exclusive lock of the cache directory, across processes. Not reentrant."""
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        with open(self.cache_dir / '.lock', 'w') as f:
+            if fcntl is not None:
+                fcntl.flock(f, fcntl.LOCK_EX)
+            try:
+                yield
+            finally:
+                if fcntl is not None:
+                    fcntl.flock(f, fcntl.LOCK_UN)
+
+
+    def _build_index(self):
+        """Sorted hashes of all the cached texts with their segment and row."""
+        if self.segments:
+            hashes = np.concatenate([s['hashes'] for s in self.segments])
+            segment = np.concatenate([np.full(len(s['hashes']), i, dtype=np.int32) for i, s in enumerate(self.segments)])
+            row = np.concatenate([np.arange(len(s['hashes'])) for s in self.segments])
+        else:
+            hashes, segment, row = np.zeros(0, np.uint64), np.zeros(0, np.int32), np.zeros(0, np.int64)
+
+        order = np.argsort(hashes, kind='stable')
+        self.index_hashes, self.index_segment, self.index_row = hashes[order], segment[order], row[order]
+
+
+    def _lookup(self, hashes:np.ndarray):
+        """Segment and row of every hash, segment -1 if it is not cached."""
+        segment = np.full(len(hashes), -1, dtype=np.int64)
+        row = np.zeros(len(hashes), dtype=np.int64)
+        if len(self.index_hashes) == 0:
+            return segment, row
+
+        pos = np.minimum(np.searchsorted(self.index_hashes, hashes), len(self.index_hashes) - 1)
+        found = self.index_hashes[pos] == hashes
+        segment[found] = self.index_segment[pos[found]]
+        row[found] = self.index_row[pos[found]]
+
+        return segment, row
+
+
+    def _add_segment(self, texts:list, hashes:np.ndarray):
+        """Tokenize the texts and save them as a new segment."""
+        input_ids = self.tokenizer(texts, padding=False, **self.settings)['input_ids']
+        lengths = np.fromiter((len(ids) for ids in input_ids), dtype=np.int64, count=len(input_ids))
+
+        name = f'{time.time_ns():x}'
+        arrays = {"values": np.fromiter((t for ids in input_ids for t in ids), dtype=np.int32, count=int(lengths.sum())),
+                  "offsets": np.concatenate([[0], np.cumsum(lengths)]),
+                  "hashes": hashes}
+        self.path.mkdir(parents=True, exist_ok=True)
+        for k, v in arrays.items():
+            np.save(self.path / f'{name}_{k}.npy', v)
+
+        self.manifest["segments"].append({"name": name,
+                                          "n_texts": len(texts),
+                                          "bytes": sum(v.nbytes for v in arrays.values()),
+                                          "last_used": time.time()})
+        self.segments.append({k: np.load(self.path / f'{name}_{k}.npy', mmap_mode='r') for k in arrays})
+
+
+    def _save_manifest(self):
+        self.path.mkdir(parents=True, exist_ok=True)
+        _write_manifest(self.path, self.manifest)
+        self._manifest_version = _file_version(self.path / 'manifest.json')
+
+
+    def tokenize(self, texts) -> pa.Table:
+        """Tokenize the texts, reading the cached ones from disk.
+
+        Args:
+            texts (list | pd.Series | pa.Array): Texts to tokenize, without missing values.
+
+        Returns:
+            pa.Table: Columns 'input_ids' and 'attention_mask' (lists without padding) in the order of the texts.
+        """
+        codes, uniques = pd.factorize(pd.Series(texts, dtype=object), use_na_sentinel=True)
+        if (codes < 0).any():
+            raise ValueError('Texts contain missing values.')
+        uniques = list(uniques)
+        hashes = text_hashes(uniques)
+
+        with self._locked():
+            self._refresh()
+            values, out_offsets = self._tokenize_unique(uniques, hashes, codes)
+            self._save_manifest()
+            self._evict()
+
+        large = out_offsets[-1] >= 2**31
+        offsets = pa.array(out_offsets, type=pa.int64() if large else pa.int32())
+        array_type = pa.LargeListArray if large else pa.ListArray
+
+        return pa.table({"input_ids": array_type.from_arrays(offsets, pa.array(values)),
+                         "attention_mask": array_type.from_arrays(offsets, pa.array(np.ones(len(values), dtype=np.int8)))})
+
+
+    def _tokenize_unique(self, uniques:list, hashes:np.ndarray, codes:np.ndarray) -> tuple:
+        """Tokens (flat values and offsets) of every row, tokenizing the unique texts which
+        are not cached yet. Called with the cache directory locked.
+        """
+        segment, row = self._lookup(hashes)
+        missing = np.flatnonzero(segment < 0)
+        self.hits += len(uniques) - len(missing)
+        self.misses += len(missing)
+        if len(missing):
+            self._add_segment([uniques[i] for i in missing], hashes[missing])
+            segment[missing] = len(self.segments) - 1
+            row[missing] = np.arange(len(missing))
+            self._build_index()
+
+        # Scatter the tokens of the unique texts to all the rows
+        row_segment, row_row = segment[codes], row[codes]
+        lengths = np.zeros(len(codes), dtype=np.int64)
+        for s in np.unique(row_segment):
+            mask = row_segment == s
+            offsets = self.segments[s]['offsets']
+            lengths[mask] = offsets[row_row[mask] + 1] - offsets[row_row[mask]]
+
+        out_offsets = np.concatenate([[0], np.cumsum(lengths)])
+        values = np.empty(int(out_offsets[-1]), dtype=np.int32)
+        now = time.time()
+        for s in np.unique(row_segment):
+            mask = row_segment == s
+            seg = self.segments[s]
+            _gather(values, out_offsets[:-1][mask], seg['values'], seg['offsets'][row_row[mask]], lengths[mask])
+            self.manifest["segments"][s]["last_used"] = now
+
+        return values, out_offsets
+
+
+    def size(self) -> int:
+        """Size of the whole cache directory in bytes."""
+        return sum(p.stat().st_size for p in self.cache_dir.rglob('*.npy'))
+
+
+    def _evict(self):
+        """Delete the least recently used segments, of all the tokenizers in the cache directory,
+        until the cache is smaller than max_bytes. Called with the cache directory locked.
+        """
+        total = self.size()
+        if total <= self.max_bytes:
+            return
+
+        manifests = {}
+        for path in self.cache_dir.glob('*/manifest.json'):
+            with open(path) as f:
+                manifests[path.parent] = json.load(f)
+        manifests[self.path] = self.manifest
+
+        candidates = sorted((seg["last_used"], str(key_path), seg["name"])
+                            for key_path, m in manifests.items() for seg in m["segments"])
+        removed = set()
+        for _, key_path, name in candidates:
+            if total <= self.max_bytes:
+                break
+            for k in ('values', 'offsets', 'hashes'):
+                file = Path(key_path) / f'{name}_{k}.npy'
+                try:
+                    total -= file.stat().st_size
+                    file.unlink()
+                except FileNotFoundError:
+                    pass
+            removed.add((key_path, name))
+
+        for key_path, m in manifests.items():
+            m["segments"] = [seg for seg in m["segments"] if (str(key_path), seg["name"]) not in removed]
+            if key_path != self.path:
+                _write_manifest(key_path, m)
+        self._save_manifest()
+        self._load()
+
+
+    def invalidate(self):
+        """Delete the cached tokens of this tokenizer and settings."""
+        with self._locked():
+            if self.path.exists():
+                shutil.rmtree(self.path)
+            self._load()
+
+
+    def clear(self):
+        """Delete the whole cache directory (all tokenizers)."""
+        with self._locked():
+            for path in self.cache_dir.iterdir():
+                if path.is_dir():
+                    shutil.rmtree(path)
+            self._load()
+
+
+    @property
+    def stats(self) -> dict:
+        """Number of texts found in the cache (hits), tokenized (misses) and the cache size."""
+        return {"hits": self.hits,
+                "misses": self.misses,
+                "texts": len(self.index_hashes),
+                "bytes": self.size() if self.cache_dir.exists() else 0}
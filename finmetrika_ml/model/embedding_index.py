@@ -0,0 +1,367 @@
+import json
+import time
+from pathlib import Path
+import numpy as np
+import pandas as pd
+
+
+
+def normalize(vectors:np.ndarray) -> np.ndarray:
+    """Scale the vectors to unit length (in float32), so the dot product is the cosine similarity.
+
+    Args:
+        vectors (np.ndarray): Vectors of size [n, dim].
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    norms = np.linalg.norm(vectors, axis=-1, keepdims=True)
+    return vectors / np.maximum(norms, 1e-12)
+
+
+
+def _merge_topk(scores:np.ndarray, indices:np.ndarray, new_scores:np.ndarray, new_indices:np.ndarray, k:int):
+    """Keep the k highest scores (sorted, descending) of the current and the new candidates."""
+    scores = np.concatenate([scores, new_scores], axis=1)
+    indices = np.concatenate([indices, new_indices], axis=1)
+    if scores.shape[1] > k:
+        top = np.argpartition(-scores, k - 1, axis=1)[:, :k]
+        scores, indices = np.take_along_axis(scores, top, 1), np.take_along_axis(indices, top, 1)
+    order = np.argsort(-scores, axis=1, kind='stable')
+    return np.take_along_axis(scores, order, 1), np.take_along_axis(indices, order, 1)
+
+
+
+def topk_cosine(queries:np.ndarray,
+                vectors:np.ndarray,
+                k:int=10,
+                block_size:int=65_536,
+                query_batch_size:int=1_024) -> tuple:
+    """Exact top-k cosine similarity search with blocked matrix multiplies: the similarities
+    are computed for a batch of queries against a block of vectors at a time, so memory is
+    bounded by query_batch_size x block_size no matter how many vectors there are.
+
+    Args:
+        queries (np.ndarray): Query vectors of size [n_queries, dim].
+        vectors (np.ndarray): Normalized vectors of size [n, dim], can be memory-mapped.
+        k (int, optional): Number of neighbours. Defaults to 10.
+        block_size (int, optional): Number of vectors per matrix multiply. Defaults to 65_536.
+        query_batch_size (int, optional): Number of queries per matrix multiply. Defaults to 1_024.
+
+    Returns:
+        tuple: Similarities and indices of the neighbours, both of size [n_queries, min(k, n)].
+    """
+    queries = normalize(queries)
+    k = min(k, len(vectors))
+    all_scores = np.empty((len(queries), k), dtype=np.float32)
+    all_indices = np.empty((len(queries), k), dtype=np.int64)
+
+    for q_start in range(0, len(queries), query_batch_size):
+        q = queries[q_start:q_start+query_batch_size]
+        scores = np.empty((len(q), 0), dtype=np.float32)
+        indices = np.empty((len(q), 0), dtype=np.int64)
+        for v_start in range(0, len(vectors), block_size):
+            sims = q @ np.asarray(vectors[v_start:v_start+block_size], dtype=np.float32).T
+            block_k = min(k, sims.shape[1])
+            top = np.argpartition(-sims, block_k - 1, axis=1)[:, :block_k]
+            scores, indices = _merge_topk(scores, indices, np.take_along_axis(sims, top, 1), top + v_start, k)
+        all_scores[q_start:q_start+len(q)] = scores
+        all_indices[q_start:q_start+len(q)] = indices
+
+    return all_scores, all_indices
+
+
+
+def _assign(vectors:np.ndarray, centroids:np.ndarray, block_size:int=65_536) -> np.ndarray:
+    """Index of the most similar centroid of every vector."""
+    return np.concatenate([np.argmax(np.asarray(vectors[i:i+block_size], dtype=np.float32) @ centroids.T, axis=1)
+                           for i in range(0, len(vectors), block_size)]) if len(vectors) else np.zeros(0, np.int64)
+
+
+
+def spherical_kmeans(vectors:np.ndarray,
+                     n_clusters:int,
+                     n_iter:int=10,
+                     seed:int=42) -> np.ndarray:
+    """K-means with cosine similarity on normalized vectors.
+
+    Args:
+        vectors (np.ndarray): Normalized vectors of size [n, dim].
+        n_clusters (int): Number of clusters.
+        n_iter (int, optional): Number of iterations. Defaults to 10.
+        seed (int, optional): Random seed. Defaults to 42.
+
+    Returns:
+        np.ndarray: Normalized centroids of size [n_clusters, dim].
+    """
+    rng = np.random.default_rng(seed)
+    vectors = np.asarray(vectors, dtype=np.float32)
+    centroids = vectors[rng.choice(len(vectors), n_clusters, replace=False)]
+
+    for _ in range(n_iter):
+        assignment = _assign(vectors, centroids)
+        order = np.argsort(assignment, kind='stable')
+        counts = np.bincount(assignment, minlength=n_clusters)
+        sums = np.zeros_like(centroids)
+        starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+        sums[counts > 0] = np.add.reduceat(vectors[order], starts[counts > 0])
+        # Re-seed the empty clusters with random vectors
+        empty = counts == 0
+        sums[empty] = vectors[rng.choice(len(vectors), int(empty.sum()), replace=False)]
+        centroids = normalize(sums)
+
+    return centroids
+
+
+
+class EmbeddingIndex:
+    """Nearest neighbour index over (transaction) embeddings with cosine similarity, e.g. to
+    label new merchants with the labels of the most similar labelled transactions.
+
+    The search is exact (blocked matrix multiplies over all the vectors) unless the index is
+    built with an inverted file (IVF): the vectors are clustered with k-means and a query is
+    compared only to the vectors of the 'n_probes' most similar clusters. The vectors are
+    stored sorted by cluster, so every cluster is a contiguous slice of the (memory-mapped) array.
+
+    Args:
+        vectors (np.ndarray): Embeddings of size [n, dim], e.g. EmbeddingShards(...).to_numpy().
+        labels (array-like, optional): Label of every vector. Defaults to None.
+        dtype (str, optional): Storage type of the normalized vectors, 'float16' halves the
+            memory. Defaults to 'float32'.
+
+    Examples:
+        index = EmbeddingIndex(train_embeddings, labels=dataset['train']['label'])
+        index.build_ivf(n_lists=1024)
+        index.recall_report(valid_embeddings[:1000], k=10, n_probes=[1, 8, 32])
+        labels = index.predict(valid_embeddings, k=10, n_probes=8)
+        index.save('index/train')
+        index = EmbeddingIndex.load('index/train')
+    """
+    def __init__(self,
+                 vectors:np.ndarray,
+                 labels=None,
+                 dtype:str='float32') -> None:
+        self.vectors = normalize(vectors).astype(dtype, copy=False)
+        self.ids = np.arange(len(self.vectors), dtype=np.int64)
+        self.centroids = None
+        self.list_offsets = None
+        if labels is not None:
+            codes, categories = pd.factorize(pd.Series(labels))
+            self.label_codes, self.label_categories = codes.astype(np.int32), categories.tolist()
+        else:
+            self.label_codes, self.label_categories = None, None
+
+
+    def __len__(self):
+        return len(self.vectors)
+
+
+    @property
+    def n_lists(self) -> int:
+        return 0 if self.centroids is None else len(self.centroids)
+
+
+    def build_ivf(self,
+                  n_lists:int=None,
+                  n_iter:int=10,
+                  sample_size:int=None,
+                  seed:int=42):
+        """Cluster the vectors with spherical k-means for approximate search.
+
+        Args:
+            n_lists (int, optional): Number of clusters. Defaults to None, 4 * sqrt(n).
+            n_iter (int, optional): Number of k-means iterations. Defaults to 10.
+            sample_size (int, optional): Number of vectors k-means is trained on. Defaults to
+                None, 256 per cluster.
+            seed (int, optional): Random seed. Defaults to 42.
+        """
+        n_lists = min(n_lists or int(4 * np.sqrt(len(self))), len(self))
+        sample_size = min(sample_size or 256 * n_lists, len(self))
+        sample = np.random.default_rng(seed).choice(len(self), sample_size, replace=False)
+        self.centroids = spherical_kmeans(self.vectors[np.sort(sample)], n_lists, n_iter, seed)
+
+        # Sort the vectors (and their ids) by cluster
+        assignment = _assign(self.vectors, self.centroids)
+        order = np.argsort(assignment, kind='stable')
+        self.vectors, self.ids = self.vectors[order], self.ids[order]
+        self.list_offsets = np.concatenate([[0], np.cumsum(np.bincount(assignment, minlength=n_lists))])
+
+        return self
+
+
+    def _search_ivf(self, queries:np.ndarray, k:int, n_probes:int) -> tuple:
+        n_probes = min(n_probes, self.n_lists)
+        _, probes = topk_cosine(queries, self.centroids, k=n_probes)
+
+        scores = np.full((len(queries), k), -np.inf, dtype=np.float32)
+        indices = np.full((len(queries), k), -1, dtype=np.int64)
+        # Every cluster is compared at once to all the queries probing it
+        probe_list = probes.ravel()
+        probe_query = np.repeat(np.arange(len(queries)), n_probes)
+        order = np.argsort(probe_list, kind='stable')
+        probe_list, probe_query = probe_list[order], probe_query[order]
+        bounds = np.searchsorted(probe_list, np.arange(self.n_lists + 1))
+
+        for l in np.unique(probe_list):
+            start, stop = self.list_offsets[l], self.list_offsets[l + 1]
+            if start == stop:
+                continue
+            q = probe_query[bounds[l]:bounds[l + 1]]
+            sims = queries[q] @ np.asarray(self.vectors[start:stop], dtype=np.float32).T
+            list_k = min(k, sims.shape[1])
+            top = np.argpartition(-sims, list_k - 1, axis=1)[:, :list_k]
+            scores[q], indices[q] = _merge_topk(scores[q], indices[q], np.take_along_axis(sims, top, 1), top + start, k)
+
+        return scores, indices
+
+
+    def search(self,
+               queries:np.ndarray,
+               k:int=10,
+               n_probes:int=None,
+               query_batch_size:int=1_024) -> tuple:
+        """Find the k most similar vectors of every query.
+
+        Args:
+            queries (np.ndarray): Query vectors of size [n_queries, dim].
+            k (int, optional): Number of neighbours. Defaults to 10.
+            n_probes (int, optional): Number of clusters searched per query. Defaults to None,
+                exact search.
+            query_batch_size (int, optional): Number of queries searched at once. Defaults to 1_024.
+
+        Returns:
+            tuple: Cosine similarities and indices (in the order of the original vectors) of the
+                neighbours, both of size [n_queries, k]. Missing neighbours (approximate search
+                over small clusters) have index -1.
+        """
+        queries = normalize(np.atleast_2d(queries))
+        k = min(k, len(self))
+        if n_probes is None or self.centroids is None:
+            scores, positions = topk_cosine(queries, self.vectors, k, query_batch_size=query_batch_size)
+        else:
+            results = [self._search_ivf(queries[i:i+query_batch_size], k, n_probes)
+                       for i in range(0, len(queries), query_batch_size)]
+            scores = np.concatenate([r[0] for r in results]) if results else np.empty((0, k), np.float32)
+            positions = np.concatenate([r[1] for r in results]) if results else np.empty((0, k), np.int64)
+
+        indices = np.where(positions >= 0, self.ids[np.maximum(positions, 0)], -1)
+        return scores, indices
+
+
+    def predict(self,
+                queries:np.ndarray,
+                k:int=10,
+                n_probes:int=None) -> np.ndarray:
+        """Label of every query: vote of the labels of its k neighbours weighted by similarity.
+
+        Args:
+            queries (np.ndarray): Query vectors of size [n_queries, dim].
+            k (int, optional): Number of neighbours. Defaults to 10.
+            n_probes (int, optional): See search(). Defaults to None.
+
+        Returns:
+            np.ndarray: Predicted labels.
+        """
+        if self.label_codes is None:
+            raise ValueError('The index was built without labels.')
+
+        scores, indices = self.search(queries, k, n_probes)
+        found = indices >= 0
+        codes = self.label_codes[np.maximum(indices, 0)]
+        votes = np.zeros((len(indices), len(self.label_categories)), dtype=np.float64)
+        np.add.at(votes, (np.repeat(np.arange(len(indices)), indices.shape[1])[found.ravel()], codes[found]),
+                  np.maximum(scores[found], 0) + 1e-6)
+
+        return np.asarray(self.label_categories, dtype=object)[votes.argmax(axis=1)]
+
+
+    def recall(self,
+               queries:np.ndarray,
+               k:int=10,
+               n_probes:int=1) -> float:
+        """Fraction of the exact k nearest neighbours found by the approximate search.
+
+        Args:
+            queries (np.ndarray): Query vectors of size [n_queries, dim].
+            k (int, optional): Number of neighbours. Defaults to 10.
+            n_probes (int, optional): Number of clusters searched per query. Defaults to 1.
+        """
+        _, exact = self.search(queries, k)
+        _, approx = self.search(queries, k, n_probes)
+        return float(np.mean([len(np.intersect1d(e, a)) / len(e) for e, a in zip(exact, approx)]))
+
+
+    def recall_report(self,
+                      queries:np.ndarray,
+                      k:int=10,
+                      n_probes:list=(1, 2, 4, 8, 16, 32)) -> pd.DataFrame:
+        """Recall and throughput of the approximate search for several numbers of probes,
+        compared to the exact search.
+
+        Args:
+            queries (np.ndarray): Query vectors of size [n_queries, dim].
+            k (int, optional): Number of neighbours. Defaults to 10.
+            n_probes (list, optional): Numbers of probes. Defaults to (1, 2, 4, 8, 16, 32).
+
+        Returns:
+            pd.DataFrame: Recall@k and queries/s, the first row is the exact search.
+        """
+        start = time.perf_counter()
+        _, exact = self.search(queries, k)
+        rows = [{"n_probes": None, "recall": 1.0, "queries_per_sec": len(queries) / (time.perf_counter() - start)}]
+
+        for p in n_probes:
+            if self.centroids is None:
+                break
+            start = time.perf_counter()
+            _, approx = self.search(queries, k, p)
+            run_time = time.perf_counter() - start
+            recall = np.mean([len(np.intersect1d(e, a)) / len(e) for e, a in zip(exact, approx)])
+            rows.append({"n_probes": p, "recall": float(recall), "queries_per_sec": len(queries) / run_time})
+
+        return pd.DataFrame(rows)
+
+
+    def save(self, path:Path):
+        """Save the index as .npy files which load() memory-maps.
+
+        Args:
+            path (Path): Directory of the index.
+        """
+        path = Path(path)
+        path.mkdir(parents=True, exist_ok=True)
+        arrays = {"vectors": self.vectors, "ids": self.ids, "centroids": self.centroids,
+                  "list_offsets": self.list_offsets, "label_codes": self.label_codes}
+        for name, arr in arrays.items():
+            if arr is not None:
+                np.save(path / f'{name}.npy', arr)
+        with open(path / 'index.json', 'w') as f:
+            json.dump({"n_vectors": len(self), "n_lists": self.n_lists,
+                       "label_categories": self.label_categories}, f, indent=2, default=str)
+
+
+    @classmethod
+    def load(cls, path:Path, mmap:bool=True):
+        """Load an index saved with save().
+
+        Args:
+            path (Path): Directory of the index.
+            mmap (bool, optional): Memory-map the vectors instead of reading them. Defaults to True.
+        """
+        path = Path(path)
+        with open(path / 'index.json') as f:
+            meta = json.load(f)
+
+        index = cls.__new__(cls)
+        mmap_mode = 'r' if mmap else None
+        def load_array(name):
+            file = path / f'{name}.npy'
+            return np.load(file, mmap_mode=mmap_mode) if file.exists() else None
+
+        index.vectors = load_array('vectors')
+        index.ids = np.asarray(load_array('ids'))
+        index.centroids = load_array('centroids')
+        index.centroids = None if index.centroids is None else np.asarray(index.centroids, dtype=np.float32)
+        index.list_offsets = load_array('list_offsets')
+        index.label_codes = load_array('label_codes')
+        index.label_categories = meta["label_categories"]
+
+        return index
@@ -0,0 +1,190 @@
+import os
+import json
+import time
+from pathlib import Path
+import numpy as np
+import torch
+from datasets import Dataset
+from transformers import PreTrainedModel, PreTrainedTokenizerBase
+from finmetrika_ml.data.data_processing import (count_tokens, pool_hidden_states, TRXTensorDataset,
+                                                LengthBucketSampler, DynamicPaddingCollator)
+
+
+
+def _write_json(path:Path, obj:dict):
+    """Write the json file atomically, a crash never leaves a partially written file."""
+    tmp_path = Path(f'{path}.tmp')
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f, indent=2)
+    os.replace(tmp_path, path)
+
+
+
+def extract_embeddings(dataset_split:Dataset,
+                       model:PreTrainedModel,
+                       tokenizer:PreTrainedTokenizerBase,
+                       output_dir:Path,
+                       pooling:str='cls',
+                       dtype:str='float16',
+                       shard_size:int=100_000,
+                       batch_size:int=256,
+                       device:str='cpu',
+                       verbose:bool=True,
+                       metadata:dict=None):
+    """Extract the embeddings (pooled last hidden states) of a tokenized dataset to fixed size
+    shards of memory-mapped .npy files, so memory is bounded by one batch no matter how large
+    the dataset is. A shard is renamed to its final name and added to 'manifest.json' only when
+    it is complete, so a restarted job continues after the last complete shard.
+
+    Within a shard the samples are batched by token length and padded dynamically
+    (see LengthBucketSampler), the embeddings are written back in the order of the dataset.
+
+    Args:
+        dataset_split (Dataset): Tokenized dataset split including "input_ids" and "attention_mask".
+        model (PreTrainedModel): The (base) model, e.g. AutoModel.from_pretrained(...).
+        tokenizer (PreTrainedTokenizerBase): The tokenizer corresponding to the model.
+        output_dir (Path): Directory of the shards and the manifest.
+        pooling (str, optional): 'cls' or 'mean', see pool_hidden_states(). Defaults to 'cls'.
+        dtype (str, optional): 'float16' or 'float32'. Defaults to 'float16'.
+        shard_size (int, optional): Number of rows per shard. Defaults to 100_000.
+        batch_size (int, optional): Number of rows per forward pass. Defaults to 256.
+        device (str, optional): Device to run the model on. Defaults to 'cpu'.
+        verbose (bool, optional): Print the progress. Defaults to True.
+        metadata (dict, optional): Json serializable description of the inputs stored with the
+            configuration, e.g. a fingerprint of the dataset. Defaults to None.
+
+    Returns:
+        EmbeddingShards: The extracted embeddings.
+
+    Examples:
+        embeddings = extract_embeddings(dataset_enc['train'], model, tokenizer, 'embeddings/train', pooling='mean')
+        embeddings[:10]
+    """
+    if dtype not in ('float16', 'float32'):
+        raise ValueError(f"Unknown dtype: {dtype}. Use 'float16' or 'float32'.")
+
+    output_dir = Path(output_dir)
+    output_dir.mkdir(parents=True, exist_ok=True)
+    base_model = getattr(model, 'base_model', model).to(device).eval()
+
+    config = {"model": getattr(model.config, 'name_or_path', '') or type(model).__name__,
+              "n_rows": len(dataset_split),
+              "hidden_size": model.config.hidden_size,
+              "pooling": pooling,
+              "dtype": dtype,
+              "shard_size": shard_size}
+    if metadata is not None:
+        config["metadata"] = metadata
+
+    manifest_path = output_dir / 'manifest.json'
+    if manifest_path.exists():
+        with open(manifest_path) as f:
+            manifest = json.load(f)
+        if manifest["config"] != config:
+            raise ValueError(f'{output_dir} contains embeddings extracted with a different configuration: '
+                             f'{manifest["config"]}. Use another directory.')
+    else:
+        manifest = {"config": config, "shards": []}
+        _write_json(manifest_path, manifest)
+
+    columns = [c for c in tokenizer.model_input_names if c in dataset_split.column_names]
+    collator = DynamicPaddingCollator(tokenizer.pad_token_id or 0)
+    n_shards = -(-len(dataset_split) // shard_size)
+
+    for shard in range(len(manifest["shards"]), n_shards):
+        start_time = time.perf_counter()
+        start, stop = shard * shard_size, min((shard + 1) * shard_size, len(dataset_split))
+        shard_split = dataset_split.select(range(start, stop))
+        dataset = TRXTensorDataset(shard_split, columns=columns)
+        sampler = LengthBucketSampler(count_tokens(shard_split), batch_size)
+
+        name = f'shard_{shard:05d}.npy'
+        tmp_path = output_dir / f'{name}.tmp'
+        out = np.lib.format.open_memmap(tmp_path, mode='w+', dtype=dtype,
+                                        shape=(stop - start, config["hidden_size"]))
+        with torch.inference_mode():
+            for indices in sampler:
+                inputs = {k: v.to(device) for k,v in collator(dataset.get_batch(indices)).items()}
+                last_hidden_state = base_model(**inputs).last_hidden_state
+                pooled = pool_hidden_states(last_hidden_state, inputs.get('attention_mask'), pooling)
+                out[indices] = pooled.float().cpu().numpy()
+        out.flush()
+        del out
+        os.replace(tmp_path, output_dir / name)
+
+        manifest["shards"].append({"file": name, "start": start, "n_rows": stop - start})
+        _write_json(manifest_path, manifest)
+
+        if verbose:
+            run_time = time.perf_counter() - start_time
+            print(f'Shard {shard + 1}/{n_shards}: {stop - start:,} rows in {run_time:.1f}s',
+                  f'({(stop - start) / run_time:,.0f} rows/s)')
+
+    return EmbeddingShards(output_dir)
+
+
+
+class EmbeddingShards:
+    """Read the embeddings written by extract_embeddings(). The shards are memory-mapped, rows
+    are read from disk only when they are indexed.
+
+    Args:
+        output_dir (Path): Directory of the shards and the manifest.
+
+    Examples:
+        embeddings = EmbeddingShards('embeddings/train')
+        embeddings[[0, 5, 150_000]]
+        X = embeddings.to_numpy()
+    """
+    def __init__(self, output_dir:Path):
+        self.output_dir = Path(output_dir)
+        with open(self.output_dir / 'manifest.json') as f:
+            self.manifest = json.load(f)
+        self.config = self.manifest["config"]
+        self.shards = [np.load(self.output_dir / s["file"], mmap_mode='r') for s in self.manifest["shards"]]
+        self.starts = np.array([s["start"] for s in self.manifest["shards"]], dtype=np.int64)
+        self.n_rows = sum(s["n_rows"] for s in self.manifest["shards"])
+
+
+    @property
+    def complete(self) -> bool:
+        """Whether all the rows of the dataset were extracted."""
+        return self.n_rows == self.config["n_rows"]
+
+
+    @property
+    def shape(self) -> tuple:
+        return (self.n_rows, self.config["hidden_size"])
+
+
+    def __len__(self):
+        return self.n_rows
+
+
+    def __getitem__(self, idx) -> np.ndarray:
+        if isinstance(idx, (int, np.integer)):
+            if not -self.n_rows <= idx < self.n_rows:
+                raise IndexError(f'Index {idx} out of range for {self.n_rows} rows.')
+            idx = idx % self.n_rows
+            shard = int(np.searchsorted(self.starts, idx, side='right')) - 1
+            return np.asarray(self.shards[shard][idx - self.starts[shard]])
+
+        idx = np.arange(self.n_rows)[idx] if isinstance(idx, slice) else np.asarray(idx, dtype=np.int64)
+        out = np.empty((len(idx), self.config["hidden_size"]), dtype=self.config["dtype"])
+        shard = np.searchsorted(self.starts, idx, side='right') - 1
+        for s in np.unique(shard):
+            mask = shard == s
+            out[mask] = self.shards[s][idx[mask] - self.starts[s]]
+        return out
+
+
+    def iter_shards(self):
+        """Iterate over the memory-mapped shards, e.g. to process the embeddings out of core."""
+        yield from self.shards
+
+
+    def to_numpy(self) -> np.ndarray:
+        """All the embeddings in one array in memory."""
+        if not self.shards:
+            return np.empty((0, self.config["hidden_size"]), dtype=self.config["dtype"])
+        return np.concatenate(self.shards)
@@ -1,3 +1,5 @@
+import numpy as np
+import pandas as pd
 import torch
 from datasets import DatasetDict
 from transformers import PreTrainedTokenizerBase
@@ -7,7 +9,8 @@ from transformers import PreTrainedTokenizerBase
 def fwd_pass(data_sample:DatasetDict,
              model,
              device:str,
-             tokenizer:PreTrainedTokenizerBase):
+             tokenizer:PreTrainedTokenizerBase,
+             return_logits:bool=False):
     
     #predictions = []
     
@@ -21,9 +24,185 @@ def fwd_pass(data_sample:DatasetDict,
         pred_label = torch.argmax(output.logits, axis=-1)
         #predictions.extend(pred_label)
     
+    if return_logits:
+        return {"predicted_label": pred_label.cpu().numpy(), "logits": output.logits.float().cpu().numpy()}
     return {"predicted_label": pred_label.cpu().numpy()}
 
 
 
-def accuracy_metrics():
-    pass
\ No newline at end of file
+def _to_numpy(values) -> np.ndarray:
+    if isinstance(values, torch.Tensor):
+        return values.detach().cpu().numpy()
+    return np.asarray(values)
+
+
+
+class StreamingMetrics:
+    """Classification metrics accumulated batch by batch in a confusion matrix, so memory is
+    O(num_classes^2) no matter how many samples are scored. Every update is a single
+    np.bincount over the batch. Accumulators of different workers (processes, shards of the
+    data) are merged with merge() or +, and are plain NumPy arrays, so they can be pickled or
+    saved with to_dict().
+
+    Args:
+        num_classes (int): Number of classes, labels are 0, ..., num_classes - 1.
+        top_k (tuple, optional): k of the top-k accuracies, computed from the scores (logits).
+            Defaults to (1, 5).
+        labels (list, optional): Names of the classes for the report. Defaults to None.
+
+    Examples:
+        metrics = StreamingMetrics(num_classes=len(vocab), labels=vocab.labels)
+        for batch in loader:
+            output = fwd_pass(batch, model, device, tokenizer, return_logits=True)
+            metrics.update(batch['label'], logits=output['logits'])
+        metrics.compute()['macro_f1']
+        metrics.per_class()
+    """
+    def __init__(self,
+                 num_classes:int,
+                 top_k:tuple=(1, 5),
+                 labels:list=None) -> None:
+        self.num_classes = num_classes
+        self.top_k = tuple(k for k in top_k if k <= num_classes)
+        self.labels = list(labels) if labels is not None else list(range(num_classes))
+        if len(self.labels) != num_classes:
+            raise ValueError(f'Expected {num_classes} labels, got {len(self.labels)}.')
+        self.confusion = np.zeros((num_classes, num_classes), dtype=np.int64)
+        self.top_k_correct = np.zeros(len(self.top_k), dtype=np.int64)
+        self.top_k_count = 0
+
+
+    def update(self, y_true, y_pred=None, logits=None):
+        """Add a batch.
+
+        Args:
+            y_true (array-like): True labels of size [batch_size].
+            y_pred (array-like, optional): Predicted labels, the argmax of the logits if None. Defaults to None.
+            logits (array-like, optional): Scores of size [batch_size, num_classes], needed for
+                the top-k accuracies. Defaults to None.
+        """
+        y_true = _to_numpy(y_true).astype(np.int64, copy=False).ravel()
+        if logits is not None:
+            logits = _to_numpy(logits)
+            if y_pred is None:
+                y_pred = logits.argmax(axis=1)
+        if y_pred is None:
+            raise ValueError('Either y_pred or logits is needed.')
+        y_pred = _to_numpy(y_pred).astype(np.int64, copy=False).ravel()
+
+        if len(y_true) != len(y_pred):
+            raise ValueError(f'y_true and y_pred have different lengths: {len(y_true)} and {len(y_pred)}.')
+        if len(y_true) and (min(y_true.min(), y_pred.min()) < 0 or max(y_true.max(), y_pred.max()) >= self.num_classes):
+            raise ValueError(f'Labels must be between 0 and {self.num_classes - 1}.')
+
+        self.confusion += np.bincount(y_true * self.num_classes + y_pred,
+                                      minlength=self.num_classes ** 2).reshape(self.num_classes, self.num_classes)
+
+        if logits is not None and self.top_k:
+            # Rank of the true class: number of classes with a higher score
+            true_scores = np.take_along_axis(logits, y_true[:, None], axis=1)
+            rank = (logits > true_scores).sum(axis=1)
+            self.top_k_correct += (rank[:, None] < np.array(self.top_k)[None, :]).sum(axis=0)
+            self.top_k_count += len(y_true)
+
+        return self
+
+
+    def merge(self, other:'StreamingMetrics'):
+        """Add the counts of another accumulator (e.g. of another worker)."""
+        if other.num_classes != self.num_classes or other.top_k != self.top_k:
+            raise ValueError('Cannot merge metrics with different classes or top-k.')
+        self.confusion += other.confusion
+        self.top_k_correct += other.top_k_correct
+        self.top_k_count += other.top_k_count
+        return self
+
+
+    def __add__(self, other:'StreamingMetrics'):
+        return StreamingMetrics.from_dict(self.to_dict()).merge(other)
+
+
+    def __iadd__(self, other:'StreamingMetrics'):
+        return self.merge(other)
+
+
+    @property
+    def n_samples(self) -> int:
+        return int(self.confusion.sum())
+
+
+    def per_class(self) -> pd.DataFrame:
+        """Precision, recall, F1 and support (number of true samples) of every class."""
+        tp = np.diag(self.confusion).astype(np.float64)
+        predicted = self.confusion.sum(axis=0)
+        support = self.confusion.sum(axis=1)
+        with np.errstate(divide='ignore', invalid='ignore'):
+            precision = np.where(predicted > 0, tp / predicted, 0.0)
+            recall = np.where(support > 0, tp / support, 0.0)
+            f1 = np.where(precision + recall > 0, 2 * precision * recall / (precision + recall), 0.0)
+
+        return pd.DataFrame({"precision": precision, "recall": recall, "f1": f1, "support": support},
+                            index=pd.Index(self.labels, name='label'))
+
+
+    def compute(self) -> dict:
+        """Accuracy, macro and weighted (by support) precision, recall and F1, and top-k accuracies."""
+        per_class = self.per_class()
+        support = per_class['support'].to_numpy()
+        weights = support / support.sum() if support.sum() else np.zeros(len(support))
+
+        metrics = {"n_samples": self.n_samples,
+                   "accuracy": float(np.trace(self.confusion) / self.n_samples) if self.n_samples else 0.0}
+        for name in ('precision', 'recall', 'f1'):
+            metrics[f'macro_{name}'] = float(per_class[name].mean())
+            metrics[f'weighted_{name}'] = float((per_class[name].to_numpy() * weights).sum())
+        for k, correct in zip(self.top_k, self.top_k_correct):
+            metrics[f'top_{k}_accuracy'] = float(correct / self.top_k_count) if self.top_k_count else float('nan')
+
+        return metrics
+
+
+    def reset(self):
+        self.confusion[:] = 0
+        self.top_k_correct[:] = 0
+        self.top_k_count = 0
+
+
+    def to_dict(self) -> dict:
+        """State of the accumulator, json serializable."""
+        return {"num_classes": self.num_classes,
+                "top_k": list(self.top_k),
+                "labels": self.labels,
+                "confusion": self.confusion.tolist(),
+                "top_k_correct": self.top_k_correct.tolist(),
+                "top_k_count": self.top_k_count}
+
+
+    @classmethod
+    def from_dict(cls, state:dict):
+        """Accumulator from the state of to_dict()."""
+        metrics = cls(state["num_classes"], tuple(state["top_k"]), state["labels"])
+        metrics.confusion += np.asarray(state["confusion"], dtype=np.int64)
+        metrics.top_k_correct += np.asarray(state["top_k_correct"], dtype=np.int64)
+        metrics.top_k_count = state["top_k_count"]
+        return metrics
+
+
+
+def accuracy_metrics(y_true,
+                     y_pred,
+                     num_classes:int=None,
+                     labels:list=None) -> dict:
+    """Accuracy, precision, recall and F1 (macro and weighted) of the predictions, see
+    StreamingMetrics to accumulate them batch by batch.
+
+    Args:
+        y_true (array-like): True labels.
+        y_pred (array-like): Predicted labels, e.g. "predicted_label" of fwd_pass().
+        num_classes (int, optional): Number of classes. Defaults to None, the largest label + 1.
+        labels (list, optional): Names of the classes. Defaults to None.
+    """
+    y_true, y_pred = _to_numpy(y_true), _to_numpy(y_pred)
+    if num_classes is None:
+        num_classes = int(max(y_true.max(initial=-1), y_pred.max(initial=-1))) + 1
+    return StreamingMetrics(num_classes, top_k=(), labels=labels).update(y_true, y_pred).compute()
\ No newline at end of file
@@ -0,0 +1,277 @@
+import time
+import hashlib
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import torch
+from transformers import PreTrainedModel, PreTrainedTokenizerBase
+from finmetrika_ml.data.data_cleaning import CachedCleaner
+from finmetrika_ml.data.data_processing import pool_hidden_states, LengthBucketSampler, DynamicPaddingCollator
+
+
+
+def model_fingerprint(model:PreTrainedModel) -> str:
+    """Hash of the model configuration and all its parameters, changes whenever the model is
+    retrained or fine tuned.
+
+    Args:
+        model (PreTrainedModel): The model.
+    """
+    h = hashlib.sha1(type(model).__name__.encode('utf-8'))
+    if hasattr(model, 'config'):
+        h.update(model.config.to_json_string().encode('utf-8'))
+    for name, tensor in model.state_dict().items():
+        h.update(name.encode('utf-8'))
+        h.update(tensor.detach().cpu().contiguous().view(-1).view(torch.uint8).numpy().tobytes())
+    return h.hexdigest()[:16]
+
+
+
+def input_hashes(input_ids:list) -> np.ndarray:
+    """64-bit hash of the input ids of every sample.
+
+    Args:
+        input_ids (list): Input ids (lists or arrays of ints) of every sample.
+    """
+    return np.fromiter((int.from_bytes(hashlib.blake2b(np.asarray(ids, dtype=np.int64).tobytes(),
+                                                       digest_size=8).digest(), 'little')
+                        for ids in input_ids), dtype=np.uint64, count=len(input_ids))
+
+
+
+class ResultCache:
+    """Persistent cache of model outputs keyed by the hash of the inputs. Outputs are rows of
+    fixed width stored in append-only .npy segments, memory-mapped on load.
+
+    Args:
+        cache_dir (Path): Directory of the cache, one per model and output.
+    """
+    def __init__(self, cache_dir:Path):
+        self.cache_dir = Path(cache_dir)
+        self.segments = []
+        for path in sorted(self.cache_dir.glob('*_hashes.npy')):
+            name = path.name[:-len('_hashes.npy')]
+            self.segments.append((np.load(path, mmap_mode='r'),
+                                  np.load(self.cache_dir / f'{name}_values.npy', mmap_mode='r')))
+        self._build_index()
+
+
+    def _build_index(self):
+        if self.segments:
+            hashes = np.concatenate([h for h, _ in self.segments])
+            segment = np.concatenate([np.full(len(h), i, dtype=np.int64) for i, (h, _) in enumerate(self.segments)])
+            row = np.concatenate([np.arange(len(h)) for h, _ in self.segments])
+        else:
+            hashes, segment, row = np.zeros(0, np.uint64), np.zeros(0, np.int64), np.zeros(0, np.int64)
+        order = np.argsort(hashes, kind='stable')
+        self.index_hashes, self.index_segment, self.index_row = hashes[order], segment[order], row[order]
+
+
+    def __len__(self):
+        return len(self.index_hashes)
+
+
+    def get(self, hashes:np.ndarray) -> tuple:
+        """Look up the outputs of the hashes.
+
+        Returns:
+            tuple: Boolean mask of the hashes found and their outputs (of the found hashes only).
+        """
+        if len(self.index_hashes) == 0:
+            return np.zeros(len(hashes), dtype=bool), None
+
+        pos = np.minimum(np.searchsorted(self.index_hashes, hashes), len(self.index_hashes) - 1)
+        found = self.index_hashes[pos] == hashes
+        segment, row = self.index_segment[pos[found]], self.index_row[pos[found]]
+
+        first_values = self.segments[0][1]
+        values = np.empty((int(found.sum()),) + first_values.shape[1:], dtype=first_values.dtype)
+        for s in np.unique(segment):
+            mask = segment == s
+            values[mask] = self.segments[s][1][row[mask]]
+        return found, values
+
+
+    def put(self, hashes:np.ndarray, values:np.ndarray):
+        """Add the outputs of new inputs as a new segment."""
+        if len(hashes) == 0:
+            return
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        name = f'{time.time_ns():x}'
+        # The hashes are written last, a segment without hashes is never loaded
+        np.save(self.cache_dir / f'{name}_values.npy', values)
+        np.save(self.cache_dir / f'{name}_hashes.npy', hashes)
+        self.segments.append((np.load(self.cache_dir / f'{name}_hashes.npy', mmap_mode='r'),
+                              np.load(self.cache_dir / f'{name}_values.npy', mmap_mode='r')))
+        self._build_index()
+
+
+
+class UniqueInference:
+    """Run the model only once per distinct input. The texts are cleaned (optional), duplicate
+    texts are dropped, the unique texts are tokenized and texts with the same input ids (e.g.
+    differing only in casing for an uncased tokenizer) are merged. The model runs on the unique
+    inputs in length-bucketed, dynamically padded batches and the outputs are scattered back
+    to every row. With 'cache_dir' the outputs are also kept on disk across jobs, keyed by the
+    model fingerprint and the input ids.
+
+    Args:
+        model (PreTrainedModel): Model for sequence classification ('predicted_label', 'logits')
+            or any model with a base model ('feature_vector').
+        tokenizer (PreTrainedTokenizerBase): The tokenizer corresponding to the model.
+        output (str, optional): 'predicted_label', 'logits' or 'feature_vector'. Defaults to 'predicted_label'.
+        pooling (str, optional): Pooling of the feature vectors, see pool_hidden_states(). Defaults to 'cls'.
+        cleaner (optional): Function or list of data cleaning functions applied to the texts
+            first, see CachedCleaner. Defaults to None.
+        max_length (int, optional): Truncate the inputs to max_length tokens. Defaults to None.
+        batch_size (int, optional): Number of unique inputs per forward pass. Defaults to 256.
+        device (str, optional): Device to run the model on. Defaults to 'cpu'.
+        cache_dir (Path, optional): Directory of the persistent result cache. Defaults to None.
+
+    Examples:
+        infer = UniqueInference(model, tokenizer, cleaner=cleaning_pipelines['default'],
+                                max_length=64, cache_dir='cache/predictions')
+        df['predicted_label'] = infer(df['text'])['predicted_label']
+        infer.stats
+    """
+    outputs = ('predicted_label', 'logits', 'feature_vector')
+
+    def __init__(self,
+                 model:PreTrainedModel,
+                 tokenizer:PreTrainedTokenizerBase,
+                 output:str='predicted_label',
+                 pooling:str='cls',
+                 cleaner=None,
+                 max_length:int=None,
+                 batch_size:int=256,
+                 device:str='cpu',
+                 cache_dir:Path=None) -> None:
+        if output not in self.outputs:
+            raise ValueError(f'Unknown output: {output}. Choose from {self.outputs}.')
+
+        self.model = model.to(device).eval()
+        self.tokenizer = tokenizer
+        self.output = output
+        self.pooling = pooling
+        self.cleaner = CachedCleaner(cleaner) if cleaner is not None else None
+        self.max_length = max_length
+        self.batch_size = batch_size
+        self.device = device
+        self.cache = None
+        if cache_dir is not None:
+            key = model_fingerprint(model) + (f'_{output}' if output != 'feature_vector' else f'_{output}_{pooling}')
+            self.cache = ResultCache(Path(cache_dir) / key)
+        self.stats = {}
+
+
+    def _forward(self, input_ids:list) -> np.ndarray:
+        """Outputs of the model for the (unique) input ids, in their order."""
+        collator = DynamicPaddingCollator(self.tokenizer.pad_token_id or 0)
+        sampler = LengthBucketSampler([len(ids) for ids in input_ids], self.batch_size)
+        results = [None] * len(input_ids)
+        model = getattr(self.model, 'base_model', self.model) if self.output == 'feature_vector' else self.model
+
+        with torch.inference_mode():
+            for indices in sampler:
+                batch = collator([{"input_ids": torch.as_tensor(input_ids[i]),
+                                   "attention_mask": torch.ones(len(input_ids[i]), dtype=torch.long)}
+                                  for i in indices])
+                inputs = {k: v.to(self.device) for k,v in batch.items() if k in self.tokenizer.model_input_names}
+                output = model(**inputs)
+                if self.output == 'feature_vector':
+                    values = pool_hidden_states(output.last_hidden_state, inputs.get('attention_mask'), self.pooling)
+                elif self.output == 'logits':
+                    values = output.logits.float()
+                else:
+                    values = torch.argmax(output.logits, axis=-1)
+                for i, v in zip(indices, values.cpu().numpy()):
+                    results[i] = v
+
+        return np.stack(results) if results else np.empty(0)
+
+
+    def run_inputs(self, input_ids:list) -> np.ndarray:
+        """Outputs of the model for every row of tokenized inputs (without padding), running the
+        model only once per distinct input.
+
+        Args:
+            input_ids (list): Input ids of every row.
+
+        Returns:
+            np.ndarray: Output of every row.
+        """
+        start_time = time.perf_counter()
+        hashes = input_hashes(input_ids)
+        codes, unique_hashes = pd.factorize(hashes)
+        first = np.full(len(unique_hashes), -1, dtype=np.int64)
+        first[codes[::-1]] = np.arange(len(codes))[::-1]
+
+        results, cache_hits = None, 0
+        missing = np.arange(len(unique_hashes))
+        if self.cache is not None:
+            found, cached = self.cache.get(unique_hashes)
+            cache_hits = int(found.sum())
+            missing = np.flatnonzero(~found)
+            if cache_hits:
+                results = np.empty((len(unique_hashes),) + cached.shape[1:], dtype=cached.dtype)
+                results[found] = cached
+
+        if len(missing):
+            computed = self._forward([input_ids[first[i]] for i in missing])
+            if results is None:
+                results = np.empty((len(unique_hashes),) + computed.shape[1:], dtype=computed.dtype)
+            results[missing] = computed
+            if self.cache is not None:
+                self.cache.put(unique_hashes[missing], computed)
+
+        self.stats = {"rows": len(input_ids),
+                      "unique_inputs": len(unique_hashes),
+                      "cache_hits": cache_hits,
+                      "model_rows": len(missing),
+                      "reduction": len(input_ids) / max(len(missing), 1),
+                      "seconds": time.perf_counter() - start_time}
+
+        if results is None:
+            return np.empty(0)
+        return results[codes]
+
+
+    def __call__(self, texts) -> dict:
+        """Outputs of the model for every text.
+
+        Args:
+            texts (list | pd.Series): Texts.
+
+        Returns:
+            dict: Output of every row under the key 'output', e.g. {"predicted_label": ...}. Missing
+                texts get the label -1, or logits and feature vectors of NaN.
+        """
+        texts = pd.Series(texts, dtype=object).reset_index(drop=True)
+        if self.cleaner is not None:
+            texts = self.cleaner(texts)
+
+        codes, unique_texts = pd.factorize(texts)
+        input_ids = self.tokenizer(list(unique_texts), padding=False, truncation=self.max_length is not None,
+                                   max_length=self.max_length)['input_ids'] if len(unique_texts) else []
+        results = self.run_inputs(input_ids)
+        self.stats.update({"rows": len(texts),
+                           "unique_texts": len(unique_texts),
+                           "reduction": len(texts) / max(self.stats["model_rows"], 1)})
+
+        # code -1 (missing text) takes the last row
+        missing_row = self._missing_row(results)
+        results = np.concatenate([results.reshape((-1,) + missing_row.shape[1:]), missing_row])
+        return {self.output: results[codes]}
+
+
+    def _missing_row(self, results:np.ndarray) -> np.ndarray:
+        """Output of a missing text: label -1, or NaN logits and feature vectors."""
+        if len(results):
+            shape, dtype = results.shape[1:], results.dtype
+        else:
+            config = self.model.config
+            shape = {"predicted_label": (),
+                     "logits": (config.num_labels,),
+                     "feature_vector": (config.hidden_size,)}[self.output]
+            dtype = np.int64 if self.output == 'predicted_label' else np.float32
+        return np.full((1,) + shape, -1 if np.issubdtype(dtype, np.integer) else np.nan, dtype=dtype)
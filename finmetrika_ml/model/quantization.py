@@ -0,0 +1,218 @@
+import io
+import copy
+import time
+import warnings
+from pathlib import Path
+import numpy as np
+import pandas as pd
+import torch
+from datasets import Dataset
+from transformers import PreTrainedModel, PreTrainedTokenizerBase
+from transformers.modeling_outputs import SequenceClassifierOutput
+from finmetrika_ml.model.evaluation import fwd_pass
+
+
+
+def quantize_dynamic_int8(model:PreTrainedModel) -> PreTrainedModel:
+    """Copy of the model with the Linear layers quantized to int8 (dynamic quantization: the
+    weights are stored in int8, the activations are quantized on the fly). Runs on CPU only.
+    
+    torch.ao.quantization is deprecated in favour of torchao, where the same quantization is
+    torchao.quantization.quantize_(model, Int8DynamicActivationInt8WeightConfig()). It still
+    works in the supported PyTorch releases, so its deprecation warnings are silenced here.
+
+    Args:
+        model (PreTrainedModel): The fp32 model, not modified.
+    """
+    with warnings.catch_warnings():
+        # Deprecated (see above) but still supported
+        warnings.simplefilter('ignore', UserWarning)
+        warnings.simplefilter('ignore', DeprecationWarning)
+        return torch.ao.quantization.quantize_dynamic(copy.deepcopy(model).cpu().eval(),
+                                                      {torch.nn.Linear}, dtype=torch.qint8)
+
+
+
+class _LogitsModule(torch.nn.Module):
+    """Positional inputs and logits output, as required by tracing."""
+    def __init__(self, model, input_names:list):
+        super().__init__()
+        self.model = model
+        self.input_names = input_names
+
+    def forward(self, *inputs):
+        return self.model(**dict(zip(self.input_names, inputs))).logits
+
+
+
+class TracedClassifier(torch.nn.Module):
+    """TorchScript traced sequence classifier with the interface of the transformers model
+    (keyword inputs, output with 'logits'), so it works with fwd_pass.
+
+    Args:
+        traced (torch.jit.ScriptModule): Traced model returning the logits.
+        input_names (list): Names of its positional inputs.
+    """
+    def __init__(self, traced:torch.jit.ScriptModule, input_names:list):
+        super().__init__()
+        self.traced = traced
+        self.input_names = list(input_names)
+
+    def forward(self, **inputs):
+        return SequenceClassifierOutput(logits=self.traced(*[inputs[k] for k in self.input_names]))
+
+    def save(self, path:Path):
+        """Save the traced model, the input names are stored with it."""
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning)
+            torch.jit.save(self.traced, path, _extra_files={"input_names": ','.join(self.input_names)})
+
+    @classmethod
+    def load(cls, path:Path):
+        """Load a traced model saved with save()."""
+        extra_files = {"input_names": ''}
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning)
+            traced = torch.jit.load(path, map_location='cpu', _extra_files=extra_files)
+        input_names = extra_files["input_names"]
+        if isinstance(input_names, bytes):
+            input_names = input_names.decode('utf-8')
+        return cls(traced, input_names.split(','))
+
+
+
+def trace_model(model:PreTrainedModel,
+                example_inputs:dict,
+                path:Path=None) -> TracedClassifier:
+    """Export the (quantized) model to TorchScript by tracing, e.g. to score without Python
+    model code. The traced model accepts any batch size and number of tokens. The model is
+    traced on the CPU.
+    
+    TorchScript (torch.jit.trace and torch.jit.freeze) is deprecated in favour of torch.export
+    and torch.compile, but still supported, so its deprecation warnings are silenced here.
+
+    Args:
+        model (PreTrainedModel): Model for sequence classification, not modified (a CPU copy is traced).
+        example_inputs (dict): Tokenized example batch, e.g. tokenizer(texts, padding=True, return_tensors='pt').
+        path (Path, optional): Save the traced model to this file. Defaults to None.
+
+    Examples:
+        traced = trace_model(quantize_dynamic_int8(model), tokenizer(texts[:8], padding=True, return_tensors='pt'))
+        fwd_pass(batch, traced, 'cpu', tokenizer)
+    """
+    input_names = [k for k in ('input_ids', 'attention_mask', 'token_type_ids') if k in example_inputs]
+    wrapper = _LogitsModule(copy.deepcopy(model).cpu().eval(), input_names)
+    with torch.inference_mode(False), torch.no_grad(), warnings.catch_warnings():
+        warnings.simplefilter('ignore')
+        traced = torch.jit.trace(wrapper, tuple(example_inputs[k].cpu() for k in input_names),
+                                 strict=False, check_trace=False)
+        if not _is_quantized(model):
+            traced = torch.jit.freeze(traced.eval())
+    traced = TracedClassifier(traced, input_names)
+    if path is not None:
+        traced.save(path)
+    return traced
+
+
+
+def _is_quantized(model) -> bool:
+    return any('quantized' in type(m).__module__ for m in model.modules())
+
+
+
+def model_size_mb(model) -> float:
+    """Size of the serialized model (state dict) in MB."""
+    buffer = io.BytesIO()
+    if isinstance(model, TracedClassifier):
+        with warnings.catch_warnings():
+            warnings.simplefilter('ignore', FutureWarning)
+            torch.jit.save(model.traced, buffer)
+    else:
+        torch.save(model.state_dict(), buffer)
+    return buffer.getbuffer().nbytes / 2**20
+
+
+
+def _predict(model, batches:list, tokenizer:PreTrainedTokenizerBase) -> tuple:
+    """Predicted labels of all the batches and the latency of every batch in ms."""
+    predictions, latencies = [], []
+    for batch in batches:
+        start = time.perf_counter()
+        predictions.append(fwd_pass(batch, model, 'cpu', tokenizer)['predicted_label'])
+        latencies.append((time.perf_counter() - start) * 1000)
+    return np.concatenate(predictions), np.array(latencies)
+
+
+
+def compare_quantized(model:PreTrainedModel,
+                      tokenizer:PreTrainedTokenizerBase,
+                      dataset_split:Dataset,
+                      text_column_name:str='text',
+                      label_column_name:str='label',
+                      batch_size:int=64,
+                      max_length:int=128,
+                      trace:bool=True,
+                      min_agreement:float=0.99,
+                      max_accuracy_drop:float=0.005) -> pd.DataFrame:
+    """Latency and accuracy report of the fp32 model and its CPU optimized variants (int8
+    dynamic quantization, optionally TorchScript traced) on a validation split. A variant is
+    safe to deploy if its predictions agree with the fp32 predictions on at least
+    'min_agreement' of the samples and its accuracy (if the split has labels) is at most
+    'max_accuracy_drop' lower.
+
+    Args:
+        model (PreTrainedModel): The fp32 model for sequence classification, not modified
+            (a CPU copy in evaluation mode is scored).
+        tokenizer (PreTrainedTokenizerBase): The tokenizer corresponding to the model.
+        dataset_split (Dataset): Validation split with the texts (and labels).
+        text_column_name (str, optional): Column with the text. Defaults to 'text'.
+        label_column_name (str, optional): Column with the label ids. Defaults to 'label'.
+        batch_size (int, optional): Number of samples per batch. Defaults to 64.
+        max_length (int, optional): Maximum number of tokens. Defaults to 128.
+        trace (bool, optional): Include the TorchScript traced variants. Defaults to True.
+        min_agreement (float, optional): Minimum agreement with fp32. Defaults to 0.99.
+        max_accuracy_drop (float, optional): Maximum accuracy drop. Defaults to 0.005.
+
+    Returns:
+        pd.DataFrame: One row per variant: agreement, accuracy, latency per batch (p50/p99 in ms),
+            samples/s, size in MB and whether it is safe to deploy.
+
+    Examples:
+        report = compare_quantized(model, tokenizer, dataset['validation'])
+        model_int8 = quantize_dynamic_int8(model)
+    """
+    if len(dataset_split) == 0:
+        raise ValueError('The dataset split is empty, there is nothing to compare.')
+    model = copy.deepcopy(model).cpu().eval()
+    texts = dataset_split[text_column_name]
+    batches = [tokenizer(texts[i:i+batch_size], padding=True, truncation=True, max_length=max_length,
+                         return_tensors='pt')
+               for i in range(0, len(texts), batch_size)]
+    labels = np.asarray(dataset_split[label_column_name]) if label_column_name in dataset_split.column_names else None
+
+    variants = {"fp32": model, "int8": quantize_dynamic_int8(model)}
+    if trace:
+        variants["fp32_traced"] = trace_model(model, batches[0])
+        variants["int8_traced"] = trace_model(variants["int8"], batches[0])
+
+    rows, reference = [], None
+    for name, variant in variants.items():
+        # Warm up (tracing and quantization kernels)
+        _predict(variant, batches[:1], tokenizer)
+        predictions, latencies = _predict(variant, batches, tokenizer)
+        if reference is None:
+            reference = predictions
+        rows.append({"variant": name,
+                     "agreement": float((predictions == reference).mean()),
+                     "accuracy": float((predictions == labels).mean()) if labels is not None else np.nan,
+                     "latency_ms_p50": float(np.percentile(latencies, 50)),
+                     "latency_ms_p99": float(np.percentile(latencies, 99)),
+                     "samples_per_sec": len(texts) / (latencies.sum() / 1000),
+                     "size_mb": model_size_mb(variant)})
+
+    report = pd.DataFrame(rows).set_index('variant')
+    report['speedup'] = report['samples_per_sec'] / report.loc['fp32', 'samples_per_sec']
+    accuracy_drop = (report.loc['fp32', 'accuracy'] - report['accuracy']).fillna(0)
+    report['safe'] = (report['agreement'] >= min_agreement) & (accuracy_drop <= max_accuracy_drop)
+
+    return report
@@ -0,0 +1,352 @@
+import json
+import time
+import asyncio
+from collections import Counter, deque
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+from transformers import PreTrainedModel, PreTrainedTokenizerBase
+from finmetrika_ml.model.evaluation import fwd_pass
+
+
+
+class MicroBatchScorer:
+    """Score texts arriving one at a time in micro-batches. Requests are queued, a batch is
+    built until it has 'max_batch_size' texts or the first text waited 'max_wait_ms', the batch
+    is tokenized (padded to its longest text) and scored with a single fwd_pass in a worker
+    thread, and the future of every caller is resolved with its prediction. The batches are
+    scored one at a time, the model never runs in two threads at once.
+
+    metrics() reports the queue depth, the histogram of the batch sizes and the p50/p99
+    latency (from queueing to the result) of the recent requests.
+
+    Args:
+        model (PreTrainedModel): Model for sequence classification.
+        tokenizer (PreTrainedTokenizerBase): The tokenizer corresponding to the model.
+        device (str, optional): Device to run the model on. Defaults to 'cpu'.
+        max_batch_size (int, optional): Maximum number of texts per batch. Defaults to 64.
+        max_wait_ms (float, optional): Maximum wait of a text for its batch to fill. Defaults to 5.
+        max_length (int, optional): Truncate the texts to max_length tokens. Defaults to 128.
+        label_vocabulary (LabelVocabulary, optional): Decode the label ids. Defaults to None.
+        n_latencies (int, optional): Number of recent requests in the latency percentiles.
+            Defaults to 10_000.
+
+    Examples:
+        scorer = MicroBatchScorer(model, tokenizer, max_batch_size=32, max_wait_ms=2)
+        await scorer.start()
+        result = await scorer.score('KONZUM P-0123 ZAGREB')
+        scorer.metrics()
+        await scorer.stop()
+    """
+    def __init__(self,
+                 model:PreTrainedModel,
+                 tokenizer:PreTrainedTokenizerBase,
+                 device:str='cpu',
+                 max_batch_size:int=64,
+                 max_wait_ms:float=5,
+                 max_length:int=128,
+                 label_vocabulary=None,
+                 n_latencies:int=10_000) -> None:
+        self.model = model.to(device).eval()
+        self.tokenizer = tokenizer
+        self.device = device
+        self.max_batch_size = max_batch_size
+        self.max_wait_ms = max_wait_ms
+        self.max_length = max_length
+        self.label_vocabulary = label_vocabulary
+
+        self.queue = None
+        self._task = None
+        self._executor = None
+        self._in_flight = []
+        self.batch_sizes = Counter()
+        self.latencies = deque(maxlen=n_latencies)
+        self.n_requests = 0
+
+
+    async def start(self):
+        """Start the batching loop in the running event loop."""
+        if self._task is None:
+            self.queue = asyncio.Queue()
+            self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix='MicroBatchScorer')
+            self._task = asyncio.create_task(self._batch_loop())
+        return self
+
+
+    async def stop(self):
+        """Stop the batching loop, queued requests and the batch being scored are cancelled.
+        Returns once the worker thread finished scoring the batch.
+        """
+        if self._task is not None:
+            self._task.cancel()
+            try:
+                await self._task
+            except asyncio.CancelledError:
+                pass
+            self._task = None
+        for _, future, _ in self._in_flight:
+            future.cancel()
+        self._in_flight = []
+        while self.queue is not None and not self.queue.empty():
+            _, future, _ = self.queue.get_nowait()
+            future.cancel()
+        if self._executor is not None:
+            # The thread can't be interrupted, wait for the running fwd_pass
+            await asyncio.get_running_loop().run_in_executor(None, self._executor.shutdown)
+            self._executor = None
+
+
+    async def __aenter__(self):
+        return await self.start()
+
+
+    async def __aexit__(self, *args):
+        await self.stop()
+
+
+    async def score(self, text:str) -> dict:
+        """Queue a text and wait for its prediction.
+
+        Args:
+            text (str): Text of the transaction.
+
+        Returns:
+            dict: The predicted label (id, or name with label_vocabulary) under "predicted_label".
+
+        Raises:
+            TypeError: If the text is not a string.
+        """
+        if not isinstance(text, str):
+            raise TypeError(f'Expected a text (str), got {type(text).__name__}.')
+        if self._task is None:
+            raise RuntimeError('The scorer is not running. Call start() first.')
+        future = asyncio.get_running_loop().create_future()
+        await self.queue.put((text, future, time.perf_counter()))
+        return await future
+
+
+    def _predict(self, texts:list) -> list:
+        """Tokenize and score one batch (in a worker thread)."""
+        inputs = self.tokenizer(texts, padding=True, truncation=True, max_length=self.max_length,
+                                return_tensors='pt')
+        predicted = fwd_pass(inputs, self.model, self.device, self.tokenizer)['predicted_label']
+        if self.label_vocabulary is not None:
+            predicted = self.label_vocabulary.decode(predicted)
+        return predicted.tolist()
+
+
+    async def _batch_loop(self):
+        loop = asyncio.get_running_loop()
+        while True:
+            batch = [await self.queue.get()]
+            deadline = batch[0][2] + self.max_wait_ms / 1000
+            while len(batch) < self.max_batch_size:
+                timeout = deadline - time.perf_counter()
+                if timeout <= 0:
+                    # Take what is already queued without waiting
+                    if self.queue.empty():
+                        break
+                    batch.append(self.queue.get_nowait())
+                    continue
+                try:
+                    batch.append(await asyncio.wait_for(self.queue.get(), timeout))
+                except asyncio.TimeoutError:
+                    break
+
+            # Skip the requests cancelled by their callers
+            batch = [item for item in batch if not item[1].done()]
+            if not batch:
+                continue
+            self._in_flight = batch
+            try:
+                predictions = await loop.run_in_executor(self._executor, self._predict, [text for text, _, _ in batch])
+            except Exception:
+                # Score the texts one by one, the error stays with the request causing it
+                predictions = []
+                for text, future, _ in batch:
+                    try:
+                        predictions.append((await loop.run_in_executor(self._executor, self._predict, [text]))[0])
+                    except Exception as e:
+                        predictions.append(e)
+            self._in_flight = []
+
+            now = time.perf_counter()
+            self.batch_sizes[len(batch)] += 1
+            for (_, future, queued), prediction in zip(batch, predictions):
+                self.latencies.append(now - queued)
+                if future.done():
+                    continue
+                if isinstance(prediction, Exception):
+                    future.set_exception(prediction)
+                else:
+                    future.set_result({"predicted_label": prediction})
+            self.n_requests += len(batch)
+
+
+    def metrics(self) -> dict:
+        """Queue depth, batch size histogram and latency percentiles in ms."""
+        latencies = np.array(self.latencies) * 1000 if self.latencies else np.zeros(1)
+        n_batches = sum(self.batch_sizes.values())
+        return {"queue_depth": self.queue.qsize() if self.queue is not None else 0,
+                "requests": self.n_requests,
+                "batches": n_batches,
+                "mean_batch_size": self.n_requests / n_batches if n_batches else 0.0,
+                "batch_size_histogram": dict(sorted(self.batch_sizes.items())),
+                "latency_ms_p50": float(np.percentile(latencies, 50)),
+                "latency_ms_p99": float(np.percentile(latencies, 99))}
+
+
+
+async def _read_request(reader:asyncio.StreamReader) -> tuple:
+    """Method, path, headers and body of the next HTTP/1.1 request, None at the end of the
+    connection. Raises a ValueError for a malformed request.
+    """
+    request_line = await reader.readline()
+    if not request_line:
+        return None
+    parts = request_line.decode('latin-1').split()
+    if len(parts) != 3 or not parts[2].startswith('HTTP/'):
+        raise ValueError(f'Malformed request line: {request_line[:100]!r}')
+    method, path, _ = parts
+    headers = {}
+    while (line := await reader.readline()) not in (b'\r\n', b'\n', b''):
+        key, _, value = line.decode('latin-1').partition(':')
+        headers[key.strip().lower()] = value.strip()
+    try:
+        content_length = int(headers.get('content-length', 0))
+    except ValueError:
+        raise ValueError(f'Invalid Content-Length: {headers["content-length"]!r}') from None
+    if content_length < 0:
+        raise ValueError(f'Invalid Content-Length: {content_length}')
+    body = await reader.readexactly(content_length)
+    return method, path, headers, body
+
+
+
+def _response(status:int, payload:dict, keep_alive:bool=True) -> bytes:
+    body = json.dumps(payload).encode('utf-8')
+    reason = {200: 'OK', 400: 'Bad Request', 404: 'Not Found', 500: 'Internal Server Error'}[status]
+    return (f'HTTP/1.1 {status} {reason}\r\nContent-Type: application/json\r\n'
+            f'Content-Length: {len(body)}\r\nConnection: {"keep-alive" if keep_alive else "close"}\r\n\r\n'
+            ).encode('latin-1') + body
+
+
+
+async def serve_http(scorer:MicroBatchScorer,
+                     host:str='127.0.0.1',
+                     port:int=8080) -> asyncio.AbstractServer:
+    """Minimal local HTTP/1.1 server (standard library only) in front of the scorer, a stand-in
+    for the production service to load test the batching.
+
+    POST /score with {"text": "..."} returns {"predicted_label": ...}, GET /metrics returns
+    scorer.metrics(). Connections are kept alive.
+
+    Args:
+        scorer (MicroBatchScorer): The scorer, started by the server if needed.
+        host (str, optional): Host address. Defaults to '127.0.0.1'.
+        port (int, optional): Port, 0 for any free port. Defaults to 8080.
+
+    Returns:
+        asyncio.AbstractServer: The running server, server.sockets[0].getsockname() has the port.
+
+    Examples:
+        async def main():
+            server = await serve_http(MicroBatchScorer(model, tokenizer), port=8080)
+            async with server:
+                await server.serve_forever()
+        asyncio.run(main())
+    """
+    await scorer.start()
+
+    async def handle(reader, writer):
+        try:
+            while True:
+                try:
+                    request = await _read_request(reader)
+                except ValueError as e:
+                    # The rest of the stream cannot be parsed, close the connection
+                    writer.write(_response(400, {"error": str(e)}, keep_alive=False))
+                    await writer.drain()
+                    break
+                if request is None:
+                    break
+                method, path, headers, body = request
+                keep_alive = headers.get('connection', '').lower() != 'close'
+                if method == 'POST' and path == '/score':
+                    try:
+                        text = json.loads(body)['text']
+                        if not isinstance(text, str):
+                            raise TypeError
+                    except (ValueError, KeyError, TypeError):
+                        writer.write(_response(400, {"error": 'Expected {"text": "..."}'}, keep_alive))
+                    else:
+                        try:
+                            writer.write(_response(200, await scorer.score(text), keep_alive))
+                        except Exception as e:
+                            writer.write(_response(500, {"error": str(e)}, keep_alive))
+                elif method == 'GET' and path == '/metrics':
+                    writer.write(_response(200, scorer.metrics(), keep_alive))
+                else:
+                    writer.write(_response(404, {"error": f'{method} {path} not found'}, keep_alive))
+                await writer.drain()
+                if not keep_alive:
+                    break
+        except (ConnectionError, asyncio.IncompleteReadError):
+            pass
+        finally:
+            writer.close()
+
+    return await asyncio.start_server(handle, host, port)
+
+
+
+async def load_test(texts:list,
+                    host:str='127.0.0.1',
+                    port:int=8080,
+                    concurrency:int=32) -> dict:
+    """Send the texts to the local HTTP server from 'concurrency' clients with keep-alive
+    connections and measure the throughput and the client side latency.
+
+    Args:
+        texts (list): Texts, one request each.
+        host (str, optional): Host address. Defaults to '127.0.0.1'.
+        port (int, optional): Port of the server. Defaults to 8080.
+        concurrency (int, optional): Number of concurrent clients. Defaults to 32.
+
+    Returns:
+        dict: Number of requests, requests/s and latency percentiles in ms.
+    """
+    todo = deque(texts)
+    latencies = []
+
+    async def client():
+        reader, writer = await asyncio.open_connection(host, port)
+        try:
+            while todo:
+                body = json.dumps({"text": todo.popleft()}).encode('utf-8')
+                start = time.perf_counter()
+                writer.write(f'POST /score HTTP/1.1\r\nHost: {host}\r\nContent-Type: application/json\r\n'
+                             f'Content-Length: {len(body)}\r\n\r\n'.encode('latin-1') + body)
+                await writer.drain()
+                headers = {}
+                status = (await reader.readline()).split()[1]
+                while (line := await reader.readline()) not in (b'\r\n', b''):
+                    key, _, value = line.decode('latin-1').partition(':')
+                    headers[key.strip().lower()] = value.strip()
+                await reader.readexactly(int(headers['content-length']))
+                if status != b'200':
+                    raise RuntimeError(f'Request failed with status {status.decode()}')
+                latencies.append(time.perf_counter() - start)
+        finally:
+            writer.close()
+            await writer.wait_closed()
+
+    start = time.perf_counter()
+    await asyncio.gather(*[client() for _ in range(min(concurrency, len(texts)))])
+    run_time = time.perf_counter() - start
+    latencies = np.array(latencies) * 1000 if latencies else np.zeros(1)
+
+    return {"requests": len(texts),
+            "seconds": run_time,
+            "requests_per_sec": len(texts) / run_time if run_time > 0 else 0.0,
+            "latency_ms_p50": float(np.percentile(latencies, 50)),
+            "latency_ms_p99": float(np.percentile(latencies, 99))}
@@ -1,110 +1,541 @@
+import json
+import sys
+import time
+import queue
+import shutil
+import hashlib
+import resource
+import threading
+from pathlib import Path
+import numpy as np
 import torch
+import pyarrow as pa
 from tqdm import tqdm
 from finmetrika_ml.utils import check_device, moveTo
 from transformers import AutoTokenizer, AutoModel
 from datasets import DatasetDict
+from finmetrika_ml.model.embeddings import extract_embeddings, EmbeddingShards
+
+
+
+def _prefetch(iterable, n_batches:int):
+    """Load the next batches in a background thread while the current batch is computed. When
+    the consumer stops early (exception or break) the thread stops too and is joined, so the
+    iterator (e.g. DataLoader workers) is released.
+    """
+    if n_batches <= 0:
+        yield from iterable
+        return
+    
+    buffer = queue.Queue(maxsize=n_batches)
+    done = object()
+    stop = threading.Event()
+    
+    def put(item) -> bool:
+        """Put the item in the buffer, False if the consumer stopped."""
+        while not stop.is_set():
+            try:
+                buffer.put(item, timeout=0.1)
+                return True
+            except queue.Full:
+                pass
+        return False
+    
+    def producer():
+        # Any exception (also KeyboardInterrupt, SystemExit, ...) is passed to the consumer, 
+        # which would otherwise wait forever
+        try:
+            for item in iterable:
+                if not put(item):
+                    return
+        except BaseException as e:
+            put(e)
+            return
+        put(done)
+    
+    thread = threading.Thread(target=producer, daemon=True)
+    thread.start()
+    try:
+        while (item := buffer.get()) is not done:
+            if isinstance(item, BaseException):
+                raise item
+            yield item
+    finally:
+        stop.set()
+        thread.join()
+
+
+
+def _peak_memory_mb(device:str) -> float:
+    """Peak memory of the device (CUDA, since the last reset of the peak memory stats) or 
+    of the process since it started (CPU, resident set size, which cannot be reset)."""
+    if torch.device(device).type == 'cuda':
+        return torch.cuda.max_memory_allocated(device) / 2**20
+    # ru_maxrss is in KB on Linux and in bytes on macOS
+    maxrss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return maxrss / 2**20 if sys.platform == 'darwin' else maxrss / 2**10
 
 
 
 class TrainNN:
-    #TODO Not finished and not tested
     """Train a neural network.
     
+    Batches are either (inputs, labels) tuples, with model(inputs) and loss_fn(outputs, labels), 
+    or dictionaries (e.g. from TRXTensorDataset with DynamicPaddingCollator) passed to the model 
+    as keyword arguments: with loss_fn=None the batch includes 'labels' and the model returns 
+    the loss (transformers models), otherwise loss_fn(outputs.logits, batch['label']).
+    
+    Every epoch returns structured metrics, also kept in 'history': the mean loss, samples/s, 
+    tokens/s (real tokens of the attention mask), step latency percentiles in ms (a step is 
+    one batch, including the wait for the data), the fraction of the time spent waiting for 
+    data and the peak memory in MB. On CUDA the peak memory is the peak of the epoch, on CPU 
+    it is the peak of the process so far (resident set size, which cannot be reset per epoch), 
+    'peak_memory_scope' is 'epoch' or 'process'. 
+    
+    With gradient accumulation the loss of every batch is divided by the number of batches of 
+    its group, also for the last incomplete group of the epoch.
+    
     Args:
         model: Instantiated model class or a defined model architecture.
         training_dataloader (torch.data.utils.DataLoader): Dataloader for training.
-        loss_fn (str): Loss function
-        optimizer (): optimizer
+        loss_fn (callable): Loss function, e.g. torch.nn.CrossEntropyLoss(). None for models 
+            which compute the loss.
+        optimizer (torch.optim.Optimizer): Optimizer of the model parameters.
         num_epochs (int): Number of epochs to train.
         device (str): Device on which to train the model. Use utils.check_device().
+        grad_accumulation_steps (int, optional): Number of batches per optimizer step. Defaults to 1.
+        autocast_dtype (torch.dtype, optional): Mixed precision, e.g. torch.bfloat16 (also on 
+            CPU). Defaults to None, full precision.
+        compile (bool, optional): Compile the model with torch.compile. Defaults to False.
+        num_threads (int, optional): Number of CPU threads of torch during training, restored afterwards. 
+            Defaults to None, unchanged.
+        prefetch (int, optional): Number of batches loaded ahead in a background thread. 
+            Defaults to 2.
+        max_grad_norm (float, optional): Clip the gradient norm. Defaults to None.
+        scheduler (optional): Learning rate scheduler stepped after every optimizer step. Defaults to None.
+        verbose (bool, optional): Show the progress and the metrics of every epoch. Defaults to True.
+    
+    Examples:
+        trainer = TrainNN(model, loader, None, torch.optim.AdamW(model.parameters(), lr=5e-5), 
+                          num_epochs=3, device='cpu', grad_accumulation_steps=4, 
+                          autocast_dtype=torch.bfloat16, num_threads=8)
+        history = pd.DataFrame(trainer.train())
     """
     def __init__(self, 
                  model, 
                  training_dataloader:torch.utils.data.DataLoader, 
-                 loss_fn:str, 
+                 loss_fn, 
                  optimizer,
                  num_epochs:int, 
-                 device:str) -> None:
+                 device:str,
+                 grad_accumulation_steps:int=1,
+                 autocast_dtype:torch.dtype=None,
+                 compile:bool=False,
+                 num_threads:int=None,
+                 prefetch:int=2,
+                 max_grad_norm:float=None,
+                 scheduler=None,
+                 verbose:bool=True) -> None:
         self.model = model
         self.training_dataloader = training_dataloader
         self.loss_fn = loss_fn
         self.optimizer = optimizer
         self.num_epochs = num_epochs
         self.device = device
+        self.grad_accumulation_steps = grad_accumulation_steps
+        self.autocast_dtype = autocast_dtype
+        self.compile = compile
+        self.num_threads = num_threads
+        self.prefetch = prefetch
+        self.max_grad_norm = max_grad_norm
+        self.scheduler = scheduler
+        self.verbose = verbose
+        self.history = []
+
 
+    def train(self) -> list:
+        """Train the model for num_epochs.
 
-    def train(self):
+        Returns:
+            list: Metrics of every epoch.
+        """
+        # The number of threads is global, restored after training
+        num_threads = torch.get_num_threads()
+        if self.num_threads:
+            torch.set_num_threads(self.num_threads)
+        
         # Send the model to device
         self.model = self.model.to(self.device)
+        self._forward_model = torch.compile(self.model) if self.compile else self.model
         
-        for epoch in tqdm(range(self.num_epochs)):
-            self.train_epoch
+        try:
+            for epoch in range(self.num_epochs):
+                metrics = self.train_epoch()
+                metrics['epoch'] = epoch
+                self.history.append(metrics)
+                if self.verbose:
+                    print(f'Epoch {epoch}: loss {metrics["loss"]:.4f}',
+                          f'{metrics["samples_per_sec"]:,.0f} samples/s',
+                          f'{metrics["tokens_per_sec"]:,.0f} tokens/s',
+                          f'step p50/p99 {metrics["step_ms_p50"]:.1f}/{metrics["step_ms_p99"]:.1f} ms',
+                          f'peak memory ({metrics["peak_memory_scope"]}) {metrics["peak_memory_mb"]:,.0f} MB')
+        finally:
+            torch.set_num_threads(num_threads)
         
+        return self.history
+    
+    
+    def _loss(self, batch) -> tuple:
+        """Loss of the batch, number of samples and number of tokens."""
+        if isinstance(batch, dict):
+            n_samples = len(next(iter(batch.values())))
+            n_tokens = int(batch['attention_mask'].sum()) if 'attention_mask' in batch else \
+                       batch['input_ids'].numel() if 'input_ids' in batch else 0
+            if self.loss_fn is None:
+                return self._forward_model(**batch).loss, n_samples, n_tokens
+            labels = batch['labels'] if 'labels' in batch else batch['label']
+            inputs = {k:v for k,v in batch.items() if k not in ('labels', 'label')}
+            outputs = self._forward_model(**inputs)
+            return self.loss_fn(getattr(outputs, 'logits', outputs), labels), n_samples, n_tokens
+        
+        inputs, labels = batch
+        outputs = self._forward_model(inputs)
+        return self.loss_fn(outputs, labels), len(labels), 0
+        
+        
+    def train_epoch(self) -> dict:
+        """Train the model for one epoch.
+
+        Returns:
+            dict: Metrics of the epoch.
+        """
+        if not hasattr(self, '_forward_model'):
+            self.model = self.model.to(self.device)
+            self._forward_model = self.model
         
-    def train_epoch(self):
         # Training mode
         self.model = self.model.train()
+        device_type = torch.device(self.device).type
+        if device_type == 'cuda':
+            torch.cuda.reset_peak_memory_stats(self.device)
         
         # initialize training loss for the epoch
-        training_loss = 0.0
+        training_loss, n_batches, n_samples, n_tokens = 0.0, 0, 0, 0
+        step_times, wait_time = [], 0.0
+        n_steps = len(self.training_dataloader) if hasattr(self.training_dataloader, '__len__') else None
         
-        for inputs, labels in tqdm(self.training_dataloader):
-            inputs = moveTo(inputs, self.device)
-            labels = moveTo(labels, self.device)
+        self.optimizer.zero_grad()
+        start_time = time.perf_counter()
+        step_start = start_time
+        for i, batch in enumerate(tqdm(_prefetch(self.training_dataloader, self.prefetch), 
+                                       total=n_steps, disable=not self.verbose, leave=False)):
+            wait_time += time.perf_counter() - step_start
+            batch = moveTo(batch, self.device)
             
-            # Reset the gradients
-            self.optimizer.zero_grad()
+            with torch.autocast(device_type=device_type, dtype=self.autocast_dtype or torch.float32, 
+                                enabled=self.autocast_dtype is not None):
+                loss, batch_samples, batch_tokens = self._loss(batch)
+            (loss / self.grad_accumulation_steps).backward()
             
-            # Model predictions
-            outputs = self.model(inputs)
+            if (i + 1) % self.grad_accumulation_steps == 0:
+                self._optimizer_step()
             
-            # Compute the loss
-            loss = self.loss_fn(outputs, labels)
-            loss.backward()
-            self.optimizer.step()
             training_loss += loss.item()
-        print(training_loss)
+            n_batches += 1
+            n_samples += batch_samples
+            n_tokens += batch_tokens
+            step_end = time.perf_counter()
+            step_times.append(step_end - step_start)
+            step_start = step_end
+        
+        # Last incomplete group: its gradients are the mean over its batches, not over grad_accumulation_steps
+        if n_batches % self.grad_accumulation_steps:
+            self._scale_gradients(self.grad_accumulation_steps / (n_batches % self.grad_accumulation_steps))
+            self._optimizer_step()
+        
+        run_time = time.perf_counter() - start_time
+        step_ms = np.array(step_times) * 1000 if step_times else np.zeros(1)
+        
+        return {"loss": training_loss / max(n_batches, 1),
+                "batches": n_batches,
+                "samples": n_samples,
+                "tokens": n_tokens,
+                "seconds": run_time,
+                "samples_per_sec": n_samples / run_time if run_time > 0 else 0.0,
+                "tokens_per_sec": n_tokens / run_time if run_time > 0 else 0.0,
+                "step_ms_p50": float(np.percentile(step_ms, 50)),
+                "step_ms_p90": float(np.percentile(step_ms, 90)),
+                "step_ms_p99": float(np.percentile(step_ms, 99)),
+                "data_wait_fraction": wait_time / run_time if run_time > 0 else 0.0,
+                "peak_memory_mb": _peak_memory_mb(self.device),
+                "peak_memory_scope": 'epoch' if device_type == 'cuda' else 'process'}
+    
+    
+    def _scale_gradients(self, factor:float):
+        for group in self.optimizer.param_groups:
+            for p in group['params']:
+                if p.grad is not None:
+                    p.grad.mul_(factor)
+    
+    
+    def _optimizer_step(self):
+        if self.max_grad_norm is not None:
+            torch.nn.utils.clip_grad_norm_(self.model.parameters(), self.max_grad_norm)
+        self.optimizer.step()
+        if self.scheduler is not None:
+            self.scheduler.step()
+        self.optimizer.zero_grad()
             
 
 
 
+def _column_fingerprint(dataset_split, 
+                        column:str,
+                        batch_size:int=10_000) -> str:
+    """Hash of the values of a dataset column (of the rows of the split, after select, filter, ...).
+    The rows are serialized and hashed one batch at a time, the column is never copied at once.
+    """
+    sha = hashlib.sha1()
+    for batch in dataset_split.select_columns([column]).with_format('arrow').iter(batch_size=batch_size):
+        sink = pa.BufferOutputStream()
+        with pa.ipc.new_stream(sink, batch.schema) as writer:
+            # One record batch, so the bytes don't depend on the chunks of the dataset
+            writer.write_table(batch.combine_chunks())
+        sha.update(sink.getvalue())
+    return sha.hexdigest()[:16]
+
+
+
 class FineTuneFtsExtraction:
-    #TODO Not finished and not tested
     """Fine tune a model using feature extraction. Training is done on the
     hidden states as features, without modifying the pretrained model.
     
+    The frozen backbone runs only once per split: the pooled hidden states are extracted to 
+    memory-mapped shards in 'cache_dir' (see extract_embeddings, resumable) and later calls, 
+    epochs and hyperparameter sweeps of the classification head only read the cached 
+    features. The backbone is loaded only if a split has no cached features. The cache of a
+    split is tied to the model name, the pooling, max_length and a fingerprint of the split's
+    texts (or input ids), it is rebuilt when any of them changes.
+    
     Args:
         model_name_hf (str): Model name as shown on HuggingFace
         dataset_hf (DatasetDict): Dataset dictionary with minimal splits:
                                   'train', 'validation', 'test'
-        use_hf (bool): Use transformers library for training. 
+        use_hf (bool): Not used, kept for compatibility.
+        cache_dir (Path, optional): Directory of the cached hidden states. Defaults to 
+            'hidden_states/<model_name_hf>'.
+        text_column_name (str, optional): Column with the text, tokenized if the split has 
+            no 'input_ids'. Defaults to 'text'.
+        label_column_name (str, optional): Column with the label ids. Defaults to 'label'.
+        pooling (str, optional): 'cls' or 'mean', see pool_hidden_states(). Defaults to 'cls'.
+        max_length (int, optional): Maximum number of tokens. Defaults to 128.
+        batch_size (int, optional): Batch size of the backbone. Defaults to 256.
+        model (PreTrainedModel, optional): Backbone, instead of loading model_name_hf. Defaults to None.
+        tokenizer (PreTrainedTokenizerBase, optional): Tokenizer, instead of loading model_name_hf. Defaults to None.
+    
+    Examples:
+        fine_tune = FineTuneFtsExtraction('classla/bcms-bertic', dataset_enc, cache_dir='hidden_states')
+        fine_tune.extract_hidden_states()
+        for weight_decay in [1e-4, 1e-3, 1e-2]:
+            fine_tune.train_head('logistic', weight_decay=weight_decay)
+            print(weight_decay, fine_tune.evaluate('validation'))
+        fine_tune.train_head('mlp', hidden_size=256, num_epochs=20)
     """
     def __init__(self, 
                  model_name_hf, 
                  dataset_hf:DatasetDict,
-                 use_hf:bool=True,         
+                 use_hf:bool=True,
+                 cache_dir=None,
+                 text_column_name:str='text',
+                 label_column_name:str='label',
+                 pooling:str='cls',
+                 max_length:int=128,
+                 batch_size:int=256,
+                 model=None,
+                 tokenizer=None,
                  ) -> None:
         
         self.model_name_hf = model_name_hf
         self.dataset_hf = dataset_hf
         self.use_hf = use_hf
+        self.cache_dir = Path(cache_dir or Path('hidden_states') / str(model_name_hf).replace('/', '_'))
+        self.text_column_name = text_column_name
+        self.label_column_name = label_column_name
+        self.pooling = pooling
+        self.max_length = max_length
+        self.batch_size = batch_size
         
-        self.device = check_device()
-        self.model = (AutoModel.from_pretrained(self.model_name_hf)
-                               .to(self.device)
-                      )
-        self.tokenizer = AutoTokenizer.from_pretrained(self.model_name_hf)
+        self.device = check_device(verbose=False)
+        self._model = model
+        self._tokenizer = tokenizer
+        self.head = None
+        self._features = {}
+    
+    
+    @property
+    def model(self):
+        if self._model is None:
+            self._model = AutoModel.from_pretrained(self.model_name_hf)
+        return self._model
+    
+    
+    @property
+    def tokenizer(self):
+        if self._tokenizer is None:
+            self._tokenizer = AutoTokenizer.from_pretrained(self.model_name_hf)
+        return self._tokenizer
+    
+    
+    def _cache_metadata(self, split:str) -> dict:
+        """Description of the hidden states of a split, stored with the cached shards."""
+        data = self.dataset_hf[split]
+        column = 'input_ids' if 'input_ids' in data.column_names else self.text_column_name
+        return {"model": str(self.model_name_hf),
+                "pooling": self.pooling,
+                "max_length": self.max_length,
+                "n_rows": len(data),
+                "dataset": _column_fingerprint(data, column)}
+    
     
-    def extract_hidden_states(self):
+    def _cached(self, split:str, metadata:dict) -> bool:
+        """Whether the split has complete cached hidden states with the metadata (same model, 
+        pooling and data, see _cache_metadata). Cached hidden states of other settings are deleted.
+        """
+        manifest_path = self.cache_dir / split / 'manifest.json'
+        if not manifest_path.exists():
+            return False
+        with open(manifest_path) as f:
+            config = json.load(f)["config"]
+        if config.get("metadata") != metadata:
+            shutil.rmtree(self.cache_dir / split)
+            return False
+        return EmbeddingShards(self.cache_dir / split).complete
+    
+    
+    def extract_hidden_states(self, splits:list=None) -> dict:
         """Extract hidden states from the model to use as features in the
-        fine tuning model.
+        fine tuning model. Splits with cached hidden states are not recomputed.
+        
+        Args:
+            splits (list, optional): Splits to extract. Defaults to None, all the splits.
+        
+        Returns:
+            dict: EmbeddingShards of every split.
         """
-        # Send the inputs to the GPU
-        inputs = {
-            k:v.to(self.device) for k,v in batch.items() if k in self.tokenizer.model_input_names
-            }
+        hidden_states = {}
+        for split in splits or list(self.dataset_hf):
+            metadata = self._cache_metadata(split)
+            if not self._cached(split, metadata):
+                data = self.dataset_hf[split]
+                if 'input_ids' not in data.column_names:
+                    data = data.map(lambda batch: self.tokenizer(batch[self.text_column_name], truncation=True,
+                                                                 max_length=self.max_length),
+                                    batched=True)
+                extract_embeddings(data, self.model, self.tokenizer, self.cache_dir / split,
+                                   pooling=self.pooling, dtype='float32', batch_size=self.batch_size,
+                                   device=self.device, verbose=False, metadata=metadata)
+            hidden_states[split] = EmbeddingShards(self.cache_dir / split)
+        
+        return hidden_states
+    
+    
+    def features(self, split:str) -> tuple:
+        """Cached hidden states and labels of a split as tensors, kept in memory.
 
-        # Extract last hidden state
+        Args:
+            split (str): Dataset split, e.g. 'train'.
+        """
+        if split not in self._features:
+            X = torch.from_numpy(self.extract_hidden_states([split])[split].to_numpy().astype(np.float32))
+            y = torch.as_tensor(np.asarray(self.dataset_hf[split].with_format('numpy')[self.label_column_name]),
+                                dtype=torch.long) if self.label_column_name in self.dataset_hf[split].column_names else None
+            self._features[split] = (X, y)
+        return self._features[split]
+    
+    
+    def train_head(self,
+                   head:str='logistic',
+                   weight_decay:float=1e-4,
+                   hidden_size:int=256,
+                   dropout:float=0.1,
+                   num_epochs:int=20,
+                   lr:float=1e-3,
+                   batch_size:int=256,
+                   max_iter:int=100,
+                   seed:int=42) -> torch.nn.Module:
+        """Train a classification head on the cached hidden states of the 'train' split.
+
+        Args:
+            head (str, optional): 'logistic' (multinomial logistic regression trained with 
+                L-BFGS) or 'mlp' (one hidden layer trained with AdamW). Defaults to 'logistic'.
+            weight_decay (float, optional): L2 regularization. Defaults to 1e-4.
+            hidden_size (int, optional): Hidden layer size of the MLP. Defaults to 256.
+            dropout (float, optional): Dropout of the MLP. Defaults to 0.1.
+            num_epochs (int, optional): Number of epochs of the MLP. Defaults to 20.
+            lr (float, optional): Learning rate of the MLP. Defaults to 1e-3.
+            batch_size (int, optional): Batch size of the MLP. Defaults to 256.
+            max_iter (int, optional): Maximum number of L-BFGS iterations. Defaults to 100.
+            seed (int, optional): Random seed. Defaults to 42.
+
+        Returns:
+            torch.nn.Module: The trained head, also kept in 'head'.
+        """
+        torch.manual_seed(seed)
+        X, y = self.features('train')
+        num_labels = int(y.max()) + 1
+        loss_fn = torch.nn.CrossEntropyLoss()
+        
+        if head == 'logistic':
+            model = torch.nn.Linear(X.shape[1], num_labels)
+            optimizer = torch.optim.LBFGS(model.parameters(), max_iter=max_iter, line_search_fn='strong_wolfe')
+            
+            def closure():
+                optimizer.zero_grad()
+                loss = loss_fn(model(X), y) + weight_decay * model.weight.pow(2).sum()
+                loss.backward()
+                return loss
+            
+            optimizer.step(closure)
+        elif head == 'mlp':
+            model = torch.nn.Sequential(torch.nn.Linear(X.shape[1], hidden_size),
+                                        torch.nn.ReLU(),
+                                        torch.nn.Dropout(dropout),
+                                        torch.nn.Linear(hidden_size, num_labels))
+            loader = torch.utils.data.DataLoader(torch.utils.data.TensorDataset(X, y), 
+                                                 batch_size=batch_size, shuffle=True)
+            TrainNN(model, loader, loss_fn, 
+                    torch.optim.AdamW(model.parameters(), lr=lr, weight_decay=weight_decay),
+                    num_epochs=num_epochs, device='cpu', prefetch=0, verbose=False).train()
+        else:
+            raise ValueError(f"Unknown head: {head}. Use 'logistic' or 'mlp'.")
+        
+        self.head = model.eval()
+        return self.head
+    
+    
+    def predict(self, split:str) -> np.ndarray:
+        """Predicted label ids of a split from its cached hidden states.
+
+        Args:
+            split (str): Dataset split, e.g. 'test'.
+        """
+        if self.head is None:
+            raise RuntimeError('The head is not trained. Call train_head() first.')
+        X, _ = self.features(split)
+        with torch.inference_mode():
+            return torch.argmax(self.head(X), dim=-1).numpy()
+    
+    
+    def evaluate(self, split:str='validation') -> float:
+        """Accuracy of the head on a split.
+
+        Args:
+            split (str, optional): Dataset split. Defaults to 'validation'.
+        """
+        _, y = self.features(split)
+        if y is None:
+            raise ValueError(f'The {split} split has no label column {self.label_column_name!r}.')
+        return float((self.predict(split) == y.numpy()).mean())
         
 
 
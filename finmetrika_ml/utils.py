@@ -244,6 +244,7 @@ def apply_functions(functions:list, data):
     Args:
         functions (list): A list (or any iterable) of functions to apply to the data. 
             Each function in this list is expected to take a single argument (the data) and return a result. 
+            For long chains of data cleaning functions use a compiled data_cleaning.CleaningEngine instead.
         data (_type_): Input data to apply the function.
     """
     #TODO Fix the function to take on arguments other than text like additional patterns
@@ -21,7 +21,8 @@ setup(
     ],
     entry_points={
         'console_scripts': [
-            'fm_create_nb=finmetrika_ml.cli:main'
+            'fm_create_nb=finmetrika_ml.cli:main',
+            'fm_clean_file=finmetrika_ml.cli:clean_file_main'
         ]
     }
 )
\ No newline at end of file
@@ -0,0 +1,35 @@
+import pandas as pd
+import pytest
+from benchmarks.synthetic import generate_transactions, build_tokenizer, build_tiny_model
+
+
+@pytest.fixture(scope="session")
+def transactions():
+    """300 synthetic card transactions with repeated texts, columns 'text' and 'label' (ids)."""
+    df = generate_transactions(300)[["text", "label"]]
+    return df.assign(label=pd.factorize(df["label"])[0])
+
+
+@pytest.fixture(scope="session")
+def make_tokenizer():
+    """Factory of word level tokenizers with the vocabulary of the given texts, nothing is downloaded."""
+    return build_tokenizer
+
+
+@pytest.fixture(scope="session")
+def tokenizer(make_tokenizer, transactions):
+    """Case sensitive tokenizer of the transactions, upper and lower case words are in the vocabulary."""
+    texts = transactions["text"].tolist()
+    return make_tokenizer(texts + [t.lower() for t in texts])
+
+
+@pytest.fixture(scope="session")
+def make_tiny_model():
+    """Factory of randomly initialized tiny BERT classifiers, make_tiny_model(vocab_size, num_labels, seed=42)."""
+    return build_tiny_model
+
+
+@pytest.fixture
+def tiny_model(make_tiny_model, tokenizer):
+    """Tiny BERT classifier with 4 labels for the tokenizer."""
+    return make_tiny_model(len(tokenizer), num_labels=4)
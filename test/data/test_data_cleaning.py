@@ -0,0 +1,113 @@
+import pickle
+import random
+import pytest
+import pandas as pd
+from finmetrika_ml.utils import apply_functions
+from finmetrika_ml.data.data_cleaning import *
+
+
+ALL_FUNCTIONS = [remove_ccard, remove_repeated_words, remove_abrv_chr, remove_non_ascii_chr,
+                 remove_cro_abrv, remove_branch_info, remove_atm_no, remove_iban, remove_punctuation]
+
+TOKENS = ['KONZUM', 'P-0980', 'ZAGREB', '462765XXXXXX1234', 'D.O.O.', 'd.o.o.', 'DOO', '.COM',
+          'WWW', '*', 'ATM', 'A3122001', 'sa', 'HR123', 'PBZT', 'PBZ1', 'TN12', 'T5', '.', ',',
+          ':', "'", 'ž', 'Đ', 'D', 'O', '.EU', 'S.R.L', '.NET', 'Prijenos', ' ']
+
+
+def random_texts(n:int, seed:int=42):
+    rng = random.Random(seed)
+    return [''.join(rng.choice(TOKENS) + rng.choice(['', ' ']) for _ in range(rng.randint(0, 10)))
+            for _ in range(n)]
+
+
+@pytest.mark.parametrize("functions", [ALL_FUNCTIONS,
+                                       ALL_FUNCTIONS[::-1],
+                                       [remove_punctuation, remove_non_ascii_chr, remove_abrv_chr]])
+def test_cleaning_engine_matches_chain(functions):
+    engine = CleaningEngine(functions)
+    for text in random_texts(5000):
+        assert engine(text) == apply_functions(functions, text)
+
+
+def test_cleaning_engine_in_apply_functions():
+    engine = CleaningEngine(['remove_ccard', 'remove_iban'])
+    text = 'Prijenos sa HR1234 TEA 462765XXXXXX1234'
+
+    assert apply_functions([engine, str.lower], text) == 'prijenos tea'
+
+
+def test_cleaning_engine_register_patterns():
+    engine = CleaningEngine([remove_abrv_chr])
+    engine.register_patterns("abbreviations", [" OBRT"])
+    text = 'FINMETRIKA OBRT ZAGREB'
+
+    assert engine(text) == remove_abrv_chr(text, abrv_patterns=[" OBRT"]) == 'FINMETRIKA ZAGREB'
+    assert len(patterns_dict["abbreviations"]) == 17
+
+
+def test_cleaning_engine_pickle():
+    engine = CleaningEngine(ALL_FUNCTIONS, extra_patterns={"abbreviations": [" OBRT"]}, single_scan=True)
+    restored = pickle.loads(pickle.dumps(engine))
+
+    assert restored.plan == engine.plan
+    for text in random_texts(500) + ['FINMETRIKA OBRT ZAGREB']:
+        assert restored(text) == engine(text)
+
+
+def test_required_literal():
+    assert required_literal(r"(ATM\s)[A-Za-z]?\d+\s") == "ATM"
+    assert required_literal(r"\d{6}X+\d{4}") == "X"
+    assert required_literal(r"[^ -~]") == ""
+
+
+def test_cached_cleaner_matches_chain():
+    texts = pd.Series(random_texts(500) * 4 + [None])
+    cleaner = CachedCleaner(ALL_FUNCTIONS, max_size=100)
+    first, second = cleaner(texts.iloc[:1000]), cleaner(texts.iloc[1000:])
+    cleaned = pd.concat([first, second])
+
+    assert cleaned.iloc[:-1].tolist() == [apply_functions(ALL_FUNCTIONS, t) for t in texts.iloc[:-1]]
+    assert pd.isna(cleaned.iloc[-1])
+    assert cleaner.stats["size"] == 100
+    assert cleaner.stats["evictions"] == cleaner.stats["misses"] - 100
+    assert cleaner.stats["hits"] + cleaner.stats["misses"] == cleaner.stats["unique"]
+
+
+def test_cached_cleaner_categorical():
+    texts = pd.Series(['a B', 'B', 'KONZUM P-0980 ZAGREB', None, 'a B'], dtype='category', index=range(3, 8))
+    cleaned = CachedCleaner([remove_branch_info, remove_punctuation])(texts)
+
+    assert isinstance(cleaned.dtype, pd.CategoricalDtype)
+    assert cleaned.index.equals(texts.index)
+    expected = [apply_functions([remove_branch_info, remove_punctuation], t) for t in texts.iloc[[0, 1, 2, 4]]]
+    assert cleaned.iloc[[0, 1, 2, 4]].tolist() == expected
+    assert cleaned.isna().tolist() == [False, False, False, True, False]
+
+
+def test_multi_literal_matcher():
+    matcher = MultiLiteralMatcher(tokens=["DOO", "D.O.O.", "DD", "D"], patterns=[r"TN\d+"])
+
+    # Leftmost-longest and non-overlapping
+    assert matcher.findall("KONZUM D.O.O. DDOO TN12") == ["D.O.O.", "DD", "TN12"]
+    assert matcher.sub("", "KONZUM D.O.O.") == "KONZUM "
+    assert MultiLiteralMatcher().sub("", "KONZUM") == "KONZUM"
+
+
+def test_inline_flags():
+    assert required_literal("(?i) obrt") == "" and literal_token("(?i)doo") is None
+    assert MultiLiteralMatcher.from_patterns(["(?i)doo"]).findall("KONZUM DOO") == ["DOO"]
+
+    engine = CleaningEngine([remove_abrv_chr], extra_patterns={"abbreviations": ["(?i) obrt"]})
+    text = 'FINMETRIKA OBRT ZAGREB'
+    assert engine(text) == remove_abrv_chr(text, abrv_patterns=["(?i) obrt"]) == 'FINMETRIKA ZAGREB'
+    engine = CleaningEngine([remove_abrv_chr], extra_patterns={"abbreviations": ["(?i) obrt"]}, single_scan=True)
+    assert engine(text) == 'FINMETRIKA ZAGREB'
+    engine = CleaningEngine([remove_punctuation], extra_patterns={"punctuation": ["(?i)x"]})
+    assert engine("Xx.") == ""
+
+
+def test_cleaning_engine_single_scan():
+    engine = CleaningEngine(cleaning_pipelines["default"], single_scan=True)
+    engine.register_patterns("abbreviations", ["TISAK", "KONZUM"])
+
+    assert engine("KONZUM P-0980 ZAGREB D.O.O. 462765XXXXXX1234") == "ZAGREB"
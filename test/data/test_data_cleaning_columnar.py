@@ -0,0 +1,33 @@
+import pytest
+import pandas as pd
+import pyarrow as pa
+from finmetrika_ml.utils import apply_functions
+from finmetrika_ml.data import data_cleaning_columnar
+from finmetrika_ml.data.data_cleaning_columnar import clean_column, to_re2
+from test.data.test_data_cleaning import ALL_FUNCTIONS, random_texts
+
+
+TEXTS = random_texts(2000) + ['İSTANBUL istanbul', 'ATM A12 x', '١٢٣٤٥٦XX1234 p', '\x1cKONZUM　']
+
+
+@pytest.mark.parametrize("dtype", [object, "string[pyarrow]"])
+@pytest.mark.parametrize("func", ALL_FUNCTIONS, ids=lambda f: f.__name__)
+def test_columnar_matches_str_functions(func, dtype):
+    data = pd.Series(TEXTS + [None], dtype=dtype)
+    cleaned = getattr(data_cleaning_columnar, func.__name__)(data)
+
+    assert cleaned.dtype == data.dtype
+    assert cleaned.iloc[-1] is None or pd.isna(cleaned.iloc[-1])
+    assert cleaned.iloc[:-1].tolist() == [func(t) for t in TEXTS]
+
+
+def test_clean_column_arrow():
+    cleaned = clean_column(ALL_FUNCTIONS, pa.array(TEXTS + [None]))
+
+    assert isinstance(cleaned, pa.Array)
+    assert cleaned.to_pylist() == [apply_functions(ALL_FUNCTIONS, t) for t in TEXTS] + [None]
+
+
+def test_to_re2():
+    assert to_re2(r"P-\d{4}") == r"P-\p{Nd}{4}"
+    assert to_re2(r"\.") == r"\."
@@ -0,0 +1,44 @@
+import pytest
+import pandas as pd
+from finmetrika_ml.utils import apply_functions
+from finmetrika_ml.data.data_cleaning import CleaningEngine
+from finmetrika_ml.data.data_cleaning_parallel import parallel_clean
+from test.data.test_data_cleaning import ALL_FUNCTIONS, random_texts
+
+
+def test_parallel_clean_matches_serial(tmp_path):
+    df = pd.DataFrame({"text": random_texts(3000) + [None], "amount": 1.0},
+                      index=range(10, 3011))
+    expected = df["text"].map(lambda t: apply_functions(ALL_FUNCTIONS, t) if isinstance(t, str) else t)
+    
+    cleaned = parallel_clean(df, ALL_FUNCTIONS, text_column="text", n_workers=2, chunk_size=250)
+    assert cleaned.index.equals(df.index)
+    assert cleaned.iloc[:-1].tolist() == expected.iloc[:-1].tolist()
+    assert pd.isna(cleaned.iloc[-1])
+    
+    df.to_parquet(tmp_path / "trx.parquet")
+    cleaned = parallel_clean(tmp_path / "trx.parquet", ALL_FUNCTIONS, text_column="text", 
+                             n_workers=2, chunk_size=700)
+    assert cleaned.iloc[:-1].tolist() == expected.iloc[:-1].tolist()
+
+
+def test_parallel_clean_categorical():
+    texts = pd.Series(random_texts(500) + [None], dtype="category")
+    expected = [apply_functions(ALL_FUNCTIONS, t) for t in texts.iloc[:-1]]
+
+    cleaned = parallel_clean(texts, ALL_FUNCTIONS, n_workers=1, chunk_size=100)
+    assert isinstance(cleaned.dtype, pd.CategoricalDtype)
+    assert cleaned.iloc[:-1].tolist() == expected
+    assert pd.isna(cleaned.iloc[-1])
+
+    with pytest.raises(ValueError):
+        parallel_clean(pd.DataFrame({"description": texts}), ALL_FUNCTIONS, text_column="text", n_workers=1)
+
+
+@pytest.mark.parametrize("mp_context", ["spawn", "forkserver"])
+def test_parallel_clean_engine(mp_context):
+    texts = pd.Series(random_texts(1000))
+    engine = CleaningEngine(ALL_FUNCTIONS)
+
+    cleaned = parallel_clean(texts, engine, n_workers=2, chunk_size=300, mp_context=mp_context)
+    assert cleaned.tolist() == [engine(t) for t in texts]
@@ -0,0 +1,54 @@
+import pytest
+import pandas as pd
+from finmetrika_ml.utils import apply_functions
+from finmetrika_ml.data.data_cleaning import cleaning_pipelines, remove_ccard
+from finmetrika_ml.data.data_cleaning_columnar import clean_column
+from finmetrika_ml.data.data_cleaning_stream import clean_file
+from test.data.test_data_cleaning import random_texts
+
+
+@pytest.mark.parametrize("suffix", [".csv", ".parquet"])
+def test_clean_file_round_trip(tmp_path, suffix):
+    # Empty texts would be read as missing values from CSV
+    texts = [t for t in random_texts(1200) if t][:1000]
+    df = pd.DataFrame({"text": texts + [None], "amount": range(1001)})
+    path = tmp_path / f"trx{suffix}"
+    df.to_csv(path, index=False) if suffix == ".csv" else df.to_parquet(path)
+
+    stats = clean_file(path, tmp_path / "clean.parquet", text_column="text", output_column="text_clean",
+                       batch_size=300, verbose=False)
+    out = pd.read_parquet(tmp_path / "clean.parquet")
+    expected = clean_column(cleaning_pipelines["default"], df["text"].iloc[:-1])
+
+    assert stats["rows"] == len(df) == len(out)
+    assert out["amount"].tolist() == df["amount"].tolist()
+    assert out["text_clean"].iloc[:-1].tolist() == expected.tolist()
+    assert pd.isna(out["text_clean"].iloc[-1])
+
+
+def test_clean_file_categorical(tmp_path):
+    texts = ["KONZUM P-0980 ZAGREB", "INA BS SPLIT 462765XXXXXX1234", None, "KONZUM P-0980 ZAGREB"]
+    pd.DataFrame({"text": pd.Series(texts, dtype="category")}).to_parquet(tmp_path / "trx.parquet")
+
+    clean_file(tmp_path / "trx.parquet", tmp_path / "clean.parquet", text_column="text",
+               pipeline="remove_ccard", verbose=False)
+    out = pd.read_parquet(tmp_path / "clean.parquet")["text"]
+    assert out.iloc[[0, 1, 3]].tolist() == [remove_ccard(texts[i]) for i in (0, 1, 3)]
+    assert pd.isna(out.iloc[2])
+
+    with pytest.raises(ValueError):
+        clean_file(tmp_path / "trx.parquet", tmp_path / "clean.parquet", text_column="text",
+                   pipeline="not_a_function", verbose=False)
+
+
+@pytest.mark.parametrize("suffix", [".csv", ".parquet"])
+def test_clean_file_empty(tmp_path, suffix):
+    df = pd.DataFrame({"text": pd.Series([], dtype=object), "amount": pd.Series([], dtype=float)})
+    path = tmp_path / f"trx{suffix}"
+    df.to_csv(path, index=False) if suffix == ".csv" else df.to_parquet(path)
+
+    stats = clean_file(path, tmp_path / "clean.parquet", text_column="text", output_column="text_clean",
+                       verbose=False)
+    out = pd.read_parquet(tmp_path / "clean.parquet")
+    assert stats["rows"] == 0 and len(out) == 0
+    assert list(out.columns) == ["text", "amount", "text_clean"]
@@ -0,0 +1,65 @@
+import pytest
+import pandas as pd
+from finmetrika_ml.data.data_features import *
+
+
+def test_extract_entities():
+    data = pd.Series(["KONZUM P-0980 ZAGREB 462765XXXXXX1234", "Prijenos sa HR1234 TEA ",
+                      "ATM A3122001 ZAGREB", None, "KONZUM P-0980 ZAGREB 462765XXXXXX1234"],
+                     index=list("abcde"))
+    entities = extract_entities(data)
+
+    assert entities.index.equals(data.index)
+    assert (entities.dtypes == "string").all()
+    assert entities.loc["a"].tolist() == ["462765XXXXXX1234", pd.NA, pd.NA, "P-0980", "KONZUM ZAGREB"]
+    assert entities.loc["b", "TRX_IBAN"] == "HR1234"
+    assert entities.loc["c", ["TRX_ATM_ID", "TRX_TEXT_REST"]].tolist() == ["A3122001", "ATM ZAGREB"]
+    assert entities.loc["d"].isna().all()
+    assert entities.loc["e"].equals(entities.loc["a"].rename("e"))
+
+
+def test_create_datetime_features():
+    df = pd.DataFrame({"date": pd.to_datetime(["2024-01-05 10:00", "2024-12-31 00:00", None])})
+    features = create_datetime_features(df, "date", inplace=False)
+
+    assert "DT_MONTH" not in df
+    assert features["DT_DATE_STR"].tolist()[:2] == ["January 05 2024", "December 31 2024"]
+    assert features["DT_MONTH_TXT"].dtype == "category"
+    assert features["DT_WEEK_DAY"].dtype == "Int8"
+    assert features["DT_WEEK_OF_YEAR"].tolist() == [1, 1, pd.NA]
+
+    df = create_datetime_features(df.dropna(), "date", columns=["DT_YEAR", "DT_DAY_OF_YEAR"])
+    assert df.columns.tolist() == ["date", "DT_YEAR", "DT_DAY_OF_YEAR"]
+    assert df["DT_DAY_OF_YEAR"].dtype == "int16"
+
+
+def test_amount_binner(tmp_path):
+    amounts = pd.Series(np.round(np.random.default_rng(0).lognormal(3, 1.5, 10_000), 2))
+    binner = AmountBinner(n_bins=4)
+    for chunk in np.array_split(amounts, 3):
+        binner.partial_fit(chunk)
+
+    expected = np.quantile(amounts, [0.25, 0.5, 0.75], method="inverted_cdf")
+    assert binner.edges[1:-1] == expected.tolist()
+
+    bins = binner.transform(amounts)
+    assert bins.cat.codes.dtype == np.int8
+    assert bins.value_counts().min() >= 2490
+
+    binner.save(tmp_path / "bins.json")
+    assert AmountBinner.load(tmp_path / "bins.json").transform(amounts).equals(bins)
+
+    custom = AmountBinner(edges=[0, 50, 500, float("inf")])
+    with pytest.raises(RuntimeError):
+        custom.partial_fit(amounts)
+    assert custom.edges == [0, 50, 500, float("inf")]
+    with pytest.raises(RuntimeError):
+        AmountBinner.load(tmp_path / "bins.json").fit(amounts)
+
+
+def test_quantize_amount():
+    df = pd.DataFrame({"TRX_AMOUNT": [-1, 0, 49.99, 50, 999, 1000, np.nan]})
+    expected = pd.cut(df["TRX_AMOUNT"], bins=[0, 50, 500, 1000, float("inf")],
+                      labels=["low", "medium", "high", "luxury"], right=False)
+
+    assert quantize_amount(df, "TRX_AMOUNT")["TRX_AMOUNT_BIN"].equals(expected.rename("TRX_AMOUNT_BIN"))
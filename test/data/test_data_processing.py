@@ -0,0 +1,180 @@
+import warnings
+import pytest
+import numpy as np
+import pandas as pd
+import torch
+import pyarrow as pa
+from datasets import Dataset
+from finmetrika_ml.data.data_processing import *
+
+
+def test_count_tokens():
+    df = pd.DataFrame({"input_ids": [[5, 6, 0], [7, 0], [1, 2, 3, 4]],
+                       "attention_mask": [[1, 1, 0], [1, 0], [1, 1, 1, 1]],
+                       "label": ["a", "b", "a"]}, index=[3, 4, 5])
+
+    assert count_tokens(df).to_dict() == {3: 2, 4: 1, 5: 4}
+    assert count_tokens(df[["input_ids"]]).tolist() == [3, 2, 4]
+    assert count_tokens(Dataset.from_pandas(df, preserve_index=False).select([2, 0])).tolist() == [4, 2]
+    assert count_tokens(torch.tensor([[1, 1, 0], [1, 0, 0]])).tolist() == [2, 1]
+
+    hist = token_length_histogram(count_tokens(df), df["label"])
+    assert hist.loc[[1, 2, 4]].to_dict() == {"a": {1: 0, 2: 1, 4: 1}, "b": {1: 1, 2: 0, 4: 0}}
+
+
+def test_trx_tensor_dataset():
+    dataset = Dataset.from_dict({"text": ["a", "b", "c"],
+                                 "input_ids": [[1, 2, 3], [4, 5, 6], [7, 8, 9]],
+                                 "attention_mask": [[1, 1, 0], [1, 1, 1], [1, 0, 0]],
+                                 "label": [0, 1, 2]}).select([2, 0, 1])
+    tensor_dataset = TRXTensorDataset(dataset)
+    old_dataset = TRXDataset(dataset, device="cpu")
+
+    for i in range(len(dataset)):
+        assert all(torch.equal(v.long(), old_dataset[i][k]) for k, v in tensor_dataset[i].items())
+
+    batch = tensor_dataset.get_batch([1, 2])
+    assert batch["input_ids"].tolist() == [[1, 2, 3], [4, 5, 6]]
+    assert TRXTensorDataset.collate(batch) is batch
+
+    ragged = TRXTensorDataset(Dataset.from_dict({"input_ids": [[1, 2], [3, 4, 5], [6]]}))
+    assert [t.tolist() for t in ragged.get_batch([2, 1])["input_ids"]] == [[6], [3, 4, 5]]
+
+    # Stock DataLoader, samples fetched one by one
+    loader = torch.utils.data.DataLoader(tensor_dataset, batch_size=2)
+    assert [b["label"].tolist() for b in loader] == [[2, 0], [1]]
+    # Batched indexing with a batch sampler
+    sampler = torch.utils.data.BatchSampler(range(3), batch_size=2, drop_last=False)
+    loader = torch.utils.data.DataLoader(tensor_dataset, sampler=sampler, batch_size=None,
+                                         collate_fn=TRXTensorDataset.collate)
+    assert [b["input_ids"].tolist() for b in loader] == [[[7, 8, 9], [1, 2, 3]], [[4, 5, 6]]]
+
+
+def test_trx_tensor_dataset_copies():
+    dataset = Dataset.from_dict({"input_ids": [[5, 6, 7], [8, 9, 10]], "label": [0, 1]})
+    ragged = Dataset.from_dict({"input_ids": [[1, 2], [3, 4, 5]]})
+    with warnings.catch_warnings():
+        # No read only Arrow buffers are wrapped
+        warnings.simplefilter("error")
+        tensor_dataset, ragged_dataset = TRXTensorDataset(dataset), TRXTensorDataset(ragged)
+
+    tensor_dataset[0]["input_ids"][0] = 103
+    tensor_dataset.get_batch([1])["input_ids"][0, 0] = 103
+    ragged_dataset[1]["input_ids"][0] = 103
+    ragged_dataset.get_batch([0])["input_ids"][0][0] = 103
+    assert dataset["input_ids"] == [[5, 6, 7], [8, 9, 10]] and ragged["input_ids"] == [[1, 2], [3, 4, 5]]
+    assert tensor_dataset[0]["input_ids"].tolist() == [5, 6, 7]
+    assert [ragged_dataset[i]["input_ids"].tolist() for i in range(2)] == [[1, 2], [3, 4, 5]]
+
+
+def test_length_bucket_sampler_and_collator():
+    n_tokens = np.random.default_rng(0).integers(3, 30, 1000)
+    sampler = LengthBucketSampler(n_tokens, batch_size=32, shuffle=True, bucket_size=5)
+    batches = sampler.batches()
+
+    assert len(batches) == len(sampler) == 32
+    assert sorted(sum(batches, [])) == list(range(1000))
+    sampler.set_epoch(1)
+    assert sampler.batches() != batches
+    sequential = [list(range(i, min(i + 32, 1000))) for i in range(0, 1000, 32)]
+    assert sampler.padding_fraction() < padding_fraction(n_tokens, sequential)
+
+    dataset = Dataset.from_dict({"input_ids": [[5] * k + [0] * (40 - k) for k in n_tokens[:4]],
+                                 "attention_mask": [[1] * k + [0] * (40 - k) for k in n_tokens[:4]],
+                                 "label": [0, 1, 0, 1]})
+    collator = DynamicPaddingCollator(pad_token_id=0)
+    batch = collator(TRXTensorDataset(dataset).get_batch([0, 1]))
+    assert batch["input_ids"].shape == (2, max(n_tokens[:2]))
+    batch = collator([TRXDataset(dataset, device="cpu")[i] for i in [2, 3]])
+    assert batch["attention_mask"].sum().item() == n_tokens[2:4].sum()
+    assert collator.padding_fraction == 1 - n_tokens[:4].sum() / (2 * max(n_tokens[:2]) + 2 * max(n_tokens[2:4]))
+
+
+def test_causal_lm_dataset_packed():
+    encodings = {"input_ids": torch.tensor([[5, 6, 7, 0], [8, 9, 0, 0], [10, 11, 12, 13]]),
+                 "attention_mask": torch.tensor([[1, 1, 1, 0], [1, 1, 0, 0], [1, 1, 1, 1]])}
+
+    unpacked = CausalLMDataset(encodings, "cpu")
+    assert unpacked[1]["labels"].tolist() == [8, 9, -100, -100]
+    assert unpacked.padding_fraction == 3 / 12
+
+    packed = CausalLMDataset(encodings, "cpu", packed=True, block_size=5, sep_token_id=2)
+    assert len(packed) == 3 and abs(packed.padding_fraction - 3 / 15) < 1e-9
+    assert [packed[i]["input_ids"].tolist() for i in range(3)] == [[5, 6, 7, 2, 8], [9, 2, 10, 11, 12], [13, 2, 0, 0, 0]]
+    assert packed[2]["labels"].tolist() == [13, 2, -100, -100, -100]
+    assert packed[2]["attention_mask"].tolist() == [1, 1, 0, 0, 0]
+    assert packed[1]["document_ids"].tolist() == [1, 1, 2, 2, 2]
+    assert len(CausalLMDataset(encodings, "cpu", packed=True, block_size=5, sep_token_id=2, drop_last=True)) == 2
+
+    docs = CausalLMDataset(encodings, "cpu", packed=True, block_size=5, sep_token_id=2, document_attention=True)
+    item = docs[1]
+    assert item["labels"].tolist() == [9, 2, -100, 11, 12]
+    assert item["position_ids"].tolist() == [0, 1, 0, 1, 2]
+    assert item["attention_mask"].tolist() == [[[1, 0, 0, 0, 0],
+                                                [1, 1, 0, 0, 0],
+                                                [0, 0, 1, 0, 0],
+                                                [0, 0, 1, 1, 0],
+                                                [0, 0, 1, 1, 1]]]
+    assert docs[2]["attention_mask"][0, 2].tolist() == [0, 0, 0, 0, 0]
+
+
+def test_regression_dataset_1d():
+    X = np.arange(10, dtype=np.float32)
+    y = np.arange(10) * 2.0
+    dataset = RegressionDataset1D(X, y)
+    assert np.shares_memory(dataset.X.numpy(), X) and dataset.y.dtype == torch.float32
+    assert dataset.X.shape == (10, 1) and len(dataset) == 10
+
+    X_i, y_i = dataset[3]
+    assert X_i.tolist() == [3.0] and y_i.tolist() == [6.0]
+    X_b, y_b = dataset.get_batch([4, 1])
+    assert X_b.tolist() == [[4.0], [1.0]] and y_b.tolist() == [[8.0], [2.0]]
+
+    # Stock DataLoader, samples fetched one by one
+    loader = torch.utils.data.DataLoader(dataset, batch_size=4)
+    assert [(X_b.shape, y_b.shape) for X_b, y_b in loader][0] == ((4, 1), (4, 1))
+    loader = torch.utils.data.DataLoader(RegressionDataset1D(np.ones((10, 3)), np.ones(10)), batch_size=4)
+    assert [X_b.shape for X_b, _ in loader] == [(4, 3), (4, 3), (2, 3)]
+    # Batched indexing with a batch sampler
+    sampler = torch.utils.data.BatchSampler(range(10), batch_size=4, drop_last=False)
+    loader = torch.utils.data.DataLoader(dataset, sampler=sampler, batch_size=None, collate_fn=RegressionDataset1D.collate)
+    assert [X_b.ravel().tolist() for X_b, _ in loader] == [[0, 1, 2, 3], [4, 5, 6, 7], [8, 9]]
+    assert [X_b.shape[0] for X_b, _ in dataset.iter_batches(4, drop_last=True)] == [4, 4]
+    shuffled = list(dataset.iter_batches(3, shuffle=True, generator=torch.Generator().manual_seed(0)))
+    assert sorted(torch.cat([X_b for X_b, _ in shuffled]).ravel().tolist()) == X.tolist()
+    assert all(torch.equal(y_b, 2 * X_b) for X_b, y_b in shuffled)
+
+    assert RegressionDataset1D(np.ones((5, 3)), np.ones(5)).X.shape == (5, 3)
+
+
+def test_label_vocabulary(tmp_path):
+    df = pd.DataFrame({"category": ["fuel", "groceries", "fuel", "cash", "groceries"]})
+    vocab = LabelVocabulary.from_data(df["category"])
+    assert vocab.labels == ["cash", "fuel", "groceries"]
+
+    ids = vocab.encode(df["category"])
+    assert ids.dtype == np.int8 and ids.tolist() == [1, 2, 1, 0, 2]
+    assert vocab.encode(pa.chunked_array([["cash"], ["fuel", "groceries"]])).tolist() == [0, 1, 2]
+    assert vocab.encode(["fuel", "other"], unknown="ignore").tolist() == [1, -1]
+    with pytest.raises(KeyError):
+        vocab.encode(["other"])
+
+    assert vocab.decode(torch.tensor([2, 0])).tolist() == ["groceries", "cash"]
+    assert list(vocab.decode(ids, categorical=True)) == df["category"].tolist()
+    assert pd.isna(vocab.decode([1, -1], categorical=True)[1])
+    with pytest.raises(ValueError):
+        vocab.decode([1, -1])
+    with pytest.raises(ValueError):
+        vocab.decode([3])
+
+    vocab.save(tmp_path / "labels.json")
+    vocab = LabelVocabulary.load(tmp_path / "labels.json")
+    dataset = vocab.encode_dataset(Dataset.from_pandas(df), "category")
+    assert dataset["label"] == ids.tolist()
+    dts = DatasetDict({"train": dataset})
+    assert get_labels_from_dataset(dts, "train", "label") == len(vocab)
+    assert LabelVocabulary.from_dataset(dts, "train", "label").labels == vocab.labels
+    assert LabelVocabulary.from_dataset(dts, "train", "category").labels == vocab.labels
+    # Only the selected rows
+    dts = DatasetDict({"train": Dataset.from_pandas(df).filter(lambda x: x["category"] != "cash").shuffle(seed=0)})
+    assert LabelVocabulary.from_dataset(dts, "train", "category").labels == ["fuel", "groceries"]
@@ -0,0 +1,80 @@
+from datasets import Dataset
+from finmetrika_ml.data.data_token_cache import *
+
+
+def test_tokenization_cache(tmp_path, make_tokenizer):
+    texts = ["KONZUM ZAGREB", "INA BS SPLIT", "KONZUM ZAGREB", "PLODINE PULA"]
+    tokenizer = make_tokenizer(texts + ["LIDL RIJEKA"])
+    expected = tokenizer(texts)
+
+    cache = TokenizationCache(tmp_path, tokenizer)
+    tokens = cache.tokenize(texts)
+    assert tokens.column("input_ids").to_pylist() == expected["input_ids"]
+    assert tokens.column("attention_mask").to_pylist() == expected["attention_mask"]
+    assert cache.stats["misses"] == 3
+
+    # A new run reads the tokens from disk and only tokenizes the new text
+    cache = TokenizationCache(tmp_path, tokenizer)
+    tokens = cache.tokenize(["LIDL RIJEKA"] + texts)
+    assert tokens.column("input_ids").to_pylist() == tokenizer(["LIDL RIJEKA"] + texts)["input_ids"]
+    assert (cache.stats["hits"], cache.stats["misses"], cache.stats["texts"]) == (3, 1, 4)
+    assert len(Dataset(tokens)) == 5
+
+    # Other settings use their own entries
+    truncated = TokenizationCache(tmp_path, tokenizer, truncation=True, max_length=3)
+    assert truncated.key != cache.key
+    assert truncated.tokenize(texts).column("input_ids").to_pylist() == \
+        tokenizer(texts, truncation=True, max_length=3)["input_ids"]
+
+    cache.invalidate()
+    assert cache.stats["texts"] == 0
+    assert TokenizationCache(tmp_path, tokenizer, truncation=True, max_length=3).stats["texts"] == 3
+
+
+def test_tokenization_cache_eviction(tmp_path, make_tokenizer):
+    texts = [f"KONZUM P-{i:04d} ZAGREB" for i in range(100)]
+    tokenizer = make_tokenizer(texts)
+
+    cache = TokenizationCache(tmp_path, tokenizer, max_bytes=2_000)
+    for start in range(0, 100, 20):
+        cache.tokenize(texts[start:start+20])
+    assert cache.size() <= 2_000
+    assert 0 < cache.stats["texts"] < 100
+    assert cache.tokenize(texts).column("input_ids").to_pylist() == tokenizer(texts)["input_ids"]
+
+    cache.clear()
+    assert cache.stats == {"hits": cache.hits, "misses": cache.misses, "texts": 0, "bytes": 0}
+
+
+def test_tokenization_cache_shared_directory(tmp_path, make_tokenizer):
+    texts = [f"KONZUM P-{i:04d} ZAGREB" for i in range(100)]
+    tokenizer = make_tokenizer(texts)
+
+    # Caches with different settings evict each other's segments
+    full = TokenizationCache(tmp_path, tokenizer, max_bytes=3_000)
+    truncated = TokenizationCache(tmp_path, tokenizer, truncation=True, max_length=2, max_bytes=3_000)
+    for start in range(0, 100, 20):
+        batch = texts[start:start+20] + texts[:5]
+        assert full.tokenize(batch).column("input_ids").to_pylist() == tokenizer(batch)["input_ids"]
+        assert truncated.tokenize(batch).column("input_ids").to_pylist() == \
+            tokenizer(batch, truncation=True, max_length=2)["input_ids"]
+    assert full.size() <= 3_000
+
+    # The manifests on disk only list existing segments
+    for cache in (full, truncated):
+        reloaded = TokenizationCache(tmp_path, tokenizer, **cache.settings)
+        assert all((cache.path / f'{seg["name"]}_{k}.npy').exists()
+                   for seg in reloaded.manifest["segments"] for k in ("values", "offsets", "hashes"))
+    assert full.tokenize(texts).column("input_ids").to_pylist() == tokenizer(texts)["input_ids"]
+
+
+def test_slow_tokenizer_fingerprint(tmp_path):
+    from transformers import ProphetNetTokenizer
+
+    (tmp_path / "vocab.txt").write_text("\n".join(["[PAD]", "[UNK]", "[CLS]", "[SEP]", "[MASK]", "[X_SEP]", "konzum"]))
+    lower = ProphetNetTokenizer(str(tmp_path / "vocab.txt"), do_lower_case=True)
+    cased = ProphetNetTokenizer(str(tmp_path / "vocab.txt"), do_lower_case=False)
+    assert not lower.is_fast
+
+    assert tokenizer_fingerprint(lower) == tokenizer_fingerprint(ProphetNetTokenizer(str(tmp_path / "vocab.txt")))
+    assert tokenizer_fingerprint(lower) != tokenizer_fingerprint(cased)
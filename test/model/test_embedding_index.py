@@ -0,0 +1,43 @@
+import numpy as np
+from finmetrika_ml.model.embedding_index import *
+
+
+def _clusters(n=2_000, dim=16, n_centers=20, seed=0):
+    rng = np.random.default_rng(seed)
+    centers = rng.normal(size=(n_centers, dim))
+    labels = rng.integers(0, n_centers, n)
+    return centers[labels] + 0.3 * rng.normal(size=(n, dim)), labels
+
+
+def test_topk_cosine():
+    vectors, _ = _clusters()
+    queries = vectors[:50] + 0.01
+    sims = normalize(queries) @ normalize(vectors).T
+    expected = np.argsort(-sims, axis=1, kind="stable")[:, :5]
+
+    scores, indices = topk_cosine(queries, normalize(vectors), k=5, block_size=300, query_batch_size=16)
+    np.testing.assert_array_equal(indices, expected)
+    np.testing.assert_allclose(scores, np.take_along_axis(sims, expected, 1), rtol=1e-5)
+
+
+def test_embedding_index(tmp_path):
+    vectors, labels = _clusters()
+    queries, query_labels = _clusters(n=200, seed=0)
+
+    index = EmbeddingIndex(vectors, labels=[f"merchant_{l}" for l in labels])
+    _, exact = index.search(queries, k=10)
+    index.build_ivf(n_lists=32)
+    _, still_exact = index.search(queries, k=10)
+    np.testing.assert_array_equal(still_exact, exact)
+
+    assert index.recall(queries, k=10, n_probes=32) == 1.0
+    report = index.recall_report(queries, k=10, n_probes=[1, 4, 32])
+    assert report["recall"].iloc[1:].is_monotonic_increasing and report["recall"].iloc[-1] == 1.0
+    assert (index.predict(queries, k=5, n_probes=4) == np.array([f"merchant_{l}" for l in query_labels])).mean() > 0.9
+
+    index.save(tmp_path)
+    loaded = EmbeddingIndex.load(tmp_path)
+    assert isinstance(loaded.vectors, np.memmap)
+    for n_probes in [None, 4]:
+        np.testing.assert_array_equal(loaded.search(queries, 10, n_probes)[1], index.search(queries, 10, n_probes)[1])
+    np.testing.assert_array_equal(loaded.predict(queries, 5), index.predict(queries, 5))
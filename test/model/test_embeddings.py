@@ -0,0 +1,51 @@
+import json
+import pytest
+import numpy as np
+import torch
+from datasets import Dataset
+from finmetrika_ml.data.data_processing import extract_feature_vector
+from finmetrika_ml.model.embeddings import *
+
+
+@pytest.fixture
+def texts(transactions):
+    return transactions["text"].tolist()[:50]
+
+
+@pytest.fixture
+def dataset(texts, tokenizer):
+    return Dataset.from_dict(dict(tokenizer(texts, truncation=True, max_length=16)))
+
+
+def test_extract_embeddings(tmp_path, texts, tokenizer, dataset, tiny_model):
+    inputs = tokenizer(texts, padding=True, truncation=True, max_length=16, return_tensors="pt")
+
+    for pooling in ["cls", "mean"]:
+        embeddings = extract_embeddings(dataset, tiny_model, tokenizer, tmp_path / pooling, pooling=pooling,
+                                        dtype="float32", shard_size=20, batch_size=8, verbose=False)
+        expected = extract_feature_vector(inputs, tiny_model.base_model, tokenizer, "cpu", pooling=pooling)
+        assert embeddings.complete and embeddings.shape == (50, 64) and len(embeddings.shards) == 3
+        np.testing.assert_allclose(embeddings.to_numpy(), expected["feature_vector"], atol=1e-5)
+        np.testing.assert_allclose(embeddings[[45, 3, 21]], expected["feature_vector"][[45, 3, 21]], atol=1e-5)
+        np.testing.assert_allclose(embeddings[-1], expected["feature_vector"][-1], atol=1e-5)
+
+
+def test_extract_embeddings_resume(tmp_path, tokenizer, dataset, tiny_model):
+    full = extract_embeddings(dataset, tiny_model, tokenizer, tmp_path, shard_size=20, verbose=False).to_numpy()
+    assert full.dtype == np.float16
+
+    # Simulate a crash during the last shard
+    manifest = json.loads((tmp_path / "manifest.json").read_text())
+    manifest["shards"] = manifest["shards"][:2]
+    (tmp_path / "manifest.json").write_text(json.dumps(manifest))
+    (tmp_path / "shard_00002.npy").rename(tmp_path / "shard_00002.npy.tmp")
+    first_shard_mtime = (tmp_path / "shard_00000.npy").stat().st_mtime_ns
+    assert not EmbeddingShards(tmp_path).complete
+
+    resumed = extract_embeddings(dataset, tiny_model, tokenizer, tmp_path, shard_size=20, verbose=False)
+    assert resumed.complete
+    assert (tmp_path / "shard_00000.npy").stat().st_mtime_ns == first_shard_mtime
+    np.testing.assert_array_equal(resumed.to_numpy(), full)
+
+    with pytest.raises(ValueError):
+        extract_embeddings(dataset, tiny_model, tokenizer, tmp_path, pooling="mean", verbose=False)
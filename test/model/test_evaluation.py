@@ -0,0 +1,47 @@
+import pickle
+import numpy as np
+import pytest
+import torch
+from finmetrika_ml.model.evaluation import *
+
+
+def test_streaming_metrics():
+    rng = np.random.default_rng(0)
+    num_classes = 6
+    y_true = rng.integers(0, num_classes, 5000)
+    logits = rng.normal(size=(5000, num_classes))
+    logits[np.arange(5000), y_true] += 1.0
+    y_pred = logits.argmax(axis=1)
+
+    metrics = StreamingMetrics(num_classes, top_k=(1, 3))
+    for i in range(0, 5000, 512):
+        metrics.update(torch.as_tensor(y_true[i:i+512]), logits=torch.as_tensor(logits[i:i+512]))
+    result = metrics.compute()
+
+    assert result["n_samples"] == 5000
+    assert result["accuracy"] == pytest.approx((y_true == y_pred).mean())
+    assert result["top_1_accuracy"] == pytest.approx(result["accuracy"])
+    top3 = (np.argsort(-logits, axis=1)[:, :3] == y_true[:, None]).any(axis=1).mean()
+    assert result["top_3_accuracy"] == pytest.approx(top3)
+
+    precision = [(y_true[y_pred == c] == c).mean() for c in range(num_classes)]
+    recall = [(y_pred[y_true == c] == c).mean() for c in range(num_classes)]
+    f1 = [2 * p * r / (p + r) for p, r in zip(precision, recall)]
+    support = np.bincount(y_true, minlength=num_classes)
+    per_class = metrics.per_class()
+    np.testing.assert_allclose(per_class["precision"], precision)
+    np.testing.assert_allclose(per_class["f1"], f1)
+    assert result["macro_recall"] == pytest.approx(np.mean(recall))
+    assert result["weighted_f1"] == pytest.approx(np.average(f1, weights=support))
+
+    # Accumulators of separate workers merge to the same counts
+    parts = [StreamingMetrics(num_classes, top_k=(1, 3)).update(y_true[i::3], logits=logits[i::3]) for i in range(3)]
+    parts = [pickle.loads(pickle.dumps(p)) for p in parts]
+    merged = parts[0] + parts[1]
+    merged += StreamingMetrics.from_dict(parts[2].to_dict())
+    np.testing.assert_array_equal(merged.confusion, metrics.confusion)
+    assert merged.compute() == result
+
+    assert accuracy_metrics(y_true, y_pred)["macro_f1"] == pytest.approx(result["macro_f1"])
+    with pytest.raises(ValueError):
+        metrics.update([0, num_classes], [0, 1])
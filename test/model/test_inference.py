@@ -0,0 +1,36 @@
+import numpy as np
+import torch
+from finmetrika_ml.model.evaluation import fwd_pass
+from finmetrika_ml.data.data_processing import extract_feature_vector
+from finmetrika_ml.model.inference import *
+
+
+def test_unique_inference(tmp_path, transactions, tokenizer, tiny_model):
+    texts = transactions["text"].tolist()
+    texts += [t.lower() for t in texts[:20]]
+    inputs = tokenizer(texts, padding=True, truncation=True, max_length=16, return_tensors="pt")
+
+    infer = UniqueInference(tiny_model, tokenizer, max_length=16, batch_size=32, cache_dir=tmp_path)
+    predicted = infer(texts)["predicted_label"]
+    np.testing.assert_array_equal(predicted, fwd_pass(inputs, tiny_model, "cpu", tokenizer)["predicted_label"])
+    assert infer.stats["unique_texts"] < len(texts) and infer.stats["model_rows"] == infer.stats["unique_inputs"]
+
+    # A new job reads the outputs of the known inputs from the cache
+    infer = UniqueInference(tiny_model, tokenizer, max_length=16, cache_dir=tmp_path)
+    np.testing.assert_array_equal(infer(texts[::-1] + ["NEW MERCHANT"])["predicted_label"][:-1], predicted[::-1])
+    assert infer.stats["model_rows"] == 1 and infer.stats["cache_hits"] == infer.stats["unique_inputs"] - 1
+
+    features = UniqueInference(tiny_model, tokenizer, output="feature_vector", pooling="mean", max_length=16)(texts)
+    expected = extract_feature_vector(inputs, tiny_model.base_model, tokenizer, "cpu", pooling="mean")
+    np.testing.assert_allclose(features["feature_vector"], expected["feature_vector"], atol=1e-5)
+
+
+def test_unique_inference_missing_texts(transactions, tokenizer, tiny_model):
+    texts = transactions["text"].tolist()[:20]
+    expected = UniqueInference(tiny_model, tokenizer)(texts)["predicted_label"]
+
+    predicted = UniqueInference(tiny_model, tokenizer)(texts + [None])["predicted_label"]
+    np.testing.assert_array_equal(predicted, np.append(expected, -1))
+    logits = UniqueInference(tiny_model, tokenizer, output="logits")([None] + texts[:3])["logits"]
+    assert logits.shape == (4, 4) and np.isnan(logits[0]).all() and not np.isnan(logits[1:]).any()
+    assert UniqueInference(tiny_model, tokenizer, output="feature_vector")([None, None])["feature_vector"].shape == (2, 64)
@@ -0,0 +1,52 @@
+import warnings
+import pytest
+import numpy as np
+import torch
+from datasets import Dataset
+from finmetrika_ml.model.evaluation import fwd_pass
+from finmetrika_ml.model.quantization import *
+
+
+def test_quantize_and_trace(tmp_path, transactions, tokenizer, tiny_model):
+    texts = transactions["text"].iloc[:64].tolist()
+    model = tiny_model
+    inputs = tokenizer(texts, padding=True, return_tensors="pt")
+    expected = fwd_pass(inputs, model, "cpu", tokenizer)["predicted_label"]
+
+    with warnings.catch_warnings():
+        # The deprecation warnings of torch.ao.quantization are handled
+        warnings.simplefilter("error")
+        model_int8 = quantize_dynamic_int8(model)
+    assert type(model.bert.encoder.layer[0].intermediate.dense) is torch.nn.Linear
+    assert "quantized" in type(model_int8.bert.encoder.layer[0].intermediate.dense).__module__
+    assert model_size_mb(model_int8) < model_size_mb(model)
+
+    model.train()
+    with warnings.catch_warnings():
+        warnings.simplefilter("error")
+        traced = trace_model(model, tokenizer(texts[:4], padding=True, return_tensors="pt"), path=tmp_path / "model.pt")
+        trace_model(model_int8, tokenizer(texts[:4], padding=True, return_tensors="pt"))
+    assert model.training and model.bert.encoder.training
+    model.eval()
+    np.testing.assert_array_equal(fwd_pass(inputs, traced, "cpu", tokenizer)["predicted_label"], expected)
+    loaded = TracedClassifier.load(tmp_path / "model.pt")
+    np.testing.assert_array_equal(fwd_pass(inputs, loaded, "cpu", tokenizer)["predicted_label"], expected)
+
+
+def test_compare_quantized(transactions, tokenizer, make_tiny_model):
+    df = transactions.iloc[:200]
+    model = make_tiny_model(len(tokenizer), num_labels=int(df["label"].max()) + 1).train()
+    weights = model.classifier.weight.detach().clone()
+
+    report = compare_quantized(model, tokenizer, Dataset.from_pandas(df, preserve_index=False),
+                               batch_size=32, max_length=32)
+    # The caller's model is left as it was
+    assert model.training and model.classifier.weight.device.type == "cpu"
+    assert torch.equal(model.classifier.weight, weights)
+    assert list(report.index) == ["fp32", "int8", "fp32_traced", "int8_traced"]
+    assert report.loc["fp32", "agreement"] == 1.0 and report.loc["fp32_traced", "agreement"] == 1.0
+    assert report.loc["fp32", "safe"] and report.loc["int8", "size_mb"] < report.loc["fp32", "size_mb"]
+    assert {"accuracy", "latency_ms_p50", "latency_ms_p99", "samples_per_sec", "speedup"} <= set(report.columns)
+
+    with pytest.raises(ValueError):
+        compare_quantized(model, tokenizer, Dataset.from_pandas(df.iloc[:0], preserve_index=False))
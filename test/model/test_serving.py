@@ -0,0 +1,122 @@
+import asyncio
+import threading
+import pytest
+import numpy as np
+from finmetrika_ml.model.evaluation import fwd_pass
+from finmetrika_ml.model.serving import *
+
+
+def test_micro_batch_scorer(transactions, tokenizer, tiny_model):
+    texts = transactions["text"].iloc[:200].tolist()
+    inputs = tokenizer(texts, padding=True, truncation=True, max_length=32, return_tensors="pt")
+    expected = fwd_pass(inputs, tiny_model, "cpu", tokenizer)["predicted_label"].tolist()
+
+    async def run():
+        async with MicroBatchScorer(tiny_model, tokenizer, max_batch_size=16, max_wait_ms=20, max_length=32) as scorer:
+            results = await asyncio.gather(*[scorer.score(t) for t in texts])
+            return [r["predicted_label"] for r in results], scorer.metrics()
+
+    predicted, metrics = asyncio.run(run())
+    assert predicted == expected
+    assert metrics["requests"] == 200 and max(metrics["batch_size_histogram"]) == 16
+    assert metrics["mean_batch_size"] > 8 and metrics["latency_ms_p99"] >= metrics["latency_ms_p50"]
+
+
+def test_serve_http(transactions, tokenizer, tiny_model):
+    texts = transactions["text"].iloc[:100].tolist()
+
+    async def run():
+        scorer = MicroBatchScorer(tiny_model, tokenizer, max_batch_size=8, max_wait_ms=5)
+        server = await serve_http(scorer, port=0)
+        port = server.sockets[0].getsockname()[1]
+        report = await load_test(texts, port=port, concurrency=8)
+
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(b"GET /metrics HTTP/1.1\r\nConnection: close\r\n\r\n")
+        response = await reader.read()
+        writer.close()
+        await writer.wait_closed()
+        server.close()
+        await server.wait_closed()
+        await scorer.stop()
+        return report, response
+
+    report, response = asyncio.run(run())
+    assert report["requests"] == 100 and report["requests_per_sec"] > 0
+    assert response.startswith(b"HTTP/1.1 200") and b'"requests": 100' in response
+
+
+def test_micro_batch_scorer_errors(transactions, tokenizer, tiny_model):
+    texts = transactions["text"].iloc[:20].tolist()
+
+    class FailingScorer(MicroBatchScorer):
+        def _predict(self, texts):
+            if "BAD" in texts:
+                raise RuntimeError("bad text")
+            return super()._predict(texts)
+
+    async def run():
+        async with FailingScorer(tiny_model, tokenizer, max_batch_size=8, max_wait_ms=20) as scorer:
+            with pytest.raises(TypeError):
+                await scorer.score(None)
+            return await asyncio.gather(*[scorer.score(t) for t in texts[:5] + ["BAD"]], return_exceptions=True)
+
+    results = asyncio.run(run())
+    assert all("predicted_label" in r for r in results[:5])
+    assert isinstance(results[-1], RuntimeError)
+
+
+def test_micro_batch_scorer_stop_in_flight(transactions, tokenizer, tiny_model):
+    texts = transactions["text"].iloc[:20].tolist()
+    release, finished = threading.Event(), threading.Event()
+
+    class SlowScorer(MicroBatchScorer):
+        def _predict(self, texts):
+            release.wait(5)
+            predictions = super()._predict(texts)
+            finished.set()
+            return predictions
+
+    async def run():
+        scorer = SlowScorer(tiny_model, tokenizer, max_batch_size=4, max_wait_ms=1)
+        await scorer.start()
+        task = asyncio.ensure_future(scorer.score(texts[0]))
+        while not scorer._in_flight:
+            await asyncio.sleep(0.001)
+        stop = asyncio.ensure_future(scorer.stop())
+        # The caller is cancelled at once, stop() waits for the running batch
+        result = await asyncio.gather(task, return_exceptions=True)
+        await asyncio.sleep(0.05)
+        assert not stop.done()
+        release.set()
+        await asyncio.wait_for(stop, 5)
+        assert finished.is_set()
+        return result
+
+    assert isinstance(asyncio.run(run())[0], asyncio.CancelledError)
+
+
+def test_serve_http_bad_requests(tokenizer, tiny_model):
+
+    async def request(port, data):
+        reader, writer = await asyncio.open_connection("127.0.0.1", port)
+        writer.write(data)
+        response = await asyncio.wait_for(reader.read(), 5)
+        writer.close()
+        await writer.wait_closed()
+        return response
+
+    async def run():
+        scorer = MicroBatchScorer(tiny_model, tokenizer, max_batch_size=8, max_wait_ms=5)
+        server = await serve_http(scorer, port=0)
+        port = server.sockets[0].getsockname()[1]
+        responses = [await request(port, data) for data in
+                     [b"GARBAGE\r\n\r\n",
+                      b"POST /score HTTP/1.1\r\nContent-Length: abc\r\n\r\n",
+                      b'POST /score HTTP/1.1\r\nContent-Length: 13\r\nConnection: close\r\n\r\n{"text": 123}']]
+        server.close()
+        await server.wait_closed()
+        await scorer.stop()
+        return responses
+
+    assert all(r.startswith(b"HTTP/1.1 400") for r in asyncio.run(run()))
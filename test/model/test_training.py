@@ -0,0 +1,149 @@
+import pytest
+import numpy as np
+import torch
+from finmetrika_ml.data.data_processing import RegressionDataset1D
+from finmetrika_ml.model.training import *
+from finmetrika_ml.model.training import _column_fingerprint
+
+
+def _regression(batch_size, grad_accumulation_steps, **kwargs):
+    torch.manual_seed(0)
+    X = np.linspace(-1, 1, 32, dtype=np.float32)
+    dataset = RegressionDataset1D(X, 3 * X + 1)
+    loader = torch.utils.data.DataLoader(dataset, batch_size=batch_size, collate_fn=RegressionDataset1D.collate)
+    model = torch.nn.Linear(1, 1)
+    trainer = TrainNN(model, loader, torch.nn.MSELoss(), torch.optim.SGD(model.parameters(), lr=0.1),
+                      num_epochs=3, device="cpu", grad_accumulation_steps=grad_accumulation_steps,
+                      verbose=False, **kwargs)
+    return trainer, trainer.train()
+
+
+def test_train_nn():
+    trainer, history = _regression(batch_size=8, grad_accumulation_steps=1)
+    assert len(history) == 3 and history[-1]["loss"] < history[0]["loss"]
+    assert history[0]["samples"] == 32 and history[0]["batches"] == 4
+    assert {"samples_per_sec", "tokens_per_sec", "step_ms_p50", "step_ms_p99", "peak_memory_mb"} <= set(history[0])
+    assert history[0]["peak_memory_scope"] == "process"
+
+    # Accumulating 2 batches of 4 is one step over 8 samples
+    accumulated, _ = _regression(batch_size=4, grad_accumulation_steps=2, prefetch=0)
+    for p, q in zip(trainer.model.parameters(), accumulated.model.parameters()):
+        torch.testing.assert_close(p, q)
+    # The last group of 1 batch is not under-weighted: 3 + 1 batches of 8 is 24 + 8 samples
+    accumulated, _ = _regression(batch_size=8, grad_accumulation_steps=3)
+    loader = torch.utils.data.DataLoader(RegressionDataset1D(np.linspace(-1, 1, 32, dtype=np.float32),
+                                                             3 * np.linspace(-1, 1, 32, dtype=np.float32) + 1),
+                                         sampler=[list(range(24)), list(range(24, 32))], batch_size=None,
+                                         collate_fn=RegressionDataset1D.collate)
+    torch.manual_seed(0)
+    model = torch.nn.Linear(1, 1)
+    TrainNN(model, loader, torch.nn.MSELoss(), torch.optim.SGD(model.parameters(), lr=0.1),
+            num_epochs=3, device="cpu", verbose=False).train()
+    for p, q in zip(model.parameters(), accumulated.model.parameters()):
+        torch.testing.assert_close(p, q)
+
+    num_threads = torch.get_num_threads()
+    bf16, history = _regression(batch_size=8, grad_accumulation_steps=1, autocast_dtype=torch.bfloat16,
+                                num_threads=num_threads + 1)
+    assert np.isfinite(history[-1]["loss"])
+    assert torch.get_num_threads() == num_threads
+
+
+def test_prefetch_stops_early():
+    import threading
+    from finmetrika_ml.model.training import _prefetch
+
+    produced = []
+    def batches():
+        for i in range(1000):
+            produced.append(i)
+            yield i
+
+    n_threads = threading.active_count()
+    for i in _prefetch(batches(), n_batches=2):
+        if i == 3:
+            break
+    # The producer thread is joined and stopped after at most the buffered batches
+    assert threading.active_count() == n_threads
+    assert len(produced) <= 4 + 2 + 1
+
+    class Interrupt(BaseException):
+        pass
+
+    def failing():
+        yield 0
+        raise Interrupt
+    with pytest.raises(Interrupt):
+        list(_prefetch(failing(), n_batches=2))
+    assert threading.active_count() == n_threads
+
+
+def test_train_nn_transformers(make_tiny_model):
+    torch.manual_seed(0)
+    model = make_tiny_model(vocab_size=20, num_labels=2)
+    input_ids = torch.randint(1, 20, (16, 6))
+    batches = [{"input_ids": input_ids[i:i+4], "attention_mask": torch.ones(4, 6, dtype=torch.long),
+                "labels": (input_ids[i:i+4, 0] > 10).long()} for i in range(0, 16, 4)]
+    trainer = TrainNN(model, batches, None, torch.optim.AdamW(model.parameters(), lr=1e-3),
+                      num_epochs=2, device="cpu", verbose=False)
+    history = trainer.train()
+    assert history[0]["tokens"] == 16 * 6 and history[0]["samples"] == 16
+
+
+def test_fine_tune_fts_extraction(tmp_path, monkeypatch, transactions, tokenizer, tiny_model):
+    from datasets import Dataset, DatasetDict
+
+    dataset = DatasetDict({"train": Dataset.from_pandas(transactions[:200], preserve_index=False),
+                           "validation": Dataset.from_pandas(transactions[200:], preserve_index=False)})
+    n_calls = []
+    tiny_model.base_model.register_forward_hook(lambda *args: n_calls.append(1))
+
+    fine_tune = FineTuneFtsExtraction("tiny", dataset, cache_dir=tmp_path, model=tiny_model, tokenizer=tokenizer,
+                                      pooling="mean", max_length=16, batch_size=64)
+    fingerprints = []
+    monkeypatch.setattr("finmetrika_ml.model.training._column_fingerprint",
+                        lambda *args, **kwargs: fingerprints.append(1) or _column_fingerprint(*args, **kwargs))
+    hidden_states = fine_tune.extract_hidden_states()
+    # One fingerprint per split
+    assert len(fingerprints) == 2
+    assert hidden_states["train"].shape == (200, 64) and hidden_states["validation"].shape == (100, 64)
+    n_backbone_calls = len(n_calls)
+
+    fine_tune.train_head("logistic")
+    assert fine_tune.evaluate("train") > 0.8
+    fine_tune.train_head("mlp", num_epochs=30)
+    assert fine_tune.predict("validation").shape == (100,)
+    assert len(n_calls) == n_backbone_calls
+
+    # A new run only reads the cached hidden states, the backbone is never loaded
+    cached = FineTuneFtsExtraction("tiny", dataset, cache_dir=tmp_path, pooling="mean", max_length=16)
+    cached.train_head("logistic")
+    fine_tune.train_head("logistic")
+    assert cached._model is None
+    np.testing.assert_array_equal(cached.predict("validation"), fine_tune.predict("validation"))
+
+    # Another pooling or other data rebuild the cache
+    cls = FineTuneFtsExtraction("tiny", dataset, cache_dir=tmp_path, model=tiny_model, tokenizer=tokenizer,
+                                pooling="cls", max_length=16)
+    fingerprints.clear()
+    assert not np.allclose(cls.features("train")[0], cached.features("train")[0])
+    assert len(fingerprints) == 1
+    assert len(n_calls) > n_backbone_calls
+    changed = DatasetDict({"train": dataset["train"].select(range(60)), "validation": dataset["validation"]})
+    changed = FineTuneFtsExtraction("tiny", changed, cache_dir=tmp_path, model=tiny_model, tokenizer=tokenizer,
+                                    pooling="cls", max_length=16)
+    changed.train_head("logistic")
+    assert changed.features("train")[0].shape == (60, 64)
+    np.testing.assert_array_equal(changed.features("validation")[0], cls.features("validation")[0])
+    reversed_ = DatasetDict({"train": dataset["train"].select(range(59, -1, -1))})
+    reversed_ = FineTuneFtsExtraction("tiny", reversed_, cache_dir=tmp_path, model=tiny_model, tokenizer=tokenizer,
+                                      pooling="cls", max_length=16)
+    np.testing.assert_allclose(reversed_.features("train")[0], changed.features("train")[0].flip(0), atol=1e-5)
+
+    unlabelled = DatasetDict({"test": dataset["validation"].remove_columns("label")})
+    unlabelled = FineTuneFtsExtraction("tiny", unlabelled, cache_dir=tmp_path, model=tiny_model, tokenizer=tokenizer,
+                                       pooling="cls", max_length=16)
+    unlabelled.head = cls.train_head("logistic")
+    assert unlabelled.predict("test").shape == (100,)
+    with pytest.raises(ValueError):
+        unlabelled.evaluate("test")
@@ -0,0 +1,22 @@
+import sys
+import pandas as pd
+from finmetrika_ml.cli import clean_file_main
+from finmetrika_ml.data.data_cleaning import remove_ccard, remove_punctuation
+
+
+def test_clean_file_main(tmp_path, monkeypatch):
+    texts = ["KONZUM P-0980 ZAGREB 462765XXXXXX1234", "PAYPAL *NETFLIX.COM"]
+    pd.DataFrame({"description": texts}).to_csv(tmp_path / "trx.csv", index=False)
+
+    # Single function name
+    monkeypatch.setattr(sys, "argv", ["fm_clean_file", str(tmp_path / "trx.csv"), str(tmp_path / "one.parquet"),
+                                      "--text-column", "description", "--pipeline", "remove_ccard"])
+    clean_file_main()
+    assert pd.read_parquet(tmp_path / "one.parquet")["description"].tolist() == [remove_ccard(t) for t in texts]
+
+    # Comma separated functions and a new output column
+    clean_file_main([str(tmp_path / "trx.csv"), str(tmp_path / "two.parquet"), "--text-column", "description",
+                     "--pipeline", "remove_ccard,remove_punctuation", "--output-column", "clean", "--batch-size", "1"])
+    out = pd.read_parquet(tmp_path / "two.parquet")
+    assert out["description"].tolist() == texts
+    assert out["clean"].tolist() == [remove_punctuation(remove_ccard(t)) for t in texts]